@@ -0,0 +1,232 @@
+#!/usr/bin/env python3
+
+'''
+bench_ingest:
+
+Measure the throughput of each ingest stage and write the results as JSON
+so they can be compared between versions:
+  parse: parseRows rows/sec
+  fetch: getBlocks bytes/sec from an S3 service
+  write: addRows rows/sec for a range of batch sizes, to a HDF5 file and
+    (with --hsds) to a HSDS domain
+  ingest: addYearData rows/sec, from S3 to a HDF5 file
+
+The fetch and ingest stages upload the CSV text to an S3 service given by
+the s3_endpoint config, e.g. a local moto or minio server:
+  moto_server -p 5000 &
+  python bench_ingest.py --s3_endpoint=http://localhost:5000 --ghcn_bucket=ghcn-bench
+These stages are skipped if s3_endpoint isn't set.  Config values (e.g.
+block_size, fetch_concurrency, cache_dir) can be set the same way.
+'''
+
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+import numpy as np
+import h5py
+
+from bench_util import REPO_DIR, getText
+import config
+from ghcn_parse import parseRows
+from ghcn_s3 import getClient, getBlocks
+from ghcn_table import createDataTable
+from ghcn_update import h5File, addRows, addYearData
+from ghcn_dtype import dt_station
+
+BATCH_ROWS = (10000, 100000, 1000000)  # batch sizes for the write stage
+STAGES = ("parse", "fetch", "write", "ingest")
+
+
+def usage():
+    print("Usage: python bench_ingest.py [options] [<csv_file>|<row_count>]")
+    print("options:")
+    print("  --output <file>: write JSON results to file (default: stdout)")
+    print("  --stages <list>: comma separated stages to run, from: " + ",".join(STAGES))
+    print("  --repeat <n>: run each measurement n times and report the fastest")
+    print("  --hsds <domain>: also run the write stage on this HSDS domain (hdf5://...)")
+    print("  --<config key>=<value>: override config value")
+    sys.exit(0)
+
+
+def getVersion():
+    """ return the git commit of the collector, or None """
+    try:
+        out = subprocess.run(["git", "describe", "--always", "--dirty"], cwd=REPO_DIR,
+                             capture_output=True, text=True, check=True)
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return out.stdout.strip()
+
+
+def best(func, repeat):
+    """ call func repeat times, return its result and the shortest time """
+    elapsed = None
+    result = None
+    for _ in range(repeat):
+        start_time = time.perf_counter()
+        result = func()
+        t = time.perf_counter() - start_time
+        if elapsed is None or t < elapsed:
+            elapsed = t
+    return result, elapsed
+
+
+def makeResult(stage, setting, seconds, rows=None, num_bytes=None):
+    result = {"stage": stage, "setting": setting, "seconds": round(seconds, 6)}
+    if rows is not None:
+        result["rows"] = rows
+        result["rows_per_sec"] = int(rows / seconds) if seconds > 0 else None
+    if num_bytes is not None:
+        result["bytes"] = num_bytes
+        result["bytes_per_sec"] = int(num_bytes / seconds) if seconds > 0 else None
+    print(f"{stage:<8} {setting:<40} {seconds:>9.3f} s", file=sys.stderr)
+    return result
+
+
+def benchParse(text, repeat):
+    rows, elapsed = best(lambda: parseRows(text), repeat)
+    return [makeResult("parse", "parseRows", elapsed, rows=len(rows), num_bytes=len(text))]
+
+
+def createFile(filepath):
+    """ create an empty data file """
+    f = h5File(filepath, mode='w')
+    createDataTable(f, "data")
+    f.create_dataset("stations", (0,), maxshape=(None,), chunks=(1000,), dtype=dt_station)
+    return f
+
+
+def benchWrite(rows, filepath, repeat):
+    results = []
+    for batch_rows in BATCH_ROWS:
+        def writeRows():
+            with createFile(filepath) as f:
+                for start in range(0, len(rows), batch_rows):
+                    addRows(f, rows[start:start+batch_rows])
+        _, elapsed = best(writeRows, repeat)
+        kind = "hsds" if filepath.startswith("hdf5://") else "h5py"
+        results.append(makeResult("write", f"{kind} batch_rows={batch_rows}", elapsed,
+                                  rows=len(rows), num_bytes=rows.nbytes))
+    return results
+
+
+def uploadText(text, year):
+    """ put text in the bucket as the CSV file for year """
+    import boto3
+    s3_bucket = config.get("ghcn_bucket")
+    s3_key = f"{config.get('ghcn_path')}{year}.csv"
+    s3 = boto3.client('s3', endpoint_url=config.get("s3_endpoint"))
+    try:
+        s3.create_bucket(Bucket=s3_bucket)
+    except s3.exceptions.BucketAlreadyOwnedByYou:
+        pass
+    # the collector's requests are unsigned, so the object must be public
+    s3.put_object(Bucket=s3_bucket, Key=s3_key, Body=text, ACL='public-read')
+    return s3_bucket, s3_key
+
+
+def benchFetch(text, year, repeat):
+    s3_bucket, s3_key = uploadText(text, year)
+    s3 = getClient()
+
+    def fetch():
+        num_bytes = 0
+        blocks = getBlocks(s3, s3_bucket, s3_key, 0, len(text), config.get("block_size"),
+                           concurrency=config.get("fetch_concurrency"),
+                           prefetch=config.get("prefetch_depth"),
+                           chunk_size=config.get("stream_chunk_size"))
+        for block in blocks:
+            num_bytes += len(block)
+        return num_bytes
+
+    num_bytes, elapsed = best(fetch, repeat)
+    setting = f"block_size={config.get('block_size')} concurrency={config.get('fetch_concurrency')}"
+    return [makeResult("fetch", setting, elapsed, num_bytes=num_bytes)]
+
+
+def benchIngest(text, year, filepath, repeat):
+    uploadText(text, year)
+
+    def ingest():
+        with createFile(filepath) as f:
+            return addYearData(f, year)
+
+    count, elapsed = best(ingest, repeat)
+    return [makeResult("ingest", "addYearData", elapsed, rows=count, num_bytes=len(text))]
+
+
+#
+# Main
+#
+output = None
+stages = STAGES
+repeat = 3
+hsds_domain = None
+arg = None
+argn = 1
+while argn < len(sys.argv):
+    opt = sys.argv[argn]
+    argn += 1
+    if opt in ("-h", "--help"):
+        usage()
+    elif opt == "--output":
+        output = sys.argv[argn]
+        argn += 1
+    elif opt == "--stages":
+        stages = sys.argv[argn].split(',')
+        argn += 1
+    elif opt == "--repeat":
+        repeat = int(sys.argv[argn])
+        argn += 1
+    elif opt == "--hsds":
+        hsds_domain = sys.argv[argn]
+        argn += 1
+    elif opt.startswith("--"):
+        # config override, read by config.get
+        continue
+    else:
+        arg = opt
+
+text = getText(arg)
+rows = parseRows(text)
+# the text is uploaded as the CSV file for the year of its first row
+year = int(rows['ymd'][0][:4])
+
+report = {
+    "version": getVersion(),
+    "timestamp": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+    "python": platform.python_version(),
+    "numpy": np.__version__,
+    "h5py": h5py.__version__,
+    "rows": len(rows),
+    "csv_bytes": len(text),
+    "results": [],
+}
+results = report["results"]
+
+with tempfile.TemporaryDirectory() as tmpdir:
+    filepath = os.path.join(tmpdir, "bench.h5")
+    if "parse" in stages:
+        results.extend(benchParse(text, repeat))
+    if "write" in stages:
+        results.extend(benchWrite(rows, filepath, repeat))
+        if hsds_domain:
+            results.extend(benchWrite(rows, hsds_domain, repeat))
+    if "fetch" in stages or "ingest" in stages:
+        if not config.get("s3_endpoint"):
+            print("s3_endpoint not set, skipping fetch and ingest stages", file=sys.stderr)
+        else:
+            if "fetch" in stages:
+                results.extend(benchFetch(text, year, repeat))
+            if "ingest" in stages:
+                results.extend(benchIngest(text, year, filepath, repeat))
+
+if output:
+    with open(output, 'w') as fh:
+        json.dump(report, fh, indent=2)
+else:
+    print(json.dumps(report, indent=2))
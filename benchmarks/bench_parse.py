@@ -0,0 +1,42 @@
+#!/usr/bin/env python3
+
+'''
+bench_parse:
+
+Compare rows/sec of the vectorized CSV parser (parseRows) with the
+original per-row loop (parseRowsLoop).
+'''
+
+import sys
+import time
+import numpy as np
+
+from bench_util import getText
+from ghcn_parse import parseRows, parseRowsLoop
+
+
+def timeit(func, arg):
+    start = time.time()
+    result = func(arg)
+    return result, time.time() - start
+
+
+#
+# Main
+#
+if len(sys.argv) > 1 and sys.argv[1] in ("-h", "--help"):
+    print("Usage: python bench_parse.py [<csv_file>|<row_count>]")
+    sys.exit(0)
+
+text = getText(sys.argv[1] if len(sys.argv) > 1 else None)
+
+arr_loop, loop_time = timeit(parseRowsLoop, text.decode('ascii').splitlines())
+arr_vec, vec_time = timeit(parseRows, text)
+
+print(f"rows: {len(arr_vec)} bytes: {len(text)}")
+print(f"parseRowsLoop: {loop_time:8.3f} s - rows/sec: {int(len(arr_loop)/loop_time)}")
+print(f"parseRows:     {vec_time:8.3f} s - rows/sec: {int(len(arr_vec)/vec_time)}")
+print(f"speedup: {loop_time/vec_time:.1f}x")
+if not np.array_equal(arr_loop, arr_vec):
+    print("WARNING: parser results differ")
+    sys.exit(1)
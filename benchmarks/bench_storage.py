@@ -0,0 +1,89 @@
+#!/usr/bin/env python3
+
+'''
+bench_storage:
+
+Ingest a sample of GHCN data into HDF5 files with different chunk
+sizes, compression filters and layouts, and report the file size,
+write rows/sec and scan rows/sec for each.
+
+Use a real year file for meaningful compression numbers, e.g.:
+  aws s3 cp --no-sign-request s3://noaa-ghcn-pds/csv/1950.csv .
+  python bench_storage.py 1950.csv
+'''
+
+import os
+import sys
+import time
+import tempfile
+import h5py
+
+from bench_util import getText
+from ghcn_parse import parseRows
+from ghcn_table import createDataTable, getDataTable
+
+BATCH_ROWS = 1048576  # rows per write, about what a write buffer flush holds
+
+# (name, createDataTable keyword arguments)
+SETTINGS = (
+    ("none", {}),
+    ("gzip-1", {"compression": "gzip", "compression_opts": 1}),
+    ("gzip-4", {"compression": "gzip", "compression_opts": 4}),
+    ("gzip-4 shuffle", {"compression": "gzip", "compression_opts": 4, "shuffle": True}),
+    ("gzip-9 shuffle", {"compression": "gzip", "compression_opts": 9, "shuffle": True}),
+    ("lzf", {"compression": "lzf"}),
+    ("lzf shuffle", {"compression": "lzf", "shuffle": True}),
+    ("gzip-4 shuffle chunks=22817", {"compression": "gzip", "compression_opts": 4, "shuffle": True, "chunks": (22817,)}),
+    ("gzip-4 shuffle chunks=365072", {"compression": "gzip", "compression_opts": 4, "shuffle": True, "chunks": (365072,)}),
+    ("columns gzip-4 shuffle", {"layout": "columns", "compression": "gzip", "compression_opts": 4, "shuffle": True}),
+    ("compact", {"encoding": "compact"}),
+    ("compact gzip-4 shuffle", {"encoding": "compact", "compression": "gzip", "compression_opts": 4, "shuffle": True}),
+    ("columns compact gzip-4 shuffle", {"layout": "columns", "encoding": "compact", "compression": "gzip", "compression_opts": 4, "shuffle": True}),
+)
+
+
+def benchSetting(filepath, rows, kwargs):
+    """ write and scan rows with the given settings, return (size, write
+        time, scan time) """
+    if os.path.exists(filepath):
+        os.remove(filepath)
+    with h5py.File(filepath, mode='w') as f:
+        createDataTable(f, "data", **kwargs)
+        dset = getDataTable(f)
+        start_time = time.time()
+        for start in range(0, len(rows), BATCH_ROWS):
+            batch = rows[start:start+BATCH_ROWS]
+            next_row = dset.shape[0]
+            dset.resize((next_row+len(batch),))
+            dset[next_row:next_row+len(batch)] = batch
+        write_time = time.time() - start_time
+
+    with h5py.File(filepath, mode='r') as f:
+        dset = getDataTable(f)
+        scan_rows = dset.chunks[0] * 4
+        start_time = time.time()
+        for start in range(0, dset.shape[0], scan_rows):
+            dset[start:start+scan_rows]
+        scan_time = time.time() - start_time
+    return os.path.getsize(filepath), write_time, scan_time
+
+
+#
+# Main
+#
+if len(sys.argv) > 1 and sys.argv[1] in ("-h", "--help"):
+    print("Usage: python bench_storage.py [<csv_file>|<row_count>]")
+    sys.exit(0)
+
+text = getText(sys.argv[1] if len(sys.argv) > 1 else None)
+rows = parseRows(text)
+count = len(rows)
+print(f"rows: {count} csv bytes: {len(text)} dt_day bytes: {rows.nbytes}")
+print(f"{'setting':<32} {'size MB':>9} {'ratio':>6} {'write rows/s':>13} {'scan rows/s':>13}")
+
+with tempfile.TemporaryDirectory() as tmpdir:
+    filepath = os.path.join(tmpdir, "bench.h5")
+    for name, kwargs in SETTINGS:
+        size, write_time, scan_time = benchSetting(filepath, rows, kwargs)
+        ratio = rows.nbytes / size
+        print(f"{name:<32} {size/1e6:>9.2f} {ratio:>6.1f} {int(count/write_time):>13} {int(count/scan_time):>13}")
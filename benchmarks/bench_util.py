@@ -0,0 +1,51 @@
+'''
+bench_util:
+
+Shared helpers for the benchmark scripts.
+'''
+
+import os
+import sys
+import numpy as np
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+if "CONFIG_DIR" not in os.environ:
+    # use the collector's config.yml
+    os.environ["CONFIG_DIR"] = REPO_DIR
+
+
+def makeRows(count, seed=0, year=2020, num_stations=2000):
+    """ return count rows of synthetic GHCN CSV text.  Rows are ordered
+        by date and then station, like the yearly CSV files. """
+    rng = np.random.default_rng(seed)
+    station_ids = [f"USC00{n:06d}" for n in sorted(rng.choice(999999, num_stations, replace=False))]
+    elements = ("TMAX", "TMIN", "PRCP", "SNOW", "SNWD")
+    start = np.datetime64(f"{year}-01-01")
+    lines = []
+    day = 0
+    while len(lines) < count:
+        ymd = str(start + day).replace('-', '')
+        for station_id in station_ids:
+            for element in elements[:rng.integers(1, len(elements)+1)]:
+                data_value = rng.integers(-300, 400)
+                m_flag = "T" if data_value == 0 and element == "PRCP" else ""
+                s_flag = "7" if len(lines) % 3 else "a"
+                obs_time = "0700" if len(lines) % 4 else ""
+                lines.append(f"{station_id},{ymd},{element},{data_value},{m_flag},,{s_flag},{obs_time}\n")
+                if len(lines) == count:
+                    break
+            if len(lines) == count:
+                break
+        day += 1
+    return "".join(lines).encode('ascii')
+
+
+def getText(arg, default_count=1000000):
+    """ return CSV text from the file named by arg, or synthetic text with
+        arg (or default_count) rows """
+    if arg and os.path.isfile(arg):
+        with open(arg, 'rb') as fh:
+            return fh.read()
+    count = int(arg) if arg else default_count
+    return makeRows(count)
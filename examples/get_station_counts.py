@@ -1,56 +1,66 @@
+import os
 import sys
 import time
 import logging
-import h5pyd
- 
-if len(sys.argv) < 2 or sys.argv[1] in ('-h', '--help'):
-    print("usage: python get_station_ids <ghcn_file>")
-    sys.exit(0)
-filename = sys.argv[1]
-
-logging.basicConfig(level=logging.ERROR)
-start_time = time.time()
-logging.info(f"start_time: {start_time:.2f}")
-
-f = h5pyd.File(filename, mode='r', use_cache=False)
-dset = f['data']
-station_year_map = {}
-cursor = dset.create_cursor()
-bad_count = 0
-line_count = 0
-year_count = 0
-previous_year = 0
-for row in cursor:
-    station_id = row['station_id'].decode('ascii')
-    ymd = row['ymd'].decode('ascii')
-    line_count += 1
-    if len(ymd) != 8:
-        # print(f"unexpected ymd: {ymd}")
-        bad_count += 1
-        continue
-    year = int(ymd[:4])  # format YYYYMMDD
-    if year != previous_year:
-        now = time.time()
-        if previous_year:
-            elapsed = now-start_time
-            msg = f"year: {previous_year} processing time: {elapsed:6.2f} s "
-            msg += f"for {year_count} lines - "
-            msg += f"lines/sec: {int((year_count/elapsed))}"
-            logging.info(msg)
-        year_count = 0
-        previous_year = year
-    year_count += 1
-    if year not in station_year_map:
-        station_year_map[year] = set()
-    station_ids = station_year_map[year]
-    station_ids.add(station_id)
-     
-now = time.time()
-logging.info(f"finish time +{(now-start_time):.2f}")
-logging.info(f"year_count: {len(station_year_map)}")
-logging.info(f"line count: {line_count}")
-logging.info(f"bad lines: {bad_count}")
-
-for year in station_year_map:
-    station_ids = station_year_map[year]
-    print(f"{year} - {len(station_ids)}") 
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from ghcn_scan import scan
+
+
+def getStationYears(rows):
+    """ Return (bad_count, {year: (line count, unique station_ids)}) for a slice of rows """
+    ymd = rows['ymd']
+    valid = np.char.str_len(ymd) == 8
+    ymd = ymd[valid]
+    station_ids = rows['station_id'][valid]
+    years = ymd.astype('S4').astype(np.int32)  # format YYYYMMDD
+    station_years = {}
+    for year in np.unique(years):
+        in_year = years == year
+        station_years[int(year)] = (np.count_nonzero(in_year), np.unique(station_ids[in_year]))
+    return len(rows) - len(ymd), station_years
+
+
+#
+# Main
+#
+if __name__ == "__main__":
+    if len(sys.argv) < 2 or sys.argv[1] in ('-h', '--help'):
+        print("usage: python get_station_counts.py [--workers=<n>] <ghcn_file>")
+        sys.exit(0)
+    workers = None
+    filename = None
+    for arg in sys.argv[1:]:
+        if arg.startswith("--workers="):
+            workers = int(arg[len("--workers="):])
+        else:
+            filename = arg
+
+    logging.basicConfig(level=logging.ERROR)
+    start_time = time.time()
+    logging.info(f"start_time: {start_time:.2f}")
+
+    station_year_map = {}  # year -> list of station_id arrays
+    year_lines = {}
+    bad_count = 0
+    for slice_bad, station_years in scan(filename, getStationYears, workers=workers,
+                                         fields=('station_id', 'ymd')):
+        bad_count += slice_bad
+        for year, (count, station_ids) in station_years.items():
+            year_lines[year] = year_lines.get(year, 0) + count
+            station_year_map.setdefault(year, []).append(station_ids)
+
+    line_count = bad_count + sum(year_lines.values())
+    now = time.time()
+    elapsed = now - start_time
+    logging.info(f"finish time +{elapsed:.2f}")
+    logging.info(f"year_count: {len(station_year_map)}")
+    logging.info(f"line count: {line_count}")
+    logging.info(f"bad lines: {bad_count}")
+
+    for year in sorted(station_year_map):
+        station_ids = np.unique(np.concatenate(station_year_map[year]))
+        print(f"{year} - {len(station_ids)}")
+    if elapsed > 0:
+        print(f"scanned {line_count} lines in {elapsed:.2f} s - lines/sec: {int(line_count/elapsed)}")
@@ -1,7 +1,10 @@
 import sys
+import time
 import h5py
 import h5pyd
 
+from ghcn_table import getShardGroups
+
 def h5File(path):
     """ open a HSDS domain or HDF5 file based on the path.
         if path starts with "hdf5://", use HSDS, otherwise
@@ -17,14 +20,32 @@ def h5File(path):
 # Main
 #
 if len(sys.argv) < 2 or sys.argv[1] in ("-h", "--help"):
-    print("Usage: python get_row_marker.py <filepath>")
+    print("Usage: python get_row_marker.py <filepath> [<year>]")
     sys.exit(0)
 
 filepath = sys.argv[1]
+year = None
+if len(sys.argv) > 2:
+    year = int(sys.argv[2])
 f = h5File(filepath)
-dset = f["data"]
-if "_row_marker" in dset.attrs:
-    row_marker = dset.attrs["_row_marker"]
-    print(f"year: {row_marker[0]} row: {row_marker[1]}")
-else:
-    print("not found")
+for grp in getShardGroups(f):
+    if grp != f:
+        print(f"{grp.name}:")
+    if "data" in grp and "_row_marker" in grp["data"].attrs:
+        # dataset, or group for the columns layout
+        row_marker = grp["data"].attrs["_row_marker"]
+        print(f"year: {row_marker[0]} row: {row_marker[1]}")
+    elif "manifest" not in grp:
+        print("not found")
+
+    if "manifest" in grp:
+        manifest = grp["manifest"][...]
+        manifest.sort(order='year')
+        print("manifest:")
+        print(f"{'year':>6} {'byte_offset':>14} {'row_count':>12} {'last_modified':<20} etag")
+        for entry in manifest:
+            if year is not None and entry['year'] != year:
+                continue
+            last_modified = time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime(entry['last_modified']))
+            etag = entry['etag'].decode('ascii')
+            print(f"{entry['year']:>6} {entry['byte_offset']:>14} {entry['row_count']:>12} {last_modified:<20} {etag}")
@@ -0,0 +1,132 @@
+'''
+GHCN_cache:
+
+Local disk cache of byte ranges read from S3.  Ranges are stored one per
+file, named by a hash of bucket, key, ETag and byte range, so a cached
+range is only used while the object is unchanged.  When the cache grows
+past its size limit, the least recently used files are removed.
+'''
+
+import hashlib
+import logging
+import os
+import threading
+import config
+
+EVICT_RATIO = 0.9  # eviction removes files until the cache is this fraction of max_size
+
+_cache = None
+_cache_pid = None
+_cache_lock = threading.Lock()
+
+
+class CacheWriter:
+    """ Writes a range to a temporary file that is moved into the cache
+    by commit.  If close is called before commit, the file is removed. """
+
+    def __init__(self, cache, path):
+        self.cache = cache
+        self.path = path
+        self.tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        self.fh = open(self.tmp_path, 'wb')
+        self.size = 0
+
+    def write(self, data):
+        self.fh.write(data)
+        self.size += len(data)
+
+    def commit(self):
+        self.fh.close()
+        os.replace(self.tmp_path, self.path)
+        self.cache.added(self.size)
+
+    def close(self):
+        if not self.fh.closed:
+            self.fh.close()
+            os.remove(self.tmp_path)
+
+
+class BlockCache:
+    """ Byte ranges of S3 objects, stored in cache_dir.  max_size is the
+    total size in bytes that the cache is allowed to grow to. """
+
+    def __init__(self, cache_dir, max_size):
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+        self.lock = threading.Lock()
+        os.makedirs(cache_dir, exist_ok=True)
+        self.size = sum(entry.stat().st_size for entry in self._entries())
+        logging.info(f"using cache: {cache_dir}, size: {self.size}")
+
+    def _entries(self):
+        """ return DirEntry for each cached range """
+        with os.scandir(self.cache_dir) as it:
+            return [entry for entry in it if entry.name.endswith(".blk")]
+
+    def getPath(self, s3_bucket, s3_key, etag, range_start, range_end):
+        """ return the file path for a range """
+        name = f"{s3_bucket}/{s3_key}/{etag}/{range_start}-{range_end}"
+        digest = hashlib.sha256(name.encode('utf-8')).hexdigest()
+        return os.path.join(self.cache_dir, f"{digest}.blk")
+
+    def open(self, s3_bucket, s3_key, etag, range_start, range_end):
+        """ Return an open file for the range, or None if it's not cached """
+        path = self.getPath(s3_bucket, s3_key, etag, range_start, range_end)
+        try:
+            fh = open(path, 'rb')
+        except FileNotFoundError:
+            return None
+        # update the modification time so the file is evicted last
+        os.utime(path)
+        logging.debug(f"cache hit: {s3_key} {range_start}-{range_end}")
+        return fh
+
+    def writer(self, s3_bucket, s3_key, etag, range_start, range_end):
+        """ Return a CacheWriter for the range """
+        path = self.getPath(s3_bucket, s3_key, etag, range_start, range_end)
+        return CacheWriter(self, path)
+
+    def added(self, num_bytes):
+        """ Account for a new file, and evict if the cache is too large """
+        with self.lock:
+            self.size += num_bytes
+            if self.size > self.max_size:
+                self.evict()
+
+    def evict(self):
+        """ Remove the least recently used files """
+        entries = []
+        for entry in self._entries():
+            try:
+                stat = entry.stat()
+            except FileNotFoundError:
+                # removed by another process
+                continue
+            entries.append((stat.st_mtime, stat.st_size, entry.path))
+        entries.sort()
+        self.size = sum(size for _, size, _ in entries)
+        target = self.max_size * EVICT_RATIO
+        removed = 0
+        for _, size, path in entries:
+            if self.size <= target:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            self.size -= size
+            removed += 1
+        logging.info(f"evicted {removed} files from cache, size: {self.size}")
+
+
+def getCache():
+    """ Return the BlockCache for cache_dir, or None if cache_dir isn't set """
+    global _cache, _cache_pid
+    cache_dir = config.get("cache_dir")
+    if not cache_dir:
+        return None
+    with _cache_lock:
+        if _cache is None or _cache_pid != os.getpid():
+            _cache = BlockCache(cache_dir, config.get("cache_size"))
+            _cache_pid = os.getpid()
+        return _cache
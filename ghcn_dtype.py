@@ -70,3 +70,103 @@ dt_station = np.dtype([('station_id', dt_station_id),
                        ])
 
 
+
+dt_year = np.dtype('i2')
+dt_byte_offset = np.dtype('i8')
+dt_row_count = np.dtype('i8')
+dt_content_length = np.dtype('i8')
+dt_etag = np.dtype('S64')
+dt_last_modified = np.dtype('f8')  # seconds since epoch
+
+# datatype for manifest table - one entry per year CSV file ingested
+dt_manifest = np.dtype([('year', dt_year),
+                        ('byte_offset', dt_byte_offset),
+                        ('row_count', dt_row_count),
+                        ('etag', dt_etag),
+                        ('content_length', dt_content_length),
+                        ('last_modified', dt_last_modified)
+                        ])
+
+dt_start_row = np.dtype('i8')
+dt_run_count = np.dtype('i4')
+dt_first_run = np.dtype('i8')
+dt_num_runs = np.dtype('i8')
+
+# datatype for station index - a run of consecutive data table rows
+# with the same station_id
+dt_station_run = np.dtype([('station_id', dt_station_id),
+                           ('start_row', dt_start_row),
+                           ('count', dt_run_count)
+                           ])
+
+# datatype for station offsets - location of a station's runs in the
+# (station sorted) station index
+dt_station_offset = np.dtype([('station_id', dt_station_id),
+                              ('first_run', dt_first_run),
+                              ('num_runs', dt_num_runs)
+                              ])
+
+dt_end_row = np.dtype('i8')
+
+# datatype for time index - the data table rows from start_row up to
+# (but not including) end_row contain all the rows for a day or year
+dt_row_span = np.dtype([('start_row', dt_start_row),
+                        ('end_row', dt_end_row)
+                        ])
+
+#
+# Compact data types - station_id, ymd, element, the flags and obs_time
+# stored as integers.  Station, element and flag codes are indexes into
+# the station_codes, element_codes and flag_codes tables.
+#
+dt_station_code = np.dtype('u4')
+dt_day_num = np.dtype('i4')  # days since 1750-01-01, or -1 - (index into ymd_codes) if ymd is invalid
+dt_element_code = np.dtype('u1')
+dt_flag_code = np.dtype('u2')
+dt_flags = np.dtype('u4')  # m_flag, q_flag and s_flag bytes as m << 16 | q << 8 | s
+dt_obs_time_num = np.dtype('u2')  # HHMM as an integer, 65535 if not set
+
+# Datatype for compact 'day' table (15 bytes vs 32 bytes for dt_day)
+dt_day_compact = np.dtype([('station', dt_station_code),
+                           ('day', dt_day_num),
+                           ('element', dt_element_code),
+                           ('data_value', dt_data_value),
+                           ('flags', dt_flag_code),
+                           ('obs_time', dt_obs_time_num)
+                           ])
+
+dt_cell = np.dtype('i4')
+dt_station_row = np.dtype('i4')
+
+# datatype for station grid - the stations table row of each station,
+# sorted by the lat/lon grid cell that contains it
+dt_station_cell = np.dtype([('cell', dt_cell),
+                            ('row', dt_station_row)
+                            ])
+
+dt_value_count = np.dtype('i4')
+dt_value_sum = np.dtype('i8')
+
+# datatype for summary tables - count, sum, min and max of data_value
+# for a station and element over a month or year
+dt_summary = np.dtype([('station_id', dt_station_id),
+                       ('element', dt_element),
+                       ('count', dt_value_count),
+                       ('sum', dt_value_sum),
+                       ('min', dt_data_value),
+                       ('max', dt_data_value)
+                       ])
+
+dt_line_start = np.dtype('i8')
+dt_line_count = np.dtype('i4')
+dt_block_hash = np.dtype('S32')  # hex digest
+
+# datatype for block hashes - a block of lines of a year's CSV file, the
+# data table rows they were stored in, and a hash of the lines
+dt_block = np.dtype([('year', dt_year),
+                     ('line_start', dt_line_start),
+                     ('line_count', dt_line_count),
+                     ('start_row', dt_start_row),
+                     ('row_count', dt_run_count),
+                     ('hash', dt_block_hash)
+                     ])
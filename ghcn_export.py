@@ -0,0 +1,382 @@
+#!/usr/bin/env python3
+
+'''
+GHCN_export:
+
+Query the GHCN data table and return the matching rows as NumPy
+batches, Arrow record batches, or a Parquet, Arrow or NumPy file.
+
+Rows can be selected by station, element, date range and q_flag.  The
+station index and time index (see ghcn_index) are used when they exist,
+so only the data table rows that can match are read:
+  stations: the runs of rows for each station
+  dates: the span of rows for the date range
+  both: the station runs, clipped to the date span
+Runs that are close together are read with one request.  With the
+columns layout, only the fields that are returned or filtered on are
+read.  The shards of a sharded file are queried one after another,
+each with its own indexes.
+
+pyarrow is only needed for the Arrow and Parquet output.
+'''
+
+import sys
+import time
+import struct
+import logging
+import numpy as np
+
+from ghcn_dtype import dt_day
+from ghcn_index import StationIndex, getDayRange, hasStationIndex, coalesceRanges
+from ghcn_parse import ymdToDays
+from ghcn_scan import readSlice
+from ghcn_table import getDataTable, getShardGroups, ColumnTable, CompactTable, COMPACT_COLUMNS
+from ghcn_update import h5File
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+    pq = None
+
+BATCH_ROWS = 1048576  # max rows read at a time
+GAP_ROWS = 4096  # runs of rows with smaller gaps between them are read together
+FORMATS = ("npy", "arrow", "parquet")
+
+
+def usage():
+    """ Usage message """
+    print("Export GHCN rows matching the given filters")
+    print("Usage: ghcn_export.py [-h] [--loglevel debug|info|warning|error] [--station <id>[,<id>...]]")
+    print("       [--element <element>[,<element>...]] [--dates <start>:<end>] [--unflagged] [--fields <name>[,<name>...]]")
+    print("       [--format npy|arrow|parquet] [--output <file>] <filepath>")
+    print("   <filepath>: HSDS or hdf5 file path ('hdf5://' prefix for HSDS)")
+    print("Options:")
+    print("   --help: this message")
+    print("   --loglevel debug|info|warning|error: change default log level")
+    print("   --station <id>[,<id>...]: only rows for the given stations")
+    print("   --element <element>[,<element>...]: only rows for the given elements (e.g. TMAX,TMIN)")
+    print("   --dates <start>:<end>: only rows from YYYYMMDD start to end (inclusive)")
+    print("   --unflagged: only rows without a q_flag")
+    print("   --fields <name>[,<name>...]: fields to output (default all)")
+    print("   --format npy|arrow|parquet: output file format (default parquet)")
+    print("   --output <file>: output file (default: print the rows)")
+    sys.exit(1)
+
+
+def _toBytesList(values):
+    """ return values as a list of bytes, or None """
+    if values is None:
+        return None
+    if isinstance(values, (str, bytes)):
+        values = [values]
+    return [v.encode('ascii') if isinstance(v, str) else v for v in values]
+
+
+def _rowBytes(dset, fields):
+    """ Return the number of bytes stored for each row of the given
+    fields """
+    if isinstance(dset, CompactTable):
+        raw = dset.raw
+        if not isinstance(raw, ColumnTable):
+            return raw.dtype.itemsize
+        # the flags share a column
+        return sum(raw.dtype[column].itemsize for column in set(COMPACT_COLUMNS[name] for name in fields))
+    if isinstance(dset, ColumnTable):
+        return sum(dset.dtype[name].itemsize for name in fields)
+    return dset.dtype.itemsize
+
+
+def getReadRanges(f, stations=None, start_ymd=None, end_ymd=None):
+    """ Return a list of (start, end) data table row ranges that include
+    all the rows for stations from start_ymd through end_ymd, using the
+    station and time indexes if they exist """
+    num_rows = getDataTable(f).shape[0]
+    span = (0, num_rows)
+    if start_ymd is not None or end_ymd is not None:
+        if "day_index" in f:
+            span = getDayRange(f, start_ymd or "17500101", end_ymd or "21991231")
+            if span is None:
+                return []
+        else:
+            logging.info("no time index, reading all dates")
+    if stations is None:
+        return [span]
+    if not hasStationIndex(f):
+        logging.info("no station index, reading all stations")
+        return [span]
+    index = StationIndex(f)
+    ranges = []
+    for station_id in stations:
+        runs = index.getRuns(station_id)
+        starts = np.maximum(runs['start_row'], span[0])
+        ends = np.minimum(runs['start_row'] + runs['count'], span[1])
+        ranges.extend(zip(starts.tolist(), ends.tolist()))
+    return ranges
+
+
+def getMask(rows, stations=None, elements=None, start_ymd=None, end_ymd=None, q_flags=None):
+    """ Return a boolean array that is True for the rows matching the filters """
+    mask = np.ones((len(rows),), dtype=bool)
+    if stations is not None:
+        mask &= np.isin(rows['station_id'], np.array(stations, dtype=dt_day['station_id']))
+    if elements is not None:
+        mask &= np.isin(rows['element'], np.array(elements, dtype=dt_day['element']))
+    if start_ymd is not None:
+        mask &= rows['ymd'] >= start_ymd
+    if end_ymd is not None:
+        mask &= rows['ymd'] <= end_ymd
+    if q_flags is not None:
+        mask &= np.isin(rows['q_flag'], np.array(q_flags, dtype=dt_day['q_flag']))
+    return mask
+
+
+def queryRows(f, stations=None, elements=None, start_ymd=None, end_ymd=None, q_flags=None,
+              fields=None, stats=None):
+    """ Generator - return batches of data table rows (NumPy arrays with
+    the given fields, or all fields) that match the filters.
+    stations and elements are lists of values to include, start_ymd and
+    end_ymd are YYYYMMDD dates (inclusive), and q_flags is a list of
+    q_flag values to include (b'' for rows that passed all checks).
+    If stats is a dict, rows_read, bytes_read, rows and elapsed are
+    added to it. """
+    start_time = time.time()
+    stations = _toBytesList(stations)
+    elements = _toBytesList(elements)
+    q_flags = _toBytesList(q_flags)
+    start_ymd = _toBytesList(start_ymd)[0] if start_ymd is not None else None
+    end_ymd = _toBytesList(end_ymd)[0] if end_ymd is not None else None
+    if fields is None:
+        fields = list(dt_day.names)
+    fields = list(fields)
+    for name in fields:
+        if name not in dt_day.names:
+            raise ValueError(f"unknown field: {name}")
+    read_fields = list(fields)
+    for name, values in (("station_id", stations), ("element", elements), ("q_flag", q_flags),
+                         ("ymd", start_ymd or end_ymd)):
+        if values is not None and name not in read_fields:
+            read_fields.append(name)
+    out_dtype = np.dtype([(name, dt_day[name]) for name in fields])
+
+    if stats is None:
+        stats = {}
+    for name in ("rows_read", "bytes_read", "rows"):
+        stats.setdefault(name, 0)
+    stats.setdefault("elapsed", 0.0)
+    # each shard of a sharded file has its own table and indexes
+    for grp in getShardGroups(f):
+        dset = getDataTable(grp)
+        row_bytes = _rowBytes(dset, read_fields)
+        reads = coalesceRanges(getReadRanges(grp, stations=stations, start_ymd=start_ymd, end_ymd=end_ymd),
+                               GAP_ROWS, BATCH_ROWS)
+        logging.info(f"queryRows - {len(reads)} reads for {sum(end - start for start, end in reads)} rows")
+        for start, end in reads:
+            rows = readSlice(dset, start, end, fields=read_fields)
+            stats["rows_read"] += len(rows)
+            stats["bytes_read"] += len(rows) * row_bytes
+            rows = rows[getMask(rows, stations=stations, elements=elements, start_ymd=start_ymd,
+                                end_ymd=end_ymd, q_flags=q_flags)]
+            if len(rows) == 0:
+                continue
+            batch = np.zeros((len(rows),), dtype=out_dtype)
+            for name in fields:
+                batch[name] = rows[name]
+            stats["rows"] += len(batch)
+            stats["elapsed"] = time.time() - start_time
+            yield batch
+    stats["elapsed"] = time.time() - start_time
+
+
+def _requireArrow():
+    if pa is None:
+        raise RuntimeError("pyarrow is required for Arrow and Parquet output")
+
+
+def toRecordBatch(batch):
+    """ Return a NumPy batch from queryRows as an Arrow RecordBatch.
+    Byte string fields are converted to strings. """
+    _requireArrow()
+    arrays = []
+    for name in batch.dtype.names:
+        values = batch[name]
+        if values.dtype.kind == 'S':
+            values = values.astype('U')
+        arrays.append(pa.array(values))
+    return pa.RecordBatch.from_arrays(arrays, names=list(batch.dtype.names))
+
+
+def queryRecordBatches(f, **kwargs):
+    """ Generator - same as queryRows, but returns Arrow RecordBatches """
+    for batch in queryRows(f, **kwargs):
+        yield toRecordBatch(batch)
+
+
+def _npyHeader(dtype, num_rows, size=None):
+    """ Return a .npy (version 1.0) header for a 1-d array of num_rows,
+    padded to size bytes if given, otherwise to a multiple of 64 """
+    header = repr({'descr': np.lib.format.dtype_to_descr(dtype), 'fortran_order': False,
+                   'shape': (num_rows,)})
+    prefix_len = len(np.lib.format.magic(1, 0)) + 2
+    if size is None:
+        size = -(-(prefix_len + len(header) + 1) // 64) * 64
+    header = header.ljust(size - prefix_len - 1) + '\n'
+    return np.lib.format.magic(1, 0) + struct.pack('<H', len(header)) + header.encode('latin1')
+
+
+def writeNpy(output, batches, dtype):
+    """ Write the batches (arrays of dtype) to output as one .npy array.
+    Batches are written as they arrive: the header is written with room
+    for any row count, then updated with the number of rows.  Returns the
+    number of rows. """
+    # a header with the largest row count, so the final header fits
+    size = len(_npyHeader(dtype, np.iinfo(np.int64).max))
+    count = 0
+    with open(output, 'wb') as fh:
+        fh.write(_npyHeader(dtype, 0, size=size))
+        for batch in batches:
+            fh.write(np.ascontiguousarray(batch, dtype=dtype).tobytes())
+            count += len(batch)
+        fh.seek(0)
+        fh.write(_npyHeader(dtype, count, size=size))
+    return count
+
+
+def exportRows(f, output, format="parquet", **kwargs):
+    """ Write the rows returned by queryRows(f, **kwargs) to output in the
+    given format (npy, arrow or parquet).  Returns the number of rows. """
+    if format not in FORMATS:
+        raise ValueError(f"unknown format: {format}")
+    count = 0
+    if format == "npy":
+        fields = kwargs.get("fields") or dt_day.names
+        dtype = np.dtype([(name, dt_day[name]) for name in fields])
+        return writeNpy(output, queryRows(f, **kwargs), dtype)
+
+    _requireArrow()
+    writer = None
+    try:
+        for batch in queryRecordBatches(f, **kwargs):
+            if writer is None:
+                if format == "parquet":
+                    writer = pq.ParquetWriter(output, batch.schema)
+                else:
+                    writer = pa.ipc.new_file(output, batch.schema)
+            writer.write_batch(batch)
+            count += batch.num_rows
+    finally:
+        if writer is not None:
+            writer.close()
+    if writer is None:
+        logging.warning("no rows matched, output not written")
+    return count
+
+
+#
+# Main
+#
+if __name__ == "__main__":
+    if len(sys.argv) < 2 or sys.argv[1] in ("-h", "--help"):
+        usage()
+
+    hdf_filepath = None
+    stations = None
+    elements = None
+    date_range = (None, None)
+    q_flags = None
+    fields = None
+    output_format = "parquet"
+    output = None
+
+    loglevel = logging.INFO
+    argn = 1
+    while argn < len(sys.argv):
+        arg = sys.argv[argn]
+        val = None
+        if len(sys.argv) > argn + 1:
+            val = sys.argv[argn+1]
+        if arg[0] == '-':
+            # process option
+            if arg == "--loglevel":
+                val = val.upper()
+                if val == "DEBUG":
+                    loglevel = logging.DEBUG
+                elif val == "INFO":
+                    loglevel = logging.INFO
+                elif val in ("WARN", "WARNING"):
+                    loglevel = logging.WARNING
+                elif val == "ERROR":
+                    loglevel = logging.ERROR
+                else:
+                    usage()
+                argn += 1
+            elif arg == "--station":
+                if not val:
+                    usage()
+                stations = val.split(',')
+                argn += 1
+            elif arg == "--element":
+                if not val:
+                    usage()
+                elements = val.split(',')
+                argn += 1
+            elif arg == "--dates":
+                if not val or val.count(':') != 1:
+                    usage()
+                date_range = tuple(x or None for x in val.split(':'))
+                dates = [x for x in date_range if x is not None]
+                if not dates or not all(x.isdigit() and len(x) == 8 for x in dates) or \
+                        not np.all(ymdToDays([x.encode('ascii') for x in dates])[1]):
+                    logging.error(f"invalid date range: {val}")
+                    usage()
+                argn += 1
+            elif arg == "--unflagged":
+                q_flags = [b'']
+            elif arg == "--fields":
+                if not val:
+                    usage()
+                fields = val.split(',')
+                argn += 1
+            elif arg == "--format":
+                if val not in FORMATS:
+                    usage()
+                output_format = val
+                argn += 1
+            elif arg == "--output":
+                if not val:
+                    usage()
+                output = val
+                argn += 1
+            else:
+                # unknown option, or --help
+                usage()
+        else:
+            if not hdf_filepath:
+                hdf_filepath = arg
+
+        argn += 1
+
+    if not hdf_filepath:
+        logging.error("HDF filepath not provided")
+        usage()
+    if output and output_format != "npy" and pa is None:
+        logging.error("pyarrow is required for arrow and parquet output")
+        sys.exit(1)
+
+    logging.basicConfig(format='%(asctime)s %(message)s', level=loglevel)
+
+    stats = {}
+    kwargs = {"stations": stations, "elements": elements, "start_ymd": date_range[0],
+              "end_ymd": date_range[1], "q_flags": q_flags, "fields": fields, "stats": stats}
+    with h5File(hdf_filepath, mode='r') as f:
+        if output:
+            exportRows(f, output, format=output_format, **kwargs)
+        else:
+            for batch in queryRows(f, **kwargs):
+                for row in batch:
+                    print(row)
+    elapsed = stats["elapsed"]
+    rate = int(stats["rows"] / elapsed) if elapsed > 0 else 0
+    print(f"{stats['rows']} rows in {elapsed:.3f} s - rows/sec: {rate}, "
+          f"rows read: {stats['rows_read']}, bytes read: {stats['bytes_read']}")
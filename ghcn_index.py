@@ -0,0 +1,566 @@
+#!/usr/bin/env python3
+
+'''
+GHCN_index:
+
+Auxiliary index tables for the GHCN data table.
+
+The station index maps each station_id to the runs of consecutive rows
+in the data table with that station.  It has two parts:
+  station_segments/<n>/runs, offsets: segments of runs sorted by
+      station, with the offset and number of runs for each station
+  station_runs: runs for rows added since the last compaction, in
+      the order they were added
+ghcn_update appends to station_runs as rows are written, and once
+enough have been collected, compaction sorts them into a new segment.
+Segments are size-tiered: when SEGMENT_FANOUT segments have the same
+level, they are merged into one segment of the next level, so each
+run is only rewritten a few times however large the index grows.
+Files compacted before segments were added have a single segment in
+the station_index and station_offsets datasets.
+
+The time index records the span of data table rows that hold each day
+and each year:
+  day_index: one entry per day since DAY_EPOCH
+  year_index: one entry per year since MIN_YEAR
+Rows are only roughly in date order, so a span can include rows for
+other days, but no rows for the day are outside of it.
+'''
+
+import sys
+import time
+import logging
+import numpy as np
+import h5pyd
+import h5py
+
+from ghcn_dtype import dt_station_run, dt_station_offset, dt_row_span
+from ghcn_parse import ymdToDays, DAY_EPOCH, MIN_YEAR
+from ghcn_table import getDataTable, getShardGroups
+
+INDEX_CHUNKS = (65536,)
+OFFSET_CHUNKS = (16384,)
+SPAN_CHUNKS = (4096,)
+COMPACT_RUNS = 1048576  # max number of index runs to merge at a time (23 bytes each)
+SEGMENTS = "station_segments"
+SEGMENT_FANOUT = 4  # number of segments of a level that are merged into one of the next level
+MERGE_RUNS = 1048576  # max number of unmerged runs before compacting in a rebuild
+SCAN_ROWS = 4 * 91268  # number of data rows to read at a time for a rebuild
+READ_GAP_ROWS = 256  # runs of a station closer than this are read together
+READ_BATCH_ROWS = 1048576  # max rows read at a time
+
+
+def usage():
+    """ Usage message """
+    print("Query, rebuild, or compact the GHCN station and time indexes")
+    print("Usage: ghcn_index.py [-h] [--loglevel debug|info|warning|error] [--rebuild] [--compact] [--station <id>] [--dates <start>:<end>] <filepath>")
+    print("   <filepath>: HSDS or hdf5 file path ('hdf5://' prefix for HSDS)")
+    print("Options:")
+    print("   --help: this message")
+    print("   --loglevel debug|info|warning|error: change default log level")
+    print("   --rebuild: recreate the indexes from the data table")
+    print("   --compact: merge recently added rows into the sorted station index")
+    print("   --station <id>: print the rows for the given station")
+    print("   --dates <start>:<end>: print the rows from YYYYMMDD start to end (inclusive)")
+    sys.exit(1)
+
+
+def h5File(path, mode='r'):
+    """ open a HSDS domain or HDF5 file based on the path.
+        if path starts with "hdf5://", use HSDS, otherwise
+        use h5py on a regular file path """
+    if path.startswith("hdf5://"):
+        f = h5pyd.File(path, mode=mode)
+    else:
+        f = h5py.File(path, mode=mode)
+    return f
+
+
+def _toBytes(station_id):
+    """ return station_id as bytes """
+    if isinstance(station_id, str):
+        station_id = station_id.encode('ascii')
+    return station_id
+
+
+def getStationRuns(rows, start_row):
+    """ Return a dt_station_run array with the runs of consecutive rows
+    with the same station_id.  start_row is the position of rows in the
+    data table. """
+    station_ids = rows['station_id']
+    count = len(station_ids)
+    if count == 0:
+        return np.zeros((0,), dtype=dt_station_run)
+    starts = np.flatnonzero(station_ids[1:] != station_ids[:-1]) + 1
+    starts = np.concatenate(([0], starts))
+    runs = np.zeros((len(starts),), dtype=dt_station_run)
+    runs['station_id'] = station_ids[starts]
+    runs['start_row'] = starts + start_row
+    runs['count'] = np.diff(np.append(starts, count))
+    return runs
+
+
+def updateStationIndex(f, rows, start_row):
+    """ Append the station runs for rows (written to the data table at
+    start_row) to the station_runs table """
+    runs = getStationRuns(rows, start_row)
+    if len(runs) == 0:
+        return
+    if "station_runs" not in f:
+        logging.info("Creating dataset: station_runs")
+        f.create_dataset("station_runs", (0,), maxshape=(None,), chunks=INDEX_CHUNKS, dtype=dt_station_run)
+    dset = f["station_runs"]
+    next_run = dset.shape[0]
+    if next_run > 0:
+        # extend the last run if rows continue with the same station
+        last_run = dset[next_run-1]
+        if (last_run['station_id'] == runs[0]['station_id'] and
+                last_run['start_row'] + last_run['count'] == start_row):
+            runs[0]['start_row'] = last_run['start_row']
+            runs[0]['count'] += last_run['count']
+            next_run -= 1
+    dset.resize((next_run+len(runs),))
+    dset[next_run:next_run+len(runs)] = runs
+
+
+def getUnindexedRuns(f):
+    """ Return the number of runs in station_runs """
+    if "station_runs" not in f:
+        return 0
+    return f["station_runs"].shape[0]
+
+
+def getStationSegments(f):
+    """ Return (runs, offsets) datasets for each segment of the station
+    index, oldest first """
+    segments = []
+    if "station_index" in f and "station_offsets" in f:
+        # compacted before segments were added
+        segments.append((f["station_index"], f["station_offsets"]))
+    if SEGMENTS in f:
+        grp = f[SEGMENTS]
+        for name in sorted(grp, key=int):
+            segments.append((grp[name]["runs"], grp[name]["offsets"]))
+    return segments
+
+
+def hasStationIndex(f):
+    """ Return True if f has a station index """
+    return "station_runs" in f or len(getStationSegments(f)) > 0
+
+
+def getIndexedRuns(f):
+    """ Return the number of runs in the station index segments """
+    return sum(runs.shape[0] for runs, _ in getStationSegments(f))
+
+
+def _getOffsets(runs):
+    """ Return the dt_station_offset array for runs sorted by station """
+    station_ids, first, counts = np.unique(runs['station_id'], return_index=True, return_counts=True)
+    offsets = np.zeros((len(station_ids),), dtype=dt_station_offset)
+    offsets['station_id'] = station_ids
+    offsets['first_run'] = first
+    offsets['num_runs'] = counts
+    return offsets
+
+
+def _writeSegment(f, sources, level):
+    """ Merge sources into a new segment with the given level and return
+    its name.  sources is a list of (runs, offsets), where runs is a
+    dataset or array of runs sorted by station and offsets is its
+    dt_station_offset array.  Runs are merged COMPACT_RUNS at a time,
+    so memory use doesn't depend on the size of the sources. """
+    station_ids = np.unique(np.concatenate([offsets['station_id'] for _, offsets in sources]))
+    # number of runs in each source for each station, and where they start
+    source_runs = []
+    source_starts = []
+    for _, offsets in sources:
+        num_runs = np.zeros((len(station_ids),), dtype=np.int64)
+        num_runs[np.searchsorted(station_ids, offsets['station_id'])] = offsets['num_runs']
+        source_runs.append(num_runs)
+        source_starts.append(np.concatenate(([0], np.cumsum(num_runs))))
+    total_runs = np.sum(source_runs, axis=0)
+    # group stations so each group reads about COMPACT_RUNS runs
+    cum_runs = np.cumsum(total_runs)
+    limits = np.arange(1, cum_runs[-1] // COMPACT_RUNS + 1) * COMPACT_RUNS
+    group_ends = np.searchsorted(cum_runs, limits, side='right')
+    group_ends = np.unique(np.append(group_ends[group_ends > 0], len(station_ids)))
+
+    grp = f.require_group(SEGMENTS)
+    name = str(int(grp.attrs.get("next_segment", 0)))
+    grp.attrs["next_segment"] = int(name) + 1
+    seg = grp.create_group(name)
+    seg.attrs["level"] = level
+    index_new = seg.create_dataset("runs", (int(cum_runs[-1]),), maxshape=(None,),
+                                   chunks=INDEX_CHUNKS, dtype=dt_station_run)
+    offsets_new = np.zeros((len(station_ids),), dtype=dt_station_offset)
+    offsets_new['station_id'] = station_ids
+
+    next_run = 0
+    group_start = 0
+    for group_end in group_ends:
+        parts = []
+        for (runs, _), starts in zip(sources, source_starts):
+            start, end = int(starts[group_start]), int(starts[group_end])
+            if end > start:
+                parts.append(runs[start:end])
+        runs = np.concatenate(parts)
+        runs = runs[np.lexsort((runs['start_row'], runs['station_id']))]
+        index_new[next_run:next_run+len(runs)] = runs
+        counts = total_runs[group_start:group_end]
+        offsets_new['first_run'][group_start:group_end] = next_run + np.cumsum(counts) - counts
+        offsets_new['num_runs'][group_start:group_end] = counts
+        next_run += len(runs)
+        group_start = group_end
+    seg.create_dataset("offsets", data=offsets_new, maxshape=(None,), chunks=OFFSET_CHUNKS,
+                       dtype=dt_station_offset)
+    return name
+
+
+def _getLevel(num_runs):
+    """ Return the level for a segment of num_runs that wasn't created by
+    compaction """
+    level = 0
+    while num_runs > MERGE_RUNS * SEGMENT_FANOUT ** (level + 1):
+        level += 1
+    return level
+
+
+def _moveOldIndex(f):
+    """ Move station_index and station_offsets of a file compacted before
+    segments were added into a segment """
+    if "station_index" not in f or "station_offsets" not in f:
+        return
+    grp = f.require_group(SEGMENTS)
+    name = str(int(grp.attrs.get("next_segment", 0)))
+    grp.attrs["next_segment"] = int(name) + 1
+    seg = grp.create_group(name)
+    seg.attrs["level"] = _getLevel(f["station_index"].shape[0])
+    seg["runs"] = f["station_index"]
+    seg["offsets"] = f["station_offsets"]
+    del f["station_index"]
+    del f["station_offsets"]
+    logging.info(f"compactStationIndex - moved station_index to {SEGMENTS}/{name}")
+
+
+def _mergeSegments(f):
+    """ Merge segments while SEGMENT_FANOUT segments have the same level """
+    grp = f[SEGMENTS]
+    while True:
+        levels = {}
+        for name in sorted(grp, key=int):
+            levels.setdefault(int(grp[name].attrs["level"]), []).append(name)
+        full = [level for level, names in levels.items() if len(names) >= SEGMENT_FANOUT]
+        if not full:
+            return
+        level = min(full)
+        names = levels[level][:SEGMENT_FANOUT]
+        sources = [(grp[name]["runs"], grp[name]["offsets"][...]) for name in names]
+        num_runs = sum(runs.shape[0] for runs, _ in sources)
+        logging.info(f"compactStationIndex - merging {len(names)} level {level} segments, {num_runs} runs")
+        _writeSegment(f, sources, level + 1)
+        for name in names:
+            del grp[name]
+
+
+def compactStationIndex(f):
+    """ Sort the runs in station_runs into a new station index segment
+    and clear station_runs, then merge segments of the same level.  The
+    runs are merged COMPACT_RUNS at a time, so memory use depends on the
+    size of station_runs but not on the size of the index. """
+    num_tail = getUnindexedRuns(f)
+    if num_tail == 0:
+        logging.info("compactStationIndex - no runs to merge")
+        return 0
+    logging.info(f"compactStationIndex - merging {num_tail} runs")
+    tail = f["station_runs"][...]
+    # sort by station, then row
+    tail = tail[np.lexsort((tail['start_row'], tail['station_id']))]
+    _moveOldIndex(f)
+    _writeSegment(f, [(tail, _getOffsets(tail))], 0)
+    f["station_runs"].resize((0,))
+    _mergeSegments(f)
+    logging.info(f"compactStationIndex - {getIndexedRuns(f)} runs in {len(f[SEGMENTS])} segments")
+    return num_tail
+
+
+def _updateSpans(dset, index, row_nums):
+    """ Extend the row spans in dset for the given index values.  index
+    and row_nums are arrays of the same length. """
+    if len(index) == 0:
+        return
+    first = index.min()
+    count = index.max() - first + 1
+    index = index - first
+    start_rows = np.full((count,), np.iinfo(np.int64).max, dtype=np.int64)
+    np.minimum.at(start_rows, index, row_nums)
+    end_rows = np.zeros((count,), dtype=np.int64)
+    np.maximum.at(end_rows, index, row_nums + 1)
+
+    if dset.shape[0] < first + count:
+        dset.resize((first + count,))
+    spans = dset[first:first+count]
+    found = end_rows > 0
+    merge = found & (spans['end_row'] > spans['start_row'])
+    start_rows[merge] = np.minimum(spans['start_row'][merge], start_rows[merge])
+    spans['start_row'][found] = start_rows[found]
+    spans['end_row'] = np.maximum(spans['end_row'], end_rows)
+    dset[first:first+count] = spans
+
+
+def updateTimeIndex(f, rows, start_row):
+    """ Update the day and year spans for rows (written to the data table
+    at start_row) """
+    days, valid = ymdToDays(rows['ymd'])
+    if not np.all(valid):
+        logging.warning(f"updateTimeIndex - {len(valid) - np.count_nonzero(valid)} rows with invalid ymd")
+    days = days[valid]
+    row_nums = np.arange(start_row, start_row + len(rows), dtype=np.int64)[valid]
+    if len(days) == 0:
+        return
+    for name in ("day_index", "year_index"):
+        if name not in f:
+            logging.info(f"Creating dataset: {name}")
+            f.create_dataset(name, (0,), maxshape=(None,), chunks=SPAN_CHUNKS, dtype=dt_row_span)
+    _updateSpans(f["day_index"], days, row_nums)
+    years = (DAY_EPOCH + days).astype('datetime64[Y]').astype(np.int64) + 1970
+    _updateSpans(f["year_index"], years - MIN_YEAR, row_nums)
+
+
+def getDayRange(f, start_ymd, end_ymd):
+    """ Return (start_row, end_row) of the data table rows that include all
+    rows from start_ymd through end_ymd, or None if there are none. """
+    days, valid = ymdToDays([_toBytes(start_ymd), _toBytes(end_ymd)])
+    if not np.all(valid):
+        raise ValueError(f"invalid date range: {start_ymd}:{end_ymd}")
+    if "day_index" not in f:
+        return None
+    dset = f["day_index"]
+    first = days[0]
+    last = min(days[1], dset.shape[0] - 1)
+    if first > last:
+        return None
+    spans = dset[first:last+1]
+    spans = spans[spans['end_row'] > spans['start_row']]
+    if len(spans) == 0:
+        return None
+    return int(spans['start_row'].min()), int(spans['end_row'].max())
+
+
+def getYearRange(f, year):
+    """ Return (start_row, end_row) of the data table rows that include all
+    rows for the given year, or None if there are none. """
+    if "year_index" not in f:
+        return None
+    dset = f["year_index"]
+    index = year - MIN_YEAR
+    if index < 0 or index >= dset.shape[0]:
+        return None
+    span = dset[index]
+    if span['end_row'] <= span['start_row']:
+        return None
+    return int(span['start_row']), int(span['end_row'])
+
+
+def getLastYear(f):
+    """ Return the most recent year in the year index, or None """
+    if "year_index" not in f:
+        return None
+    spans = f["year_index"][...]
+    years = np.flatnonzero(spans['end_row'] > spans['start_row'])
+    if len(years) == 0:
+        return None
+    return int(years[-1]) + MIN_YEAR
+
+
+def getDateRows(f, start_ymd, end_ymd):
+    """ Return the data table rows from start_ymd through end_ymd """
+    dset = getDataTable(f)
+    row_range = getDayRange(f, start_ymd, end_ymd)
+    if row_range is None:
+        return np.zeros((0,), dtype=dset.dtype)
+    rows = dset[row_range[0]:row_range[1]]
+    ymd = rows['ymd']
+    return rows[(ymd >= _toBytes(start_ymd)) & (ymd <= _toBytes(end_ymd))]
+
+
+def rebuildIndexes(f, station_index=True, time_index=True):
+    """ Recreate the station and/or time indexes by reading the data table """
+    names = []
+    if station_index:
+        names.extend(("station_index", "station_offsets", SEGMENTS, "station_runs"))
+    if time_index:
+        names.extend(("day_index", "year_index"))
+    for name in names:
+        if name in f:
+            del f[name]
+    dset = getDataTable(f)
+    num_rows = dset.shape[0]
+    logging.info(f"rebuildIndexes - {num_rows} rows")
+    start_row = 0
+    while start_row < num_rows:
+        end_row = min(start_row + SCAN_ROWS, num_rows)
+        rows = dset[start_row:end_row]
+        if station_index:
+            updateStationIndex(f, rows, start_row)
+            if getUnindexedRuns(f) > MERGE_RUNS:
+                compactStationIndex(f)
+        if time_index:
+            updateTimeIndex(f, rows, start_row)
+        start_row = end_row
+    if station_index:
+        compactStationIndex(f)
+
+
+def coalesceRanges(ranges, gap_rows, batch_rows):
+    """ Return a list of (start, end) row ranges that cover ranges, with
+    ranges less than gap_rows apart merged, and none longer than
+    batch_rows """
+    merged = []
+    for start, end in sorted(ranges):
+        if end <= start:
+            continue
+        if merged and start - merged[-1][1] < gap_rows and end - merged[-1][0] <= batch_rows:
+            merged[-1][1] = max(merged[-1][1], end)
+        else:
+            merged.append([start, end])
+    reads = []
+    for start, end in merged:
+        while start < end:
+            reads.append((start, min(start + batch_rows, end)))
+            start += batch_rows
+    return reads
+
+
+class StationIndex:
+    """ Look up the rows for a station using the station index.  The
+    station offsets of each segment and the unmerged runs are read
+    once, so repeated lookups take one read per segment plus the data
+    reads. """
+
+    def __init__(self, f):
+        self.f = f
+        self.segments = [(runs, offsets[...]) for runs, offsets in getStationSegments(f)]
+        if "station_runs" in f:
+            self.tail = f["station_runs"][...]
+        else:
+            self.tail = np.zeros((0,), dtype=dt_station_run)
+
+    def getRuns(self, station_id):
+        """ Return the runs (dt_station_run array) for station_id in row order """
+        station_id = _toBytes(station_id)
+        parts = []
+        for runs, offsets in self.segments:
+            index = np.searchsorted(offsets['station_id'], station_id)
+            if index < len(offsets) and offsets[index]['station_id'] == station_id:
+                first_run = offsets[index]['first_run']
+                num_runs = offsets[index]['num_runs']
+                parts.append(runs[first_run:first_run+num_runs])
+        parts.append(self.tail[self.tail['station_id'] == station_id])
+        runs = np.concatenate(parts)
+        return runs[np.argsort(runs['start_row'], kind='stable')]
+
+    def getRows(self, station_id):
+        """ Return the data table rows for station_id.  Only the rows of
+        the station's runs are read, with runs less than READ_GAP_ROWS
+        apart read together. """
+        station_id = _toBytes(station_id)
+        dset = getDataTable(self.f)
+        runs = self.getRuns(station_id)
+        ranges = zip(runs['start_row'].tolist(), (runs['start_row'] + runs['count']).tolist())
+        parts = []
+        for start, end in coalesceRanges(ranges, READ_GAP_ROWS, READ_BATCH_ROWS):
+            rows = dset[start:end]
+            parts.append(rows[rows['station_id'] == station_id])
+        if not parts:
+            return np.zeros((0,), dtype=dset.dtype)
+        return np.concatenate(parts)
+
+
+#
+# Main
+#
+if __name__ == "__main__":
+    if len(sys.argv) < 2 or sys.argv[1] in ("-h", "--help"):
+        usage()
+
+    hdf_filepath = None
+    station_id = None
+    date_range = None
+    rebuild = False
+    compact = False
+
+    loglevel = logging.INFO
+    argn = 1
+    while argn < len(sys.argv):
+        arg = sys.argv[argn]
+        val = None
+        if len(sys.argv) > argn + 1:
+            val = sys.argv[argn+1]
+        if arg[0] == '-':
+            # process option
+            if arg == "--loglevel":
+                val = val.upper()
+                if val == "DEBUG":
+                    loglevel = logging.DEBUG
+                elif val == "INFO":
+                    loglevel = logging.INFO
+                elif val in ("WARN", "WARNING"):
+                    loglevel = logging.WARNING
+                elif val == "ERROR":
+                    loglevel = logging.ERROR
+                else:
+                    usage()
+                argn += 1
+            elif arg == "--station":
+                if not val:
+                    usage()
+                station_id = val
+                argn += 1
+            elif arg == "--dates":
+                if not val or val.count(':') != 1:
+                    usage()
+                date_range = val.split(':')
+                argn += 1
+            elif arg == "--rebuild":
+                rebuild = True
+            elif arg == "--compact":
+                compact = True
+            else:
+                # unknown option, or --help
+                usage()
+        else:
+            if not hdf_filepath:
+                hdf_filepath = arg
+
+        argn += 1
+
+    if not hdf_filepath:
+        logging.error("HDF filepath not provided")
+        usage()
+
+    logging.basicConfig(format='%(asctime)s %(message)s', level=loglevel)
+
+    mode = 'a' if rebuild or compact else 'r'
+    with h5File(hdf_filepath, mode=mode) as f:
+        # each shard of a sharded file has its own indexes
+        shards = getShardGroups(f)
+        for grp in shards:
+            if rebuild:
+                rebuildIndexes(grp)
+            elif compact:
+                compactStationIndex(grp)
+        if station_id:
+            start_time = time.time()
+            rows = np.concatenate([StationIndex(grp).getRows(station_id) for grp in shards])
+            elapsed = time.time() - start_time
+            for row in rows:
+                print(row)
+            print(f"{len(rows)} rows for {station_id} in {elapsed:.3f} s")
+        if date_range:
+            start_time = time.time()
+            rows = np.concatenate([getDateRows(grp, date_range[0], date_range[1]) for grp in shards])
+            elapsed = time.time() - start_time
+            for row in rows:
+                print(row)
+            print(f"{len(rows)} rows for {date_range[0]}-{date_range[1]} in {elapsed:.3f} s")
@@ -0,0 +1,136 @@
+'''
+GHCN_metrics:
+
+Counters and per-stage timers for the collector.  Metrics can be served
+in the Prometheus text format from an HTTP /metrics endpoint, and
+summarized in a log line.
+'''
+
+import logging
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+PREFIX = "ghcn"
+
+_lock = threading.Lock()
+_counters = {}  # name -> value
+_timers = {}  # stage name -> [calls, seconds]
+
+
+def inc(name, value=1):
+    """ add value to the named counter """
+    with _lock:
+        _counters[name] = _counters.get(name, 0) + value
+
+
+def addTime(stage, seconds, calls=1):
+    """ add seconds to the time for the named stage """
+    with _lock:
+        timer = _timers.setdefault(stage, [0, 0.0])
+        timer[0] += calls
+        timer[1] += seconds
+
+
+@contextmanager
+def timer(stage):
+    """ context manager that adds the time of its block to stage """
+    start_time = time.perf_counter()
+    try:
+        yield
+    finally:
+        addTime(stage, time.perf_counter() - start_time)
+
+
+def getMetrics():
+    """ Return a copy of the counters and timers """
+    with _lock:
+        timers = {stage: list(values) for stage, values in _timers.items()}
+        return {"counters": dict(_counters), "timers": timers}
+
+
+def mergeMetrics(metrics):
+    """ add counters and timers from getMetrics (e.g. from another process) """
+    for name, value in metrics["counters"].items():
+        inc(name, value)
+    for stage, (calls, seconds) in metrics["timers"].items():
+        addTime(stage, seconds, calls=calls)
+
+
+def resetMetrics():
+    """ set all counters and timers to zero """
+    with _lock:
+        _counters.clear()
+        _timers.clear()
+
+
+def formatMetrics():
+    """ Return the metrics in the Prometheus text format """
+    metrics = getMetrics()
+    lines = []
+    for name in sorted(metrics["counters"]):
+        metric = f"{PREFIX}_{name}_total"
+        lines.append(f"# TYPE {metric} counter")
+        lines.append(f"{metric} {metrics['counters'][name]}")
+    timers = metrics["timers"]
+    if timers:
+        lines.append(f"# HELP {PREFIX}_stage_seconds_total Time spent in each ingest stage")
+        lines.append(f"# TYPE {PREFIX}_stage_seconds_total counter")
+        for stage in sorted(timers):
+            lines.append(f'{PREFIX}_stage_seconds_total{{stage="{stage}"}} {timers[stage][1]:.6f}')
+        lines.append(f"# TYPE {PREFIX}_stage_calls_total counter")
+        for stage in sorted(timers):
+            lines.append(f'{PREFIX}_stage_calls_total{{stage="{stage}"}} {timers[stage][0]}')
+    return "\n".join(lines) + "\n"
+
+
+def getSummary():
+    """ Return the metrics as a one line summary """
+    metrics = getMetrics()
+    items = [f"{name}={value}" for name, value in sorted(metrics["counters"].items())]
+    for stage, (calls, seconds) in sorted(metrics["timers"].items()):
+        items.append(f"{stage}={seconds:.2f}s/{calls}")
+    return " ".join(items)
+
+
+def logSummary():
+    logging.info(f"metrics: {getSummary()}")
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    """ Serves formatMetrics at /metrics """
+
+    def do_GET(self):
+        if self.path.split('?')[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = formatMetrics().encode('utf-8')
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logging.debug(f"metrics request: {format % args}")
+
+
+def startServer(port):
+    """ Serve the /metrics endpoint on port from a daemon thread """
+    server = ThreadingHTTPServer(("", port), MetricsHandler)
+    thread = threading.Thread(target=server.serve_forever, name="metrics", daemon=True)
+    thread.start()
+    logging.info(f"serving metrics on port {port}")
+    return server
+
+
+def startSummaryLog(interval):
+    """ Log the metrics summary every interval seconds from a daemon thread """
+    def logLoop():
+        while True:
+            time.sleep(interval)
+            logSummary()
+    thread = threading.Thread(target=logLoop, name="metrics-log", daemon=True)
+    thread.start()
+    return thread
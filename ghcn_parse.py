@@ -0,0 +1,441 @@
+'''
+GHCN_parse:
+
+Convert blocks of GHCN CSV text into arrays of the HDF table types.
+'''
+
+import logging
+import numpy as np
+
+from ghcn_dtype import dt_day, dt_station
+import ghcn_metrics as metrics
+
+MIN_SHORT = -32768
+MAX_SHORT = 32767
+BAD_VALUE = -999  # value stored when data_value can't be parsed
+
+NUM_FIELDS = 8  # station_id,ymd,element,data_value,m_flag,q_flag,s_flag,obs_time
+MAX_VALUE_CHARS = 11  # data_value fields longer than this are out of range
+
+DAY_EPOCH = np.datetime64('1750-01-01', 'D')  # day 0 for date indexes
+MIN_YEAR = 1750
+MAX_YEAR = 2199
+OBS_TIME_NONE = 65535  # compact obs_time value when not set
+
+STATION_LINE_CHARS = 85  # width of a ghcnd-stations.txt line
+# (field, first column, last column + 1) in ghcnd-stations.txt lines
+STATION_COLUMNS = (("station_id", 0, 11),
+                   ("lat", 11, 20),
+                   ("lon", 21, 30),
+                   ("elev", 31, 37),
+                   ("state", 38, 40),
+                   ("name", 41, 71),
+                   ("gsn_flag", 72, 75),
+                   ("hcn_flag", 76, 79),
+                   ("wmo_id", 80, 85))
+STATION_FLOATS = ("lat", "lon", "elev")
+
+COMMA = ord(',')
+NEWLINE = ord('\n')
+CR = ord('\r')
+MINUS = ord('-')
+PLUS = ord('+')
+PERIOD = ord('.')
+ZERO = ord('0')
+
+
+def _lineBounds(buf):
+    """ return start and end offsets of each non-empty line in buf.
+        buf is a uint8 array.  The end offset excludes the newline
+        (and any carriage return). """
+    newlines = np.flatnonzero(buf == NEWLINE)
+    ends = newlines
+    if len(buf) > 0 and buf[-1] != NEWLINE:
+        # last line is not newline terminated
+        ends = np.append(ends, len(buf))
+    starts = np.zeros((len(ends),), dtype=ends.dtype)
+    starts[1:] = ends[:-1] + 1
+    # don't include carriage return in the line
+    has_cr = ends > starts
+    has_cr[has_cr] = buf[ends[has_cr] - 1] == CR
+    ends = ends - has_cr
+    # skip empty lines
+    non_empty = ends > starts
+    return starts[non_empty], ends[non_empty]
+
+
+def _getChars(buf, starts, lengths, width):
+    """ return a (count, width) uint8 array of the chars at the given start
+        offsets, with chars past the end of each field set to zero.
+        buf must be padded with at least width bytes at the end. """
+    cols = np.arange(width)
+    chars = np.take(buf, starts[:, None] + cols)
+    chars *= cols < lengths[:, None]
+    return chars
+
+
+def _getField(buf, starts, lengths, width):
+    """ return fixed-width byte strings of up to width chars taken from buf at
+        the given start offsets.  Longer fields are truncated. """
+    chars = _getChars(buf, starts, lengths, width)
+    return chars.view(f"S{width}").reshape((len(starts),))
+
+
+def _getValues(buf, starts, lengths):
+    """ convert data_value fields to integers.  Fields that are empty,
+        non-numeric, or outside the range of a short are set to BAD_VALUE.
+        Fields that aren't just an optional sign and up to MAX_VALUE_CHARS
+        digits are converted with int() (so e.g. " 12" and "1_2" are read
+        as in parseRowsLoop).  Returns the values and the number of bad
+        values. """
+    count = len(starts)
+    width = MAX_VALUE_CHARS
+    chars = _getChars(buf, starts, lengths, width)
+
+    negative = chars[:, 0] == MINUS
+    signed = negative | (chars[:, 0] == PLUS)
+    # digits are the chars following any sign char
+    digit_mask = np.arange(width) < lengths[:, None]
+    digit_mask[:, 0] &= ~signed
+    digits = chars.astype(np.int32) - ZERO
+    is_digit = (digits >= 0) & (digits <= 9)
+
+    valid = lengths <= width
+    valid &= np.all(is_digit | ~digit_mask, axis=1)
+    valid &= np.any(digit_mask, axis=1)
+
+    values = np.zeros((count,), dtype=np.int64)
+    for col in range(width):
+        use = digit_mask[:, col]
+        values = np.where(use, values * 10 + digits[:, col], values)
+    values[negative] *= -1
+
+    # the few fields the vector conversion rejects are converted one at a time
+    for i in np.flatnonzero(~valid):
+        field = bytes(buf[starts[i]:starts[i] + lengths[i]])
+        try:
+            values[i] = int(field.decode('utf-8', errors='replace'))
+        except (ValueError, OverflowError):
+            continue
+        valid[i] = MIN_SHORT <= values[i] <= MAX_SHORT
+
+    valid &= (values >= MIN_SHORT) & (values <= MAX_SHORT)
+    values[~valid] = BAD_VALUE
+    return values, count - np.count_nonzero(valid)
+
+
+def parseRows(text):
+    """ Parse a block of GHCN CSV text into a dt_day array.
+
+    text is a bytes-like object of newline separated rows, e.g.:
+      b'ASN00008050,18770101,PRCP,0,,,a,\\n'
+    Rows that don't have 8 fields are skipped.  Fields longer than
+    their column width are truncated, and data values that can't be
+    stored as a short are set to -999 (same as parseRowsLoop).
+    """
+    buf = np.frombuffer(text, dtype=np.uint8)
+    starts, ends = _lineBounds(buf)
+
+    # each well-formed row has exactly 7 commas
+    commas = np.flatnonzero(buf == COMMA)
+    first_comma = np.searchsorted(commas, starts)
+    num_commas = np.searchsorted(commas, ends) - first_comma
+    valid = num_commas == NUM_FIELDS - 1
+    skipped = len(starts) - np.count_nonzero(valid)
+    if skipped:
+        logging.warning(f"Expected {NUM_FIELDS} fields, skipping {skipped} rows")
+        metrics.inc("rows_rejected", skipped)
+    starts = starts[valid]
+    ends = ends[valid]
+    first_comma = first_comma[valid]
+
+    count = len(starts)
+    arr = np.zeros((count,), dtype=dt_day)
+    if count == 0:
+        return arr
+
+    # pad so that fixed-width reads past the last field stay in bounds
+    buf = np.concatenate((buf, np.zeros((MAX_VALUE_CHARS,), dtype=np.uint8)))
+    comma_pos = commas[first_comma[:, None] + np.arange(NUM_FIELDS - 1)]
+    field_starts = np.empty((count, NUM_FIELDS), dtype=starts.dtype)
+    field_starts[:, 0] = starts
+    field_starts[:, 1:] = comma_pos + 1
+    field_ends = np.empty((count, NUM_FIELDS), dtype=ends.dtype)
+    field_ends[:, :-1] = comma_pos
+    field_ends[:, -1] = ends
+    field_lengths = field_ends - field_starts
+
+    for i, name in enumerate(dt_day.names):
+        starts = field_starts[:, i]
+        lengths = field_lengths[:, i]
+        if name == 'data_value':
+            values, bad_count = _getValues(buf, starts, lengths)
+            if bad_count:
+                logging.warning(f"Unable to convert {bad_count} data_values to short")
+                metrics.inc("values_rejected", bad_count)
+            arr[name] = values
+            continue
+        width = dt_day[name].itemsize
+        if name in ('station_id', 'ymd', 'element'):
+            bad_count = np.count_nonzero(lengths != width)
+        else:
+            bad_count = np.count_nonzero(lengths > width)
+        if bad_count:
+            logging.warning(f"Unexpected length for {name} in {bad_count} rows")
+        arr[name] = _getField(buf, starts, lengths, width)
+
+    return arr
+
+
+def parseRowsLoop(rows):
+    """ Parse a list of GHCN CSV row strings into a dt_day array one row
+        at a time.  This is the original implementation, kept as a
+        reference for parseRows. """
+    count = len(rows)
+    arr = np.zeros((count,), dtype=dt_day)
+    for i in range(count):
+        row = rows[i]
+        fields = row.split(',')
+        if len(fields) != 8:
+            logging.warning(f"Expected 8 fields, skipping row:{i}")
+            continue
+        e = arr[i]
+        station_id = fields[0]
+        if len(station_id) != 11:
+            logging.warning(f"Unexpected length for station: {station_id}")
+        e['station_id'] = station_id
+        ymd = fields[1]
+        if len(ymd) != 8:
+            logging.warning(f"Unexpected length for ymd: {ymd}")
+        e['ymd'] = ymd
+        element = fields[2]
+        if len(element) != 4:
+            logging.warning(f"Unexpected length for elemenbt: {element}")
+        e['element'] = element
+        try:
+            data_value = int(fields[3])
+        except ValueError:
+            logging.warning(f"Unable to convert data_value to int: {fields[3]}")
+            data_value = BAD_VALUE
+        if data_value < MIN_SHORT:
+            logging.warning(f"Data value less than MIN_SHORT: {data_value}")
+            data_value = BAD_VALUE
+        if data_value > MAX_SHORT:
+            logging.warning(f"Data value greater than MAX_SHORT: {data_value}")
+            data_value = BAD_VALUE
+        e['data_value'] = data_value
+        m_flag = fields[4]
+        if len(m_flag) > 1:
+            logging.warning(f"Unexpected length of m_flag: {m_flag}")
+            m_flag = m_flag[0]
+        e['m_flag'] = m_flag
+        q_flag = fields[5]
+        if len(q_flag) > 1:
+            logging.warning(f"Unexpected length of q_flag: {q_flag}")
+            q_flag = q_flag[0]
+        e['q_flag'] = q_flag
+        s_flag = fields[6]
+        if len(s_flag) > 1:
+            logging.warning(f"Unexpected length of s_flag: {s_flag}")
+            s_flag = s_flag[0]
+        e['s_flag'] = s_flag
+        obs_time = fields[7]
+        if len(obs_time) > 4:
+            logging.warning(f"Unexpected length of obs_time: {obs_time}")
+            obs_time = obs_time[:4]
+        e['obs_time'] = obs_time
+        arr[i] = e
+    return arr
+
+
+def _toFloat(values):
+    """ convert an array of byte strings to floats.  Returns the values
+        and a boolean array that is False where conversion failed. """
+    count = len(values)
+    chars = np.frombuffer(values.tobytes(), dtype=np.uint8).reshape((count, values.itemsize))
+    digits = chars.astype(np.int32) - ZERO
+    is_numeric = (digits >= 0) & (digits <= 9)
+    is_numeric |= (chars == MINUS) | (chars == PLUS) | (chars == PERIOD) | (chars == 0)
+    valid = np.all(is_numeric, axis=1) & (chars[:, 0] != 0)
+    floats = np.zeros((count,), dtype=np.float64)
+    try:
+        floats[valid] = values[valid].astype(np.float64)
+    except ValueError:
+        # find the values that can't be converted (e.g. "1.2.3")
+        for i in np.flatnonzero(valid):
+            try:
+                floats[i] = float(values[i])
+            except ValueError:
+                valid[i] = False
+    return floats, valid
+
+
+def _parseStationLine(line):
+    """ return a dt_station row for a line of ghcnd-stations.txt text, or
+        None if it isn't valid.  Used for lines with non-ascii names,
+        where the columns are character rather than byte offsets. """
+    e = np.zeros((), dtype=dt_station)
+    for name, start, end in STATION_COLUMNS:
+        value = line[start:end].strip()
+        if name == "station_id" and len(value) != dt_station[name].itemsize:
+            return None
+        if name in STATION_FLOATS:
+            try:
+                value = float(value)
+            except ValueError:
+                return None
+        elif name == "name":
+            value = value.encode('utf-8')
+        else:
+            try:
+                value = value.encode('ascii')
+            except UnicodeEncodeError:
+                return None
+        e[name] = value
+    return e
+
+
+def parseStations(text):
+    """ Parse the fixed-width lines of ghcnd-stations.txt into a dt_station
+    array, e.g.:
+      b'ACW00011604  17.1167  -61.7833   10.1    ST JOHNS COOLIDGE FLD'
+    Lines without an 11 character station_id, or where lat, lon or elev
+    aren't numbers, are skipped.  Names that aren't ascii are stored as
+    utf-8, truncated to 30 bytes.
+    """
+    buf = np.frombuffer(text, dtype=np.uint8)
+    starts, ends = _lineBounds(buf)
+    count = len(starts)
+    arr = np.zeros((count,), dtype=dt_station)
+    if count == 0:
+        return arr
+
+    width = STATION_LINE_CHARS
+    buf = np.concatenate((buf, np.zeros((width,), dtype=np.uint8)))
+    chars = _getChars(buf, starts, np.minimum(ends - starts, width), width)
+    valid = np.ones((count,), dtype=bool)
+    for name, start, end in STATION_COLUMNS:
+        field = np.ascontiguousarray(chars[:, start:end])
+        field = np.char.strip(field.view(f"S{end-start}").reshape((count,)))
+        if name == "station_id":
+            ok = np.char.str_len(field) == dt_station[name].itemsize
+            if not np.all(ok):
+                logging.warning(f"unexpected station_id, skipping {count - np.count_nonzero(ok)} stations")
+            valid &= ok
+            arr[name] = field
+        elif name in STATION_FLOATS:
+            values, ok = _toFloat(field)
+            if not np.all(ok):
+                logging.warning(f"Unable to convert {name} to float, skipping {count - np.count_nonzero(ok)} stations")
+            valid &= ok
+            arr[name] = values
+        else:
+            arr[name] = field
+
+    # columns are character positions, so re-parse lines with utf-8 text
+    for i in np.flatnonzero(np.any(chars >= 0x80, axis=1)):
+        line = bytes(buf[starts[i]:ends[i]]).decode('utf-8', errors='replace')
+        e = _parseStationLine(line)
+        if e is None:
+            logging.warning(f"can't parse station: {line}")
+            valid[i] = False
+        else:
+            arr[i] = e
+            valid[i] = True
+    return arr[valid]
+
+
+def countRows(text):
+    """ return the number of lines in text.  A final line without a
+        trailing newline is counted. """
+    num_rows = text.count(b'\n')
+    if len(text) > 0 and text[-1:] != b'\n':
+        num_rows += 1
+    return num_rows
+
+
+def skipRows(text, num_rows):
+    """ return text following the first num_rows lines """
+    if num_rows <= 0:
+        return text
+    buf = np.frombuffer(text, dtype=np.uint8)
+    newlines = np.flatnonzero(buf == NEWLINE)
+    if num_rows > len(newlines):
+        return text[len(text):]
+    return text[newlines[num_rows - 1] + 1:]
+
+
+def lineEnd(text, num_rows):
+    """ return the offset following the first num_rows lines of text, or
+        None if text has fewer than num_rows complete lines """
+    if num_rows <= 0:
+        return 0
+    buf = np.frombuffer(text, dtype=np.uint8)
+    newlines = np.flatnonzero(buf == NEWLINE)
+    if num_rows > len(newlines):
+        return None
+    return int(newlines[num_rows - 1]) + 1
+
+
+def ymdToDays(ymd):
+    """ Convert an array of YYYYMMDD byte strings to the number of days
+        since DAY_EPOCH.  Returns the days and a boolean array that is
+        False for values that aren't valid dates (days is 0 for these). """
+    ymd = np.asarray(ymd, dtype='S8')
+    chars = np.frombuffer(ymd.tobytes(), dtype=np.uint8).reshape((len(ymd), 8))
+    digits = chars.astype(np.int32) - ZERO
+    valid = np.all((digits >= 0) & (digits <= 9), axis=1)
+    digits[~valid] = 0
+    year = digits[:, 0] * 1000 + digits[:, 1] * 100 + digits[:, 2] * 10 + digits[:, 3]
+    month = digits[:, 4] * 10 + digits[:, 5]
+    day = digits[:, 6] * 10 + digits[:, 7]
+    valid &= (year >= MIN_YEAR) & (year <= MAX_YEAR)
+    valid &= (month >= 1) & (month <= 12) & (day >= 1) & (day <= 31)
+    year[~valid] = 1970
+    month[~valid] = 1
+    day[~valid] = 1
+
+    months = (year - 1970).astype('datetime64[Y]').astype('datetime64[M]') + (month - 1)
+    dates = months.astype('datetime64[D]') + (day - 1)
+    # days past the end of the month (e.g. Feb 30) roll over to the next month
+    valid &= dates.astype('datetime64[M]') == months
+    days = (dates - DAY_EPOCH).astype(np.int64)
+    days[~valid] = 0
+    return days, valid
+
+
+def daysToYmd(days):
+    """ Convert an array of days since DAY_EPOCH to YYYYMMDD byte strings.
+        Negative values are returned as empty strings. """
+    days = np.asarray(days, dtype=np.int64)
+    count = len(days)
+    dates = (DAY_EPOCH + np.maximum(days, 0)).astype('S10')  # b'YYYY-MM-DD'
+    chars = np.frombuffer(dates.tobytes(), dtype=np.uint8).reshape((count, 10))
+    chars = chars[:, [0, 1, 2, 3, 5, 6, 8, 9]].copy()
+    chars[days < 0] = 0
+    return chars.view('S8').reshape((count,))
+
+
+def obsTimeToNum(obs_time):
+    """ Convert an array of HHMM byte strings to integers.  Values that
+        aren't 4 digits are returned as OBS_TIME_NONE. """
+    obs_time = np.asarray(obs_time, dtype='S4')
+    chars = np.frombuffer(obs_time.tobytes(), dtype=np.uint8).reshape((len(obs_time), 4))
+    digits = chars.astype(np.int32) - ZERO
+    valid = np.all((digits >= 0) & (digits <= 9), axis=1)
+    nums = digits[:, 0] * 1000 + digits[:, 1] * 100 + digits[:, 2] * 10 + digits[:, 3]
+    nums[~valid] = OBS_TIME_NONE
+    return nums.astype(np.uint16)
+
+
+def numToObsTime(nums):
+    """ Convert an array of integer HHMM values to byte strings """
+    nums = np.asarray(nums, dtype=np.int32)
+    count = len(nums)
+    chars = np.zeros((count, 4), dtype=np.uint8)
+    value = nums.copy()
+    for col in (3, 2, 1, 0):
+        chars[:, col] = value % 10 + ZERO
+        value //= 10
+    chars[nums == OBS_TIME_NONE] = 0
+    return chars.view('S4').reshape((count,))
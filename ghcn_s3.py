@@ -0,0 +1,209 @@
+'''
+GHCN_s3:
+
+Helpers for reading GHCN objects from S3.
+'''
+
+import logging
+import os
+import queue
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import boto3
+from botocore import UNSIGNED
+from botocore.config import Config
+from botocore.exceptions import ClientError
+import config
+import ghcn_metrics as metrics
+
+_s3_client = None
+_s3_client_pid = None
+_s3_client_lock = threading.Lock()
+
+QUEUE_POLL_SECONDS = 0.1  # how often a blocked block reader checks if the read was stopped
+
+
+def getClient():
+    """ Return the S3 client shared by all requests, creating it on
+        first use.  The GHCN bucket is public, so requests are not
+        signed.  Set s3_endpoint to use another S3 service (e.g. a
+        local S3 server for testing). """
+    global _s3_client, _s3_client_pid
+    with _s3_client_lock:
+        # a client can't be shared with a forked process
+        if _s3_client is None or _s3_client_pid != os.getpid():
+            client_config = Config(
+                signature_version=UNSIGNED,
+                max_pool_connections=config.get("s3_max_pool_connections"),
+                retries={'total_max_attempts': config.get("s3_max_attempts"), 'mode': 'adaptive'},
+                tcp_keepalive=True)
+            kwargs = {}
+            endpoint = config.get("s3_endpoint")
+            if endpoint:
+                kwargs['endpoint_url'] = endpoint
+            logging.info("creating S3 client")
+            _s3_client = boto3.client('s3', config=client_config, **kwargs)
+            _s3_client_pid = os.getpid()
+        return _s3_client
+
+
+def isNotModified(ce):
+    """ Return True if the ClientError is a 304 response to a
+        conditional (If-None-Match) request """
+    if ce.response['Error']['Code'] in ('304', 'NotModified'):
+        return True
+    metadata = ce.response.get('ResponseMetadata', {})
+    return metadata.get('HTTPStatusCode') == 304
+
+
+def openRange(s3, s3_bucket, s3_key, range_start, range_end, etag=None):
+    """ Request the bytes of s3_key from range_start up to (but not
+        including) range_end and return the response body without
+        reading it.  If etag is given, the request fails if the object
+        no longer has that etag. """
+    s3_range = f"bytes={range_start}-{range_end-1}"
+    logging.info(f"s3_range: {s3_range}")
+    kwargs = {}
+    if etag:
+        kwargs['IfMatch'] = etag
+    with metrics.timer("s3_get"):
+        rsp = s3.get_object(Bucket=s3_bucket, Key=s3_key, Range=s3_range, **kwargs)
+    return rsp['Body']
+
+
+def getRange(s3, s3_bucket, s3_key, range_start, range_end, etag=None):
+    """ Return the bytes of s3_key from range_start up to (but not
+        including) range_end.  If etag is given, the request fails
+        if the object no longer has that etag. """
+    body = openRange(s3, s3_bucket, s3_key, range_start, range_end, etag=etag)
+    return body.read()
+
+
+def openBlock(s3, s3_bucket, s3_key, range_start, range_end, etag=None, cache=None):
+    """ Return (body, writer) for a range of s3_key.  If the range is in
+        cache, body is the cached file and writer is None.  Otherwise
+        body is the S3 response body, and writer is a CacheWriter to
+        save it to (or None if no cache is used). """
+    writer = None
+    if cache is not None and etag:
+        fh = cache.open(s3_bucket, s3_key, etag, range_start, range_end)
+        if fh is not None:
+            metrics.inc("cache_hits")
+            return fh, None
+        metrics.inc("cache_misses")
+    body = openRange(s3, s3_bucket, s3_key, range_start, range_end, etag=etag)
+    if cache is not None and etag:
+        writer = cache.writer(s3_bucket, s3_key, etag, range_start, range_end)
+    return body, writer
+
+
+def _putChunk(chunks, item, stop):
+    """ Put item in the chunks queue, waiting while it is full.  Returns
+        False without adding item if stop is set first. """
+    while not stop.is_set():
+        try:
+            chunks.put(item, timeout=QUEUE_POLL_SECONDS)
+            return True
+        except queue.Full:
+            continue
+    return False
+
+
+def _readBlock(s3, s3_bucket, s3_key, range_start, range_end, chunk_size, chunks, stop,
+               etag=None, cache=None):
+    """ Read a range of s3_key (from the cache if it's there) in
+        chunk_size pieces, and put each piece in the chunks queue
+        followed by None.  An error is put in the queue in place of
+        the remaining pieces.  Stops early if stop is set. """
+    if stop.is_set():
+        return
+    try:
+        body, writer = openBlock(s3, s3_bucket, s3_key, range_start, range_end, etag=etag, cache=cache)
+    except Exception as e:
+        _putChunk(chunks, e, stop)
+        return
+    try:
+        while not stop.is_set():
+            with metrics.timer("s3_read"):
+                chunk = body.read(chunk_size)
+            if not chunk:
+                if writer is not None:
+                    writer.commit()
+                break
+            if writer is not None:
+                writer.write(chunk)
+            if not _putChunk(chunks, chunk, stop):
+                return
+    except Exception as e:
+        _putChunk(chunks, e, stop)
+        return
+    finally:
+        body.close()
+        if writer is not None:
+            writer.close()
+    _putChunk(chunks, None, stop)
+
+
+def getBlocks(s3, s3_bucket, s3_key, range_start, content_length, block_size,
+              concurrency=1, prefetch=1, etag=None, chunk_size=None, cache=None):
+    """ Generator that returns the bytes of s3_key from range_start to
+        content_length.  The object is requested in block_size ranges.
+        concurrency threads each download a range in chunk_size pieces,
+        and hold at most one piece ahead of the reader, so memory use
+        depends on chunk_size rather than block_size.  Up to prefetch
+        ranges are queued, but bytes are always returned in order.
+        Stops if a range is past the end of the object (InvalidRange).
+        Any other error reading a range is raised, including a 412 when
+        the object's etag no longer matches etag, so a caller never
+        mistakes a failed read for the end of the object.  If cache is given, ranges
+        are read from and saved to the cache (only when etag is set). """
+    concurrency = max(concurrency, 1)
+    prefetch = max(prefetch, concurrency)
+    if not chunk_size:
+        chunk_size = block_size
+    pending = deque()  # (future, chunks queue) for each requested block
+    next_start = range_start
+    stop = threading.Event()
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        try:
+            while True:
+                while len(pending) < prefetch and next_start < content_length:
+                    next_end = min(next_start + block_size, content_length)
+                    chunks = queue.Queue(maxsize=1)
+                    future = executor.submit(_readBlock, s3, s3_bucket, s3_key, next_start, next_end,
+                                             chunk_size, chunks, stop, etag=etag, cache=cache)
+                    pending.append((future, chunks))
+                    next_start = next_end
+                if not pending:
+                    logging.info("no more bytes to read")
+                    break
+                _, chunks = pending.popleft()
+                num_bytes = 0
+                error = None
+                while True:
+                    chunk = chunks.get()
+                    if chunk is None:
+                        break
+                    if isinstance(chunk, Exception):
+                        error = chunk
+                        break
+                    num_bytes += len(chunk)
+                    metrics.inc("bytes_read", len(chunk))
+                    yield chunk
+                if isinstance(error, ClientError) and error.response['Error']['Code'] == "InvalidRange":
+                    # the object is shorter than expected
+                    logging.info(f"exceeded range for {s3_key}")
+                    break
+                if error is not None:
+                    logging.error(f"error reading {s3_key}: {error}")
+                    raise error
+                if num_bytes == 0:
+                    logging.info("no bytes read")
+                    break
+        finally:
+            # stop the threads reading blocks whose data won't be used
+            stop.set()
+            for future, _ in pending:
+                future.cancel()
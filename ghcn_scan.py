@@ -0,0 +1,143 @@
+'''
+GHCN_scan:
+
+Parallel scans of the GHCN data table.  The table is read in slices of
+whole chunks, and a function is run on each slice (a dt_day array) by a
+pool of workers.  HSDS domains use a thread pool, since most of the time
+is spent waiting on HSDS requests.  HDF5 files use a process pool, so
+that reads and the per-slice NumPy work run on all cores.  Each worker
+opens the file once and keeps it open for the following slices.
+
+The function should reduce its slice to a small result (e.g. the unique
+station_ids in it), which scan returns in row order for the caller to
+merge.  With the process pool, the function must be defined at the top
+level of a module so it can be pickled.
+'''
+
+import os
+import time
+import logging
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+import numpy as np
+import h5pyd
+import h5py
+
+from ghcn_table import getDataTable, ColumnTable, CompactTable
+
+SCAN_CHUNKS = 8  # chunks per slice
+HSDS_WORKERS = 16  # threads for HSDS scans
+PENDING_PER_WORKER = 2  # slices queued per worker
+
+_local = threading.local()
+
+
+def isHsds(path):
+    """ Return True if path is a HSDS domain """
+    return path.startswith("hdf5://")
+
+
+def _openFile(path):
+    """ Return the file for path opened by this worker, opening it on
+    first use """
+    files = getattr(_local, "files", None)
+    if files is None:
+        files = _local.files = {}
+    if path not in files:
+        if isHsds(path):
+            files[path] = h5pyd.File(path, mode='r', use_cache=False)
+        else:
+            files[path] = h5py.File(path, mode='r')
+    return files[path]
+
+
+def _openTable(path):
+    """ open path for reading from the calling process """
+    if isHsds(path):
+        return h5pyd.File(path, mode='r', use_cache=False)
+    return h5py.File(path, mode='r')
+
+
+def readSlice(dset, start_row, end_row, fields=None):
+    """ Return rows start_row to end_row of the data table.  If fields
+    is given, only those fields are returned, and with the columns layout
+    only those columns are read (and decoded, for the compact encoding). """
+    if fields is None:
+        return dset[start_row:end_row]
+    if isinstance(dset, (ColumnTable, CompactTable)) and dset.hasColumns() and \
+            all(name in dset.dtype.names for name in fields):
+        columns = [dset.getColumn(name, slice(start_row, end_row)) for name in fields]
+        dtype = [(name, column.dtype) for name, column in zip(fields, columns)]
+        arr = np.zeros((len(columns[0]),), dtype=dtype)
+        for name, column in zip(fields, columns):
+            arr[name] = column
+        return arr
+    return dset[start_row:end_row][list(fields)]
+
+
+def _scanSlice(path, func, start_row, end_row, fields):
+    """ Read a slice of the data table and return (rows read, func(rows)) """
+    f = _openFile(path)
+    rows = readSlice(getDataTable(f), start_row, end_row, fields=fields)
+    return len(rows), func(rows)
+
+
+def getSlices(num_rows, chunk_rows, start_row=0, end_row=None, slice_rows=None):
+    """ Return a list of (start, end) row ranges covering start_row to
+    end_row.  Ranges after the first start on a chunk boundary. """
+    if end_row is None or end_row > num_rows:
+        end_row = num_rows
+    if not slice_rows:
+        slice_rows = chunk_rows * SCAN_CHUNKS
+    slice_rows = max(slice_rows // chunk_rows, 1) * chunk_rows
+    slices = []
+    start = start_row
+    while start < end_row:
+        end = min((start // slice_rows + 1) * slice_rows, end_row)
+        slices.append((start, end))
+        start = end
+    return slices
+
+
+def scan(path, func, start_row=0, end_row=None, workers=None, slice_rows=None, fields=None):
+    """ Generator - run func on each slice of the data table in path
+    (rows start_row to end_row) and return the results in row order.
+    fields limits the fields read for each row.  Logs the rows/sec
+    once the scan is done. """
+    with _openTable(path) as f:
+        dset = getDataTable(f)
+        num_rows = dset.shape[0]
+        chunk_rows = dset.chunks[0] if dset.chunks else 91268
+    slices = getSlices(num_rows, chunk_rows, start_row=start_row, end_row=end_row, slice_rows=slice_rows)
+    if isHsds(path):
+        workers = workers or HSDS_WORKERS
+        executor = ThreadPoolExecutor(max_workers=workers)
+    else:
+        workers = workers or os.cpu_count() or 1
+        executor = ProcessPoolExecutor(max_workers=workers)
+    logging.info(f"scan - {len(slices)} slices of {path} with {workers} workers")
+
+    start_time = time.time()
+    rows_read = 0
+    pending = deque()
+    next_slice = 0
+    with executor:
+        try:
+            while True:
+                while len(pending) < workers * PENDING_PER_WORKER and next_slice < len(slices):
+                    start, end = slices[next_slice]
+                    pending.append(executor.submit(_scanSlice, path, func, start, end, fields))
+                    next_slice += 1
+                if not pending:
+                    break
+                count, result = pending.popleft().result()
+                rows_read += count
+                yield result
+        finally:
+            for future in pending:
+                future.cancel()
+    elapsed = time.time() - start_time
+    if elapsed > 0:
+        logging.info(f"scan - {rows_read} rows in {elapsed:.2f} s, rows/sec: {int(rows_read/elapsed)}")
+
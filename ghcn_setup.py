@@ -12,21 +12,31 @@ import h5pyd
 import h5py
 
 if __name__ == "__main__":
-    from ghcn_dtype import dt_day
     from ghcn_dtype import dt_station
+    from ghcn_dtype import dt_manifest
+    from ghcn_table import createDataTable, createShards, getFilters, getShardGroups, LAYOUTS, ENCODINGS, SHARDS
 
 else:
-    from .ghcn_dtype import dt_day
     from .ghcn_dtype import dt_station
+    from .ghcn_dtype import dt_manifest
+    from .ghcn_table import createDataTable, createShards, getFilters, getShardGroups, LAYOUTS, ENCODINGS, SHARDS
 
 def usage():
     """ Usage message """
     print("Create or update HDF data file for GHCN data")
-    print("Usage: ghcn_config.py [-h] [--loglevel debug|info|warning|error] <filepath>")
+    print("Usage: ghcn_config.py [-h] [--loglevel debug|info|warning|error] [--layout table|columns] [--encoding string|compact]")
+    print("       [--compression none|gzip|lzf|<hsds filter>] [--level <n>] [--shuffle] [--chunks <rows>] [--shards <n>] <filepath>")
     print("   <filepath>: HSDS or hdf5 file path ('hdf5://' prefix for HSDS)")
     print("Options:")
     print("   --help: this message")
     print("   --loglevel debug|info|warning|error: change default log level")
+    print("   --layout table|columns: store data as one table (default) or one dataset per field")
+    print("   --encoding string|compact: store station_id, ymd, element, flags and obs_time as strings (default) or integer codes")
+    print("   --compression none|gzip|lzf|<hsds filter>: compression filter for the data and stations tables (default none)")
+    print("   --level <n>: compression level (e.g. 1-9 for gzip)")
+    print("   --shuffle: use the shuffle filter (usually improves compression)")
+    print("   --chunks <rows>: number of rows per chunk for the data table (default 91268)")
+    print("   --shards <n>: split the data table into n shards, each written by its own collector (HSDS)")
     sys.exit(1)
 
 
@@ -41,14 +51,15 @@ def h5File(path, mode='r'):
         f = h5py.File(path, mode=mode)
     return f
 
-def create_table(grp, name, dt):
+def create_table(grp, name, dt, chunks=(91268,), **kwargs):
     """ Create extensible 1-D dataset of given type if object with that
-        name doesn't already exist. """
+        name doesn't already exist.  kwargs are passed to create_dataset
+        (e.g. compression filters). """
     if name in grp:
         return  # Dataset already exists
     logging.info(f"Creating dataset: {name}")
 
-    grp.create_dataset(name, (0,), maxshape=(None,), chunks=(91268,), dtype=dt)
+    grp.create_dataset(name, (0,), maxshape=(None,), chunks=chunks, dtype=dt, **kwargs)
 #  
 # Main
 #
@@ -56,6 +67,13 @@ if len(sys.argv) < 2 or sys.argv[1] in ("-h", "--help"):
     usage()
 
 hdf_filepath = None
+layout = "table"
+encoding = "string"
+compression = None
+compression_level = None
+shuffle = False
+chunk_rows = 91268
+shard_count = 0
 
 loglevel = logging.INFO
 argn = 1
@@ -79,6 +97,38 @@ while argn < len(sys.argv):
             else:
                 usage()
             argn += 1
+        elif arg == "--layout":
+            if val not in LAYOUTS:
+                usage()
+            layout = val
+            argn += 1
+        elif arg == "--encoding":
+            if val not in ENCODINGS:
+                usage()
+            encoding = val
+            argn += 1
+        elif arg == "--compression":
+            if not val:
+                usage()
+            compression = val
+            argn += 1
+        elif arg == "--level":
+            if not val or not val.isdigit():
+                usage()
+            compression_level = int(val)
+            argn += 1
+        elif arg == "--shuffle":
+            shuffle = True
+        elif arg == "--chunks":
+            if not val or not val.isdigit():
+                usage()
+            chunk_rows = int(val)
+            argn += 1
+        elif arg == "--shards":
+            if not val or not val.isdigit() or int(val) < 1:
+                usage()
+            shard_count = int(val)
+            argn += 1
         elif arg in ("-h", "--help"):
             usage()
         else:
@@ -102,10 +152,22 @@ if os.path.isfile(hdf_filepath):
 with h5File(hdf_filepath, mode='a') as f:
     logging.debug(f"Got root id: {f.id.id}")
     # Create data table if not created already
-    create_table(f, "data", dt_day)
+    filters = getFilters(compression=compression, compression_opts=compression_level, shuffle=shuffle)
+    if "data" not in f and SHARDS not in f:
+        logging.info(f"Creating data table with layout: {layout}, encoding: {encoding}, chunks: {chunk_rows}, filters: {filters}")
+        if shard_count > 0:
+            logging.info(f"Creating {shard_count} shards")
+            createShards(f, shard_count, layout=layout, encoding=encoding, chunks=(chunk_rows,), **filters)
+        else:
+            createDataTable(f, "data", layout=layout, encoding=encoding, chunks=(chunk_rows,), **filters)
 
     # Create station table
-    create_table(f, "stations", dt_station)
+    create_table(f, "stations", dt_station, **filters)
+
+    # Create manifest table (how far each year's CSV file has been loaded),
+    # one per shard for sharded files
+    for grp in getShardGroups(f):
+        create_table(grp, "manifest", dt_manifest, chunks=(1024,))
 
     # TBD - create/update auxillary tables 
     logging.info("done")
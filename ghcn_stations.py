@@ -0,0 +1,403 @@
+#!/usr/bin/env python3
+
+'''
+GHCN_stations:
+
+In-memory lookup of the GHCN stations table by station_id and by
+location.  The stations are read once into arrays, with a dict from
+station_id to row and a grid of GRID_DEGREES lat/lon cells.  The
+station rows are sorted by cell, so the stations in a band of cells
+are one slice of the sorted rows.  Radius, nearest-k and bounding box
+queries only compute distances for the stations in the cells that can
+contain a match.
+
+The sorted rows can be saved as the station_grid dataset next to
+stations, so later loads don't need to sort them.  The grid is only
+used while the stations table has the same etag it was built for.
+'''
+
+import sys
+import time
+import logging
+import numpy as np
+import h5pyd
+import h5py
+
+from ghcn_dtype import dt_station_cell
+
+GRID_DEGREES = 1.0  # width and height of a grid cell
+EARTH_RADIUS = 6371.0088  # mean earth radius in km
+GRID_CHUNKS = (16384,)
+MIN_NEAREST_KM = 1.0  # smallest first search radius for nearest queries
+
+
+def usage():
+    """ Usage message """
+    print("Find GHCN stations by id or location")
+    print("Usage: ghcn_stations.py [-h] [--loglevel debug|info|warning|error] [--rebuild] [--station <id>]")
+    print("       [--near <lat>,<lon>] [-k <n>] [--radius <km>] [--bbox <min_lat>,<min_lon>,<max_lat>,<max_lon>] <filepath>")
+    print("   <filepath>: HSDS or hdf5 file path ('hdf5://' prefix for HSDS)")
+    print("Options:")
+    print("   --help: this message")
+    print("   --loglevel debug|info|warning|error: change default log level")
+    print("   --rebuild: recreate the station_grid dataset from the stations table")
+    print("   --station <id>: print the station with the given id")
+    print("   --near <lat>,<lon>: print the stations nearest to lat,lon")
+    print("   -k <n>: number of stations to print for --near (default 10)")
+    print("   --radius <km>: print all stations within km of --near instead")
+    print("   --bbox <min_lat>,<min_lon>,<max_lat>,<max_lon>: print the stations in the box")
+    sys.exit(1)
+
+
+def h5File(path, mode='r'):
+    """ open a HSDS domain or HDF5 file based on the path.
+        if path starts with "hdf5://", use HSDS, otherwise
+        use h5py on a regular file path """
+    if path.startswith("hdf5://"):
+        f = h5pyd.File(path, mode=mode)
+    else:
+        f = h5py.File(path, mode=mode)
+    return f
+
+
+def _toBytes(station_id):
+    """ return station_id as bytes """
+    if isinstance(station_id, str):
+        station_id = station_id.encode('ascii')
+    return station_id
+
+
+def getDistances(lat, lon, lats, lons):
+    """ Return the great circle distances in km from lat, lon (degrees)
+    to each of lats, lons """
+    lat = np.radians(lat)
+    lats = np.radians(lats)
+    dlat = lats - lat
+    dlon = np.radians(lons) - np.radians(lon)
+    a = np.sin(dlat / 2) ** 2 + np.cos(lat) * np.cos(lats) * np.sin(dlon / 2) ** 2
+    return 2 * EARTH_RADIUS * np.arcsin(np.sqrt(np.minimum(a, 1.0)))
+
+
+def _normLon(lon):
+    """ return lon moved to the range -180 to 180 """
+    if -180 <= lon <= 180:
+        return lon
+    return (lon + 180) % 360 - 180
+
+
+def _lonRanges(min_lon, max_lon):
+    """ Return a list of (min, max) longitude ranges within -180 to 180
+    covering min_lon to max_lon, where min_lon > max_lon means the range
+    crosses the antimeridian """
+    if max_lon - min_lon >= 360:
+        return [(-180.0, 180.0)]
+    min_lon = _normLon(min_lon)
+    max_lon = _normLon(max_lon)
+    if min_lon <= max_lon:
+        return [(min_lon, max_lon)]
+    return [(min_lon, 180.0), (-180.0, max_lon)]
+
+
+def _getStationEtag(f):
+    """ Return the etag saved with the stations table, or empty string """
+    dset = f['stations']
+    if "_etag" in dset.attrs:
+        return dset.attrs["_etag"]
+    return ""
+
+
+class StationGrid:
+    """ Stations table rows sorted by lat/lon grid cell """
+
+    def __init__(self, lats, lons, cells=None, cell_size=GRID_DEGREES):
+        self.cell_size = cell_size
+        self.num_lats = int(np.ceil(180 / cell_size))
+        self.num_lons = int(np.ceil(360 / cell_size))
+        if cells is None:
+            cells = self.getCells(lats, lons)
+        self.cells = cells
+        self.offsets = np.searchsorted(cells['cell'], np.arange(self.num_lats * self.num_lons + 1))
+
+    def getCells(self, lats, lons):
+        """ Return a dt_station_cell array with the grid cell of each
+        station, sorted by cell.  Stations without a valid location are
+        left out. """
+        valid = np.isfinite(lats) & np.isfinite(lons) & (np.abs(lats) <= 90)
+        rows = np.flatnonzero(valid)
+        cells = np.zeros((len(rows),), dtype=dt_station_cell)
+        cells['cell'] = self._latIndex(lats[rows]) * self.num_lons + self._lonIndex(lons[rows])
+        cells['row'] = rows
+        return cells[np.argsort(cells['cell'], kind='stable')]
+
+    def _latIndex(self, lats):
+        index = np.floor((np.asarray(lats) + 90) / self.cell_size).astype(np.int64)
+        return np.clip(index, 0, self.num_lats - 1)
+
+    def _lonIndex(self, lons):
+        # like _normLon, so a station at lon 180 is in the last column
+        lons = np.asarray(lons, dtype=np.float64)
+        lons = np.where(np.abs(lons) <= 180, lons, (lons + 180) % 360 - 180)
+        index = np.floor((lons + 180) / self.cell_size).astype(np.int64)
+        return np.clip(index, 0, self.num_lons - 1)
+
+    def getRows(self, min_lat, max_lat, lon_ranges):
+        """ Return the rows of stations in cells that overlap min_lat to
+        max_lat and any of lon_ranges """
+        first_lat, last_lat = self._latIndex([min_lat, max_lat])
+        parts = []
+        for lat_index in range(first_lat, last_lat + 1):
+            for min_lon, max_lon in lon_ranges:
+                first_lon, last_lon = self._lonIndex([min_lon, max_lon])
+                if max_lon >= 180:
+                    last_lon = self.num_lons - 1
+                first_cell = lat_index * self.num_lons + first_lon
+                last_cell = lat_index * self.num_lons + last_lon
+                parts.append(self.cells['row'][self.offsets[first_cell]:self.offsets[last_cell + 1]])
+        if not parts:
+            return np.zeros((0,), dtype=np.int64)
+        return np.concatenate(parts).astype(np.int64)
+
+
+class StationLookup:
+    """ Find stations by id, distance from a point, or bounding box.
+    stations is a dt_station array (the stations table).  Queries
+    return row numbers of the stations array. """
+
+    def __init__(self, stations, cells=None, cell_size=GRID_DEGREES):
+        self.stations = stations
+        self.lats = stations['lat'].astype(np.float64)
+        self.lons = stations['lon'].astype(np.float64)
+        self.rows = {station_id: row for row, station_id in enumerate(stations['station_id'].tolist())}
+        self.grid = StationGrid(self.lats, self.lons, cells=cells, cell_size=cell_size)
+
+    def __len__(self):
+        return len(self.stations)
+
+    def getRow(self, station_id):
+        """ Return the row for station_id, or None if not found """
+        return self.rows.get(_toBytes(station_id))
+
+    def getStation(self, station_id):
+        """ Return the station record for station_id, or None if not found """
+        row = self.getRow(station_id)
+        if row is None:
+            return None
+        return self.stations[row]
+
+    def radius(self, lat, lon, km):
+        """ Return (rows, distances) for the stations within km of lat, lon,
+        nearest first """
+        angle = np.degrees(km / EARTH_RADIUS)
+        min_lat = lat - angle
+        max_lat = lat + angle
+        if angle >= 180:
+            rows = self.grid.cells['row'].astype(np.int64)
+        else:
+            if min_lat <= -90 or max_lat >= 90:
+                # the circle includes a pole, so all longitudes
+                lon_ranges = [(-180.0, 180.0)]
+            else:
+                # widest longitude offset of the circle
+                dlon = np.degrees(np.arcsin(np.sin(np.radians(angle)) / np.cos(np.radians(lat))))
+                lon_ranges = _lonRanges(lon - dlon, lon + dlon)
+            rows = self.grid.getRows(max(min_lat, -90), min(max_lat, 90), lon_ranges)
+        distances = getDistances(lat, lon, self.lats[rows], self.lons[rows])
+        found = distances <= km
+        rows = rows[found]
+        distances = distances[found]
+        order = np.argsort(distances, kind='stable')
+        return rows[order], distances[order]
+
+    def nearest(self, lat, lon, k=1):
+        """ Return (rows, distances) for the k stations nearest to lat, lon,
+        nearest first """
+        # start with the radius that would hold 2k stations if they were
+        # evenly spread, and double it until k stations are found
+        km = max(2 * EARTH_RADIUS * np.sqrt(2 * k / max(len(self.grid.cells), 1)), MIN_NEAREST_KM)
+        while True:
+            rows, distances = self.radius(lat, lon, km)
+            if len(rows) >= k or km >= np.pi * EARTH_RADIUS:
+                return rows[:k], distances[:k]
+            km *= 2
+
+    def bbox(self, min_lat, min_lon, max_lat, max_lon):
+        """ Return the rows of the stations with min_lat <= lat <= max_lat
+        and min_lon <= lon <= max_lon.  If min_lon > max_lon, the box
+        crosses the antimeridian. """
+        lon_ranges = _lonRanges(min_lon, max_lon)
+        rows = self.grid.getRows(max(min_lat, -90), min(max_lat, 90), lon_ranges)
+        lats = self.lats[rows]
+        lons = self.lons[rows]
+        found = (lats >= min_lat) & (lats <= max_lat)
+        in_lons = np.zeros((len(rows),), dtype=bool)
+        for lon_min, lon_max in lon_ranges:
+            in_lons |= (lons >= lon_min) & (lons <= lon_max)
+        return np.sort(rows[found & in_lons])
+
+
+def updateStationGrid(f, cell_size=GRID_DEGREES):
+    """ Save the grid cells of the stations table as the station_grid
+    dataset.  Returns the StationLookup for the stations. """
+    stations = f['stations'][...]
+    lookup = StationLookup(stations, cell_size=cell_size)
+    cells = lookup.grid.cells
+    if "station_grid" in f:
+        del f["station_grid"]
+    logging.info(f"Creating dataset: station_grid with {len(cells)} stations")
+    dset = f.create_dataset("station_grid", (len(cells),), maxshape=(None,), chunks=GRID_CHUNKS,
+                            dtype=dt_station_cell)
+    if len(cells) > 0:
+        dset[...] = cells
+    dset.attrs["cell_size"] = cell_size
+    dset.attrs["_etag"] = _getStationEtag(f)
+    return lookup
+
+
+def getStationLookup(f):
+    """ Return a StationLookup for the stations table, using the
+    station_grid dataset if it is up to date """
+    stations = f['stations'][...]
+    if "station_grid" in f:
+        dset = f["station_grid"]
+        etag = _getStationEtag(f)
+        if etag and "_etag" in dset.attrs and dset.attrs["_etag"] == etag:
+            cells = dset[...]
+            if len(cells) == 0 or cells['row'].max() < len(stations):
+                return StationLookup(stations, cells=cells, cell_size=float(dset.attrs["cell_size"]))
+        logging.info("station_grid is out of date, sorting stations")
+    return StationLookup(stations)
+
+
+def _parseFloats(val, count):
+    """ return the comma separated floats in val, or None if there
+    aren't count of them """
+    try:
+        values = [float(x) for x in val.split(',')]
+    except ValueError:
+        return None
+    if len(values) != count:
+        return None
+    return values
+
+
+def _printStations(lookup, rows, distances=None):
+    """ print the stations for rows, with the distance if given """
+    for i, row in enumerate(rows):
+        station = lookup.stations[row]
+        if distances is None:
+            print(station)
+        else:
+            print(f"{distances[i]:9.2f} km {station}")
+
+
+#
+# Main
+#
+if __name__ == "__main__":
+    if len(sys.argv) < 2 or sys.argv[1] in ("-h", "--help"):
+        usage()
+
+    hdf_filepath = None
+    station_id = None
+    near = None
+    k = 10
+    radius_km = None
+    box = None
+    rebuild = False
+
+    loglevel = logging.INFO
+    argn = 1
+    while argn < len(sys.argv):
+        arg = sys.argv[argn]
+        val = None
+        if len(sys.argv) > argn + 1:
+            val = sys.argv[argn+1]
+        if arg[0] == '-':
+            # process option
+            if arg == "--loglevel":
+                val = val.upper()
+                if val == "DEBUG":
+                    loglevel = logging.DEBUG
+                elif val == "INFO":
+                    loglevel = logging.INFO
+                elif val in ("WARN", "WARNING"):
+                    loglevel = logging.WARNING
+                elif val == "ERROR":
+                    loglevel = logging.ERROR
+                else:
+                    usage()
+                argn += 1
+            elif arg == "--station":
+                if not val:
+                    usage()
+                station_id = val
+                argn += 1
+            elif arg == "--near":
+                near = _parseFloats(val or "", 2)
+                if near is None:
+                    usage()
+                argn += 1
+            elif arg == "-k":
+                if not val or not val.isdigit():
+                    usage()
+                k = int(val)
+                argn += 1
+            elif arg == "--radius":
+                radius_km = _parseFloats(val or "", 1)
+                if radius_km is None:
+                    usage()
+                radius_km = radius_km[0]
+                argn += 1
+            elif arg == "--bbox":
+                box = _parseFloats(val or "", 4)
+                if box is None:
+                    usage()
+                argn += 1
+            elif arg == "--rebuild":
+                rebuild = True
+            else:
+                # unknown option, or --help
+                usage()
+        else:
+            if not hdf_filepath:
+                hdf_filepath = arg
+
+        argn += 1
+
+    if not hdf_filepath:
+        logging.error("HDF filepath not provided")
+        usage()
+
+    logging.basicConfig(format='%(asctime)s %(message)s', level=loglevel)
+
+    mode = 'a' if rebuild else 'r'
+    with h5File(hdf_filepath, mode=mode) as f:
+        start_time = time.time()
+        if rebuild:
+            lookup = updateStationGrid(f)
+        else:
+            lookup = getStationLookup(f)
+        elapsed = time.time() - start_time
+        logging.info(f"loaded {len(lookup)} stations in {elapsed:.3f} s")
+
+    if station_id:
+        start_time = time.time()
+        station = lookup.getStation(station_id)
+        elapsed = time.time() - start_time
+        print(station)
+        print(f"lookup of {station_id} in {elapsed*1e6:.1f} us")
+    if near:
+        start_time = time.time()
+        if radius_km is not None:
+            rows, distances = lookup.radius(near[0], near[1], radius_km)
+        else:
+            rows, distances = lookup.nearest(near[0], near[1], k=k)
+        elapsed = time.time() - start_time
+        _printStations(lookup, rows, distances)
+        print(f"{len(rows)} stations near {near[0]},{near[1]} in {elapsed*1e6:.1f} us")
+    if box:
+        start_time = time.time()
+        rows = lookup.bbox(*box)
+        elapsed = time.time() - start_time
+        _printStations(lookup, rows)
+        print(f"{len(rows)} stations in {box} in {elapsed*1e6:.1f} us")
@@ -0,0 +1,313 @@
+#!/usr/bin/env python3
+
+'''
+GHCN_summary:
+
+Summary tables of the GHCN data table.  For each station and element,
+the summary tables hold the count, sum, min and max of data_value over
+a month or a year:
+  monthly_summary/<YYYYMM>: one dataset per month
+  yearly_summary/<YYYY>: one dataset per year
+Each dataset is sorted by station_id and element.  Rows with a q_flag
+(failed a quality check), an invalid ymd, or a data_value that couldn't
+be parsed are not counted.
+
+ghcn_update merges the rows it adds into the summaries of the months
+and years they cover.  In a sharded file, the summaries are in the
+group of the shard that stores the year.  Since rows are added in roughly date order, each
+write only rewrites a few of the datasets.
+'''
+
+import sys
+import time
+import logging
+import numpy as np
+import h5pyd
+import h5py
+
+from ghcn_dtype import dt_summary
+from ghcn_parse import ymdToDays, DAY_EPOCH, BAD_VALUE
+from ghcn_table import getDataTable, getShardGroups, getYearGroup
+from ghcn_index import getYearRange
+
+MONTHLY = "monthly_summary"
+YEARLY = "yearly_summary"
+SUMMARY_CHUNKS = (4096,)
+SCAN_ROWS = 16 * 91268  # number of data rows to read at a time for a rebuild
+
+
+def usage():
+    """ Usage message """
+    print("Query or rebuild the GHCN monthly and yearly summary tables")
+    print("Usage: ghcn_summary.py [-h] [--loglevel debug|info|warning|error] [--rebuild] [--year <YYYY>] [--month <MM>]")
+    print("       [--station <id>] [--element <element>] <filepath>")
+    print("   <filepath>: HSDS or hdf5 file path ('hdf5://' prefix for HSDS)")
+    print("Options:")
+    print("   --help: this message")
+    print("   --loglevel debug|info|warning|error: change default log level")
+    print("   --rebuild: recreate the summary tables from the data table")
+    print("   --year <YYYY>: print the summary for the given year")
+    print("   --month <MM>: print the summary for the given month of --year instead")
+    print("   --station <id>: only print the given station")
+    print("   --element <element>: only print the given element (e.g. TMAX)")
+    sys.exit(1)
+
+
+def h5File(path, mode='r'):
+    """ open a HSDS domain or HDF5 file based on the path.
+        if path starts with "hdf5://", use HSDS, otherwise
+        use h5py on a regular file path """
+    if path.startswith("hdf5://"):
+        f = h5pyd.File(path, mode=mode)
+    else:
+        f = h5py.File(path, mode=mode)
+    return f
+
+
+def _toBytes(value):
+    """ return value as bytes """
+    if isinstance(value, str):
+        value = value.encode('ascii')
+    return value
+
+
+def combineSummary(entries):
+    """ Return entries (a dt_summary array) with the entries for each
+    station and element combined into one, sorted by station_id and
+    element """
+    if len(entries) == 0:
+        return entries
+    entries = entries[np.lexsort((entries['element'], entries['station_id']))]
+    station_ids = entries['station_id']
+    elements = entries['element']
+    starts = np.flatnonzero((station_ids[1:] != station_ids[:-1]) | (elements[1:] != elements[:-1])) + 1
+    starts = np.concatenate(([0], starts))
+    if len(starts) == len(entries):
+        return entries
+    combined = entries[starts]
+    combined['count'] = np.add.reduceat(entries['count'], starts)
+    combined['sum'] = np.add.reduceat(entries['sum'], starts)
+    combined['min'] = np.minimum.reduceat(entries['min'], starts)
+    combined['max'] = np.maximum.reduceat(entries['max'], starts)
+    return combined
+
+
+def getSummaryRows(rows):
+    """ Return (months, entries) for the dt_day rows that are counted in
+    the summaries.  entries is a dt_summary array with one entry per row,
+    and months is the month of each row (months since year 0). """
+    days, valid = ymdToDays(rows['ymd'])
+    valid &= rows['q_flag'] == b''
+    valid &= rows['data_value'] != BAD_VALUE
+    rows = rows[valid]
+    months = (DAY_EPOCH + days[valid]).astype('datetime64[M]').astype(np.int64) + 1970 * 12
+    entries = np.zeros((len(rows),), dtype=dt_summary)
+    entries['station_id'] = rows['station_id']
+    entries['element'] = rows['element']
+    entries['count'] = 1
+    entries['sum'] = rows['data_value']
+    entries['min'] = rows['data_value']
+    entries['max'] = rows['data_value']
+    return months, entries
+
+
+def _mergeSummary(f, grp_name, name, entries):
+    """ Merge entries into the summary dataset grp_name/name """
+    if grp_name not in f:
+        logging.info(f"Creating group: {grp_name}")
+        f.create_group(grp_name)
+    grp = f[grp_name]
+    if name in grp:
+        dset = grp[name]
+        if dset.shape[0] > 0:
+            entries = np.concatenate((dset[...], entries))
+        entries = combineSummary(entries)
+        if dset.shape[0] < len(entries):
+            dset.resize((len(entries),))
+    else:
+        entries = combineSummary(entries)
+        dset = grp.create_dataset(name, (len(entries),), maxshape=(None,), chunks=SUMMARY_CHUNKS,
+                                  dtype=dt_summary)
+    dset[0:len(entries)] = entries
+
+
+def updateSummaries(f, rows):
+    """ Add the dt_day rows to the monthly and yearly summaries """
+    months, entries = getSummaryRows(rows)
+    if len(entries) == 0:
+        return
+    order = np.argsort(months, kind='stable')
+    months = months[order]
+    entries = entries[order]
+    unique_months, starts = np.unique(months, return_index=True)
+    ends = np.append(starts[1:], len(months))
+    year_entries = {}
+    for month, start, end in zip(unique_months, starts, ends):
+        year = int(month // 12)
+        name = f"{year:04d}{int(month % 12) + 1:02d}"
+        monthly = combineSummary(entries[start:end])
+        _mergeSummary(f, MONTHLY, name, monthly)
+        year_entries.setdefault(year, []).append(monthly)
+    for year, parts in year_entries.items():
+        _mergeSummary(f, YEARLY, f"{year:04d}", np.concatenate(parts))
+
+
+def getSummary(f, year, month=None, station_id=None, element=None):
+    """ Return the summary (dt_summary array) for the year, or the month
+    of the year if given.  Only entries for station_id and element are
+    returned if these are given. """
+    if month is None:
+        path = f"{YEARLY}/{int(year):04d}"
+    else:
+        path = f"{MONTHLY}/{int(year):04d}{int(month):02d}"
+    grp = getYearGroup(f, int(year))
+    if path not in grp:
+        return np.zeros((0,), dtype=dt_summary)
+    entries = grp[path][...]
+    if station_id is not None:
+        station_id = _toBytes(station_id)
+        start = np.searchsorted(entries['station_id'], station_id, side='left')
+        end = np.searchsorted(entries['station_id'], station_id, side='right')
+        entries = entries[start:end]
+    if element is not None:
+        entries = entries[entries['element'] == _toBytes(element)]
+    return entries
+
+
+def rebuildSummaries(f):
+    """ Recreate the summary tables by reading the data table.  The
+    summaries of each shard of a sharded file are in the shard's group. """
+    for grp in getShardGroups(f):
+        for name in (MONTHLY, YEARLY):
+            if name in grp:
+                del grp[name]
+        dset = getDataTable(grp)
+        num_rows = dset.shape[0]
+        logging.info(f"rebuildSummaries - {num_rows} rows in {grp.name}")
+        start_row = 0
+        while start_row < num_rows:
+            end_row = min(start_row + SCAN_ROWS, num_rows)
+            updateSummaries(grp, dset[start_row:end_row])
+            start_row = end_row
+
+
+def rebuildYearSummaries(f, year):
+    """ Recreate the summaries for one year from the data table rows for
+    the year.  Only the year's rows in the time index are read, or the
+    whole table if there is no time index. """
+    for month in range(1, 13):
+        name = f"{MONTHLY}/{year:04d}{month:02d}"
+        if name in f:
+            del f[name]
+    name = f"{YEARLY}/{year:04d}"
+    if name in f:
+        del f[name]
+    dset = getDataTable(f)
+    if "year_index" in f:
+        span = getYearRange(f, year)
+        if span is None:
+            return
+    else:
+        span = (0, dset.shape[0])
+    logging.info(f"rebuildYearSummaries - {year}, rows {span[0]} to {span[1]}")
+    prefix = f"{year:04d}".encode('ascii')
+    start_row = span[0]
+    while start_row < span[1]:
+        end_row = min(start_row + SCAN_ROWS, span[1])
+        rows = dset[start_row:end_row]
+        updateSummaries(f, rows[rows['ymd'].astype('S4') == prefix])
+        start_row = end_row
+
+
+#
+# Main
+#
+if __name__ == "__main__":
+    if len(sys.argv) < 2 or sys.argv[1] in ("-h", "--help"):
+        usage()
+
+    hdf_filepath = None
+    year = None
+    month = None
+    station_id = None
+    element = None
+    rebuild = False
+
+    loglevel = logging.INFO
+    argn = 1
+    while argn < len(sys.argv):
+        arg = sys.argv[argn]
+        val = None
+        if len(sys.argv) > argn + 1:
+            val = sys.argv[argn+1]
+        if arg[0] == '-':
+            # process option
+            if arg == "--loglevel":
+                val = val.upper()
+                if val == "DEBUG":
+                    loglevel = logging.DEBUG
+                elif val == "INFO":
+                    loglevel = logging.INFO
+                elif val in ("WARN", "WARNING"):
+                    loglevel = logging.WARNING
+                elif val == "ERROR":
+                    loglevel = logging.ERROR
+                else:
+                    usage()
+                argn += 1
+            elif arg == "--year":
+                if not val or not val.isdigit():
+                    usage()
+                year = int(val)
+                argn += 1
+            elif arg == "--month":
+                if not val or not val.isdigit() or not 1 <= int(val) <= 12:
+                    usage()
+                month = int(val)
+                argn += 1
+            elif arg == "--station":
+                if not val:
+                    usage()
+                station_id = val
+                argn += 1
+            elif arg == "--element":
+                if not val:
+                    usage()
+                element = val
+                argn += 1
+            elif arg == "--rebuild":
+                rebuild = True
+            else:
+                # unknown option, or --help
+                usage()
+        else:
+            if not hdf_filepath:
+                hdf_filepath = arg
+
+        argn += 1
+
+    if not hdf_filepath:
+        logging.error("HDF filepath not provided")
+        usage()
+    if month is not None and year is None:
+        logging.error("--month requires --year")
+        usage()
+
+    logging.basicConfig(format='%(asctime)s %(message)s', level=loglevel)
+
+    mode = 'a' if rebuild else 'r'
+    with h5File(hdf_filepath, mode=mode) as f:
+        if rebuild:
+            start_time = time.time()
+            rebuildSummaries(f)
+            logging.info(f"rebuildSummaries - done in {time.time() - start_time:.1f} s")
+        if year is not None:
+            start_time = time.time()
+            entries = getSummary(f, year, month=month, station_id=station_id, element=element)
+            elapsed = time.time() - start_time
+            for entry in entries:
+                mean = entry['sum'] / entry['count'] if entry['count'] else 0
+                print(f"{entry['station_id'].decode('ascii')} {entry['element'].decode('ascii')} "
+                      f"count: {entry['count']} sum: {entry['sum']} min: {entry['min']} "
+                      f"max: {entry['max']} mean: {mean:.2f}")
+            print(f"{len(entries)} entries in {elapsed:.3f} s")
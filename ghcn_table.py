@@ -0,0 +1,451 @@
+'''
+GHCN_table:
+
+Access to the GHCN data table for either storage layout:
+  table: 'data' is a 1-D dataset of dt_day records
+  columns: 'data' is a group with a 1-D dataset for each dt_day field
+    (station_id, ymd, element, etc.), all with the same length.
+With the columns layout, a query that only needs some of the fields
+(e.g. data_value and element) reads just those columns.  Rows are in
+the same order in each column, so row numbers (and the indexes in
+ghcn_index) are the same for either layout.
+
+Either layout can use the compact encoding (dt_day_compact), where
+station_id, element and the three flags are stored as codes into the
+station_codes, element_codes and flag_codes tables, and ymd and obs_time
+as integers.  A ymd that isn't a valid date is stored in ymd_codes, so
+it reads back unchanged.  getDataTable
+returns a CompactTable for these files that converts to and from
+dt_day, so code that reads or writes dt_day rows works with either
+encoding.
+
+A sharded file has no top-level data table.  Instead, the shards group
+has a subgroup for each shard ("shards/0", "shards/1", ...) with its own
+data table, manifest and indexes.  Each year is stored in shard
+year % shard_count, so collectors writing different shards never write
+to the same dataset.  getDataTable returns a ShardTable for these files
+that reads the shards' tables as one table.
+'''
+
+import logging
+import numpy as np
+import h5pyd
+import h5py
+
+from ghcn_dtype import dt_day, dt_day_compact, dt_station_id, dt_element, dt_ymd, dt_flags
+from ghcn_parse import ymdToDays, daysToYmd, obsTimeToNum, numToObsTime
+
+LAYOUTS = ("table", "columns")
+ENCODINGS = ("string", "compact")
+CODE_CHUNKS = (16384,)
+DATA_CHUNKS = (91268,)
+SHARDS = "shards"
+# dt_day_compact column that each dt_day field is stored in
+COMPACT_COLUMNS = {'station_id': 'station', 'ymd': 'day', 'element': 'element', 'data_value': 'data_value',
+                   'm_flag': 'flags', 'q_flag': 'flags', 's_flag': 'flags', 'obs_time': 'obs_time'}
+FLAG_SHIFTS = {'m_flag': 16, 'q_flag': 8, 's_flag': 0}  # bit position of each flag in dt_flags
+MAX_CODES = {"element_codes": 256, "flag_codes": 65536}  # number of values a code can index
+
+
+class ColumnTable:
+    """ Presents a group of column datasets as one table of dt_day rows.
+    Supports the subset of the h5py Dataset interface used by the
+    collector: shape, dtype, chunks, attrs, resize, and slice reads and
+    writes. """
+
+    def __init__(self, grp, dtype=dt_day):
+        self.grp = grp
+        self.dtype = dtype
+        self.columns = {name: grp[name] for name in dtype.names}
+
+    @property
+    def shape(self):
+        return self.columns[self.dtype.names[0]].shape
+
+    @property
+    def chunks(self):
+        return self.columns[self.dtype.names[0]].chunks
+
+    @property
+    def attrs(self):
+        return self.grp.attrs
+
+    @property
+    def name(self):
+        return self.grp.name
+
+    def __len__(self):
+        return self.shape[0]
+
+    def resize(self, shape):
+        for column in self.columns.values():
+            column.resize(shape)
+
+    def hasColumns(self):
+        """ Return True if fields can be read without reading whole rows """
+        return True
+
+    def getColumn(self, name, sel=slice(None)):
+        """ Return the values of one field for the selection """
+        return self.columns[name][sel]
+
+    def __getitem__(self, sel):
+        if isinstance(sel, str):
+            # field name
+            return self.getColumn(sel)
+        arr = None
+        for name in self.dtype.names:
+            values = self.columns[name][sel]
+            if arr is None:
+                arr = np.zeros(np.shape(values), dtype=self.dtype)
+            arr[name] = values
+        if arr.shape == ():
+            return arr[()]
+        return arr
+
+    def __setitem__(self, sel, arr):
+        for name in self.dtype.names:
+            self.columns[name][sel] = arr[name]
+
+
+class CompactCodec:
+    """ Converts between dt_day and dt_day_compact rows.  Station,
+    element and flag codes are the positions of the values in the
+    station_codes, element_codes and flag_codes tables, and invalid ymd
+    values are stored in ymd_codes.  Values seen for the first time are
+    appended to these tables, so existing codes never change. """
+
+    def __init__(self, f):
+        self.f = f
+        self.tables = {}
+        for name, dt in (("station_codes", dt_station_id), ("element_codes", dt_element),
+                         ("flag_codes", dt_flags), ("ymd_codes", dt_ymd)):
+            if name in f:
+                values = f[name][...]
+            else:
+                values = np.zeros((0,), dtype=dt)
+            order = np.argsort(values)
+            self.tables[name] = {"values": values, "sorted": values[order], "codes": order}
+
+    def _encodeValues(self, name, values):
+        """ return codes for values, adding new values to the code table """
+        table = self.tables[name]
+        unique, inverse = np.unique(values, return_inverse=True)
+        pos = np.searchsorted(table["sorted"], unique)
+        pos = np.minimum(pos, max(len(table["sorted"]) - 1, 0))
+        if len(table["sorted"]) > 0:
+            known = table["sorted"][pos] == unique
+        else:
+            known = np.zeros((len(unique),), dtype=bool)
+        codes = np.zeros((len(unique),), dtype=np.int64)
+        codes[known] = table["codes"][pos[known]]
+        new_values = unique[~known]
+        if len(new_values) > 0:
+            if name not in self.f:
+                logging.info(f"Creating dataset: {name}")
+                self.f.create_dataset(name, (0,), maxshape=(None,), chunks=CODE_CHUNKS,
+                                      dtype=new_values.dtype)
+            dset = self.f[name]
+            first = dset.shape[0]
+            limit = MAX_CODES.get(name)
+            if limit is not None and first + len(new_values) > limit:
+                raise ValueError(f"too many values in {name} for compact encoding")
+            dset.resize((first + len(new_values),))
+            dset[first:] = new_values
+            logging.info(f"added {len(new_values)} values to {name}")
+            codes[~known] = np.arange(first, first + len(new_values))
+            values = np.concatenate((table["values"], new_values))
+            order = np.argsort(values)
+            self.tables[name] = {"values": values, "sorted": values[order], "codes": order}
+        return codes[inverse.reshape(-1)]
+
+    def encode(self, rows):
+        """ Return dt_day rows as dt_day_compact """
+        arr = np.zeros((len(rows),), dtype=dt_day_compact)
+        arr['station'] = self._encodeValues("station_codes", rows['station_id'])
+        days, valid = ymdToDays(rows['ymd'])
+        if not np.all(valid):
+            logging.warning(f"{len(valid) - np.count_nonzero(valid)} rows with invalid ymd, saved in ymd_codes")
+            days[~valid] = -1 - self._encodeValues("ymd_codes", rows['ymd'][~valid])
+        arr['day'] = days
+        arr['element'] = self._encodeValues("element_codes", rows['element'])
+        arr['data_value'] = rows['data_value']
+        flags = np.zeros((len(rows),), dtype=dt_flags)
+        for name, shift in FLAG_SHIFTS.items():
+            flags |= rows[name].view(np.uint8).astype(dt_flags) << shift
+        arr['flags'] = self._encodeValues("flag_codes", flags)
+        arr['obs_time'] = obsTimeToNum(rows['obs_time'])
+        return arr
+
+    def decodeColumn(self, name, values):
+        """ Return the values of the dt_day field name, given the values
+        of its dt_day_compact column (see COMPACT_COLUMNS) """
+        if name == 'station_id':
+            return self.tables["station_codes"]["values"][values]
+        if name == 'ymd':
+            ymd = daysToYmd(values)
+            invalid = values < 0
+            if np.any(invalid):
+                ymd[invalid] = self.tables["ymd_codes"]["values"][-1 - values[invalid]]
+            return ymd
+        if name == 'element':
+            return self.tables["element_codes"]["values"][values]
+        if name in FLAG_SHIFTS:
+            flags = self.tables["flag_codes"]["values"][values]
+            return ((flags >> FLAG_SHIFTS[name]) & 0xff).astype(np.uint8).view(dt_day[name])
+        if name == 'obs_time':
+            return numToObsTime(values)
+        return values
+
+    def decode(self, arr):
+        """ Return dt_day_compact rows as dt_day """
+        rows = np.zeros((len(arr),), dtype=dt_day)
+        for name in dt_day.names:
+            rows[name] = self.decodeColumn(name, arr[COMPACT_COLUMNS[name]])
+        return rows
+
+
+class CompactTable:
+    """ Presents a table of dt_day_compact rows as dt_day rows.  Reads
+    are decoded and writes are encoded using a CompactCodec.  Use
+    raw to get the stored values. """
+
+    def __init__(self, raw, codec):
+        self.raw = raw
+        self.codec = codec
+        self.dtype = dt_day
+
+    @property
+    def shape(self):
+        return self.raw.shape
+
+    @property
+    def chunks(self):
+        return self.raw.chunks
+
+    @property
+    def attrs(self):
+        return self.raw.attrs
+
+    @property
+    def name(self):
+        return self.raw.name
+
+    def __len__(self):
+        return self.shape[0]
+
+    def resize(self, shape):
+        self.raw.resize(shape)
+
+    def __getitem__(self, sel):
+        if isinstance(sel, str):
+            # field name
+            return self.codec.decode(self.raw[...])[sel]
+        arr = self.raw[sel]
+        if arr.shape == ():
+            return self.codec.decode(arr.reshape((1,)))[0]
+        return self.codec.decode(arr)
+
+    def __setitem__(self, sel, rows):
+        self.raw[sel] = self.codec.encode(rows)
+
+    def hasColumns(self):
+        """ Return True if fields can be read without reading whole rows """
+        return isinstance(self.raw, ColumnTable)
+
+    def getColumn(self, name, sel=slice(None)):
+        """ Return the decoded values of one dt_day field for the selection """
+        column = COMPACT_COLUMNS[name]
+        if self.hasColumns():
+            values = self.raw.getColumn(column, sel)
+        else:
+            values = self.raw[sel][column]
+        return self.codec.decodeColumn(name, values)
+
+
+class ShardTable:
+    """ Presents the data tables of a sharded file as one read-only table
+    of dt_day rows, with the rows of each shard after the rows of the
+    shard before it.  The size of each shard is read when the
+    ShardTable is created, so rows added later aren't included. """
+
+    def __init__(self, f):
+        self.grp = f[SHARDS]
+        self.dtype = dt_day
+        self.tables = [getDataTable(shard) for shard in getShardGroups(f)]
+        self.offsets = np.cumsum([0] + [table.shape[0] for table in self.tables])
+
+    @property
+    def shape(self):
+        return (int(self.offsets[-1]),)
+
+    @property
+    def chunks(self):
+        return self.tables[0].chunks
+
+    @property
+    def attrs(self):
+        return self.grp.attrs
+
+    @property
+    def name(self):
+        return self.grp.name
+
+    def __len__(self):
+        return self.shape[0]
+
+    def resize(self, shape):
+        raise ValueError("sharded data table is read-only, write to a shard's table")
+
+    def __setitem__(self, sel, rows):
+        raise ValueError("sharded data table is read-only, write to a shard's table")
+
+    def __getitem__(self, sel):
+        if isinstance(sel, str):
+            # field name
+            return np.concatenate([table[sel] for table in self.tables])
+        if sel is Ellipsis:
+            sel = slice(None)
+        if isinstance(sel, (int, np.integer)):
+            row = sel + len(self) if sel < 0 else sel
+            if row < 0 or row >= len(self):
+                raise IndexError(f"row {sel} out of range")
+            shard = np.searchsorted(self.offsets, row, side='right') - 1
+            return self.tables[shard][int(row - self.offsets[shard])]
+        start, stop, step = sel.indices(len(self))
+        if step != 1:
+            raise ValueError("only contiguous selections are supported")
+        parts = []
+        for table, offset, end in zip(self.tables, self.offsets[:-1], self.offsets[1:]):
+            first = max(start, offset)
+            last = min(stop, end)
+            if last > first:
+                parts.append(table[int(first - offset):int(last - offset)])
+        if not parts:
+            return np.zeros((0,), dtype=self.dtype)
+        return np.concatenate(parts)
+
+
+def isGroup(obj):
+    """ Return True if obj is a h5py or h5pyd Group """
+    return isinstance(obj, (h5py.Group, h5pyd.Group))
+
+
+def isSharded(f):
+    """ Return True if f is a sharded file """
+    return SHARDS in f
+
+
+def getShardCount(f):
+    """ Return the number of shards of f, or 0 if f isn't sharded """
+    if not isSharded(f):
+        return 0
+    return int(f[SHARDS].attrs["shard_count"])
+
+
+def getShardGroups(f):
+    """ Return the group of each shard of f, or [f] if f isn't sharded """
+    if not isSharded(f):
+        return [f]
+    grp = f[SHARDS]
+    return [grp[str(shard_id)] for shard_id in range(getShardCount(f))]
+
+
+def getShardGroup(f, shard_id):
+    """ Return the group of the given shard """
+    shard_count = getShardCount(f)
+    if shard_id < 0 or shard_id >= shard_count:
+        raise ValueError(f"no shard {shard_id} in file with {shard_count} shards")
+    return f[SHARDS][str(shard_id)]
+
+
+def getYearShard(year, shard_count):
+    """ Return the shard that stores the given year """
+    return year % shard_count
+
+
+def getYearGroup(f, year):
+    """ Return the group with the data for the given year: the shard
+    group for a sharded file, otherwise f """
+    if not isSharded(f):
+        return f
+    return getShardGroup(f, getYearShard(year, getShardCount(f)))
+
+
+def getDataTable(f, name="data"):
+    """ Return the data table, either the dataset or a ColumnTable for
+    the columns layout.  Compact tables are returned as a CompactTable,
+    and the shards of a sharded file as a ShardTable """
+    if name not in f and isSharded(f):
+        return ShardTable(f)
+    obj = f[name]
+    if isGroup(obj):
+        if "station" in obj:
+            table = ColumnTable(obj, dtype=dt_day_compact)
+        else:
+            table = ColumnTable(obj)
+    else:
+        table = obj
+    if table.dtype == dt_day_compact:
+        return CompactTable(table, CompactCodec(f))
+    return table
+
+
+def getEncoding(f, name="data"):
+    """ Return the encoding of the data table """
+    obj = f[name]
+    if isGroup(obj):
+        compact = "station" in obj
+    else:
+        compact = obj.dtype == dt_day_compact
+    return "compact" if compact else "string"
+
+
+def getLayout(f, name="data"):
+    """ Return the layout of the data table """
+    if isGroup(f[name]):
+        return "columns"
+    return "table"
+
+
+def getFilters(compression=None, compression_opts=None, shuffle=False):
+    """ Return create_dataset keyword arguments for the given filters """
+    kwargs = {}
+    if compression and compression != "none":
+        kwargs['compression'] = compression
+        if compression_opts is not None:
+            kwargs['compression_opts'] = compression_opts
+    if shuffle:
+        kwargs['shuffle'] = True
+    return kwargs
+
+
+def createDataTable(grp, name="data", layout="table", encoding="string", chunks=DATA_CHUNKS,
+                    compression=None, compression_opts=None, shuffle=False):
+    """ Create an empty data table with the given layout, encoding, chunk
+    shape and filters """
+    if layout not in LAYOUTS:
+        raise ValueError(f"unknown layout: {layout}")
+    if encoding not in ENCODINGS:
+        raise ValueError(f"unknown encoding: {encoding}")
+    dtype = dt_day_compact if encoding == "compact" else dt_day
+    kwargs = getFilters(compression=compression, compression_opts=compression_opts, shuffle=shuffle)
+    if layout == "table":
+        return grp.create_dataset(name, (0,), maxshape=(None,), chunks=chunks, dtype=dtype, **kwargs)
+    column_grp = grp.create_group(name)
+    for field in dtype.names:
+        column_grp.create_dataset(field, (0,), maxshape=(None,), chunks=chunks, dtype=dtype[field], **kwargs)
+    return ColumnTable(column_grp, dtype=dtype)
+
+
+def createShards(f, shard_count, **kwargs):
+    """ Create the shards group with a data table for each of shard_count
+    shards.  kwargs are passed to createDataTable. """
+    if shard_count < 1:
+        raise ValueError(f"invalid shard count: {shard_count}")
+    grp = f.create_group(SHARDS)
+    grp.attrs["shard_count"] = shard_count
+    for shard_id in range(shard_count):
+        shard = grp.create_group(str(shard_id))
+        createDataTable(shard, "data", **kwargs)
+    return grp
@@ -6,25 +6,36 @@ GHCN_update:
 Read GHCN csv files from S3, parse, and append to HDF GHCN table.
 '''
 
+import hashlib
 import time
 import logging
+import multiprocessing
+import queue
+import socket
 import sys
-import boto3
+import threading
+from collections import deque
 from botocore.exceptions import ClientError
 import numpy as np
 import h5pyd
 import h5py
 import config
+from ghcn_parse import parseRows, parseStations, countRows, skipRows, lineEnd
+from ghcn_s3 import getClient, getBlocks, isNotModified
+from ghcn_cache import getCache
+import ghcn_metrics as metrics
+from ghcn_index import updateStationIndex, compactStationIndex, getUnindexedRuns
+from ghcn_index import updateTimeIndex, getLastYear
+from ghcn_table import getDataTable, getShardCount, getShardGroup, getYearShard
+from ghcn_stations import updateStationGrid
+from ghcn_summary import updateSummaries, rebuildYearSummaries
 
-MIN_SHORT = -32768
-MAX_SHORT = 32767
+from ghcn_dtype import dt_day, dt_manifest, dt_block
 
-if __name__ == "__main__":
-    from ghcn_dtype import dt_day
-    from ghcn_dtype import dt_station
-else:
-    from .ghcn_dtype import dt_day
-    from ghcn_dtype import dt_station
+STATION_WRITE_GAP = 64  # unchanged stations rows between changed rows that are rewritten in one write
+BLOCK_HASH_CHUNKS = (4096,)
+WORKER_START_METHOD = "forkserver"  # start backfill workers without forking this (threaded) process
+WORKER_POLL_SECONDS = 1  # how often to check that a backfill worker is still running while waiting on it
 
 
 def h5File(path, mode='r'):
@@ -50,81 +61,214 @@ def h5File(path, mode='r'):
     return f
 
 def addRows(f, rows):
-    """ Add rows to table """
+    """ Add rows to table. rows is a dt_day array """
     count = len(rows)
     if count == 0:
         logging.warning("addRows - no rows to add!")
-        return
-    
-    arr = np.zeros((count,), dtype=dt_day)
-    for i in range(count):
-        row = rows[i]
-        fields = row.split(',')
-        if len(fields) != 8:
-            logging.warning(f"Expected 8 fields, skipping row:{i}")
-            continue
-        e = arr[i]
-        station_id = fields[0]
-        if len(station_id) != 11:
-            logging.warning(f"Unexpected length for station: {station_id}")
-        e['station_id'] = station_id
-        ymd = fields[1]
-        if len(ymd) != 8:
-            logging.warning(f"Unexpected length for ymd: {ymd}")
-        e['ymd'] = ymd
-        element = fields[2]
-        if len(element) != 4:
-            logging.warning(f"Unexpected length for elemenbt: {element}")
-        e['element'] = element
-        try:
-            data_value = int(fields[3])
-        except ValueError:
-            logging.warning(f"Unable to convert data_value to int: {fields[3]}")
-            data_value = -999
-        if data_value < MIN_SHORT:
-            logging.warning(f"Data value less than MIN_SHORT: {data_value}")
-            data_value = -999
-        if data_value > MAX_SHORT:
-            logging.warning(f"Data value greater than MAX_SHORT: {data_value}")
-            data_value = -999
-        e['data_value'] = data_value
-        m_flag = fields[4]
-        if len(m_flag) > 1:
-            logging.warning(f"Unexpected length of m_flag: {m_flag}")
-            m_flag = m_flag[0]
-        e['m_flag'] = m_flag
-        q_flag = fields[5]
-        if len(q_flag) > 1:
-            logging.warning(f"Unexpected length of q_flag: {q_flag}")
-            q_flag = q_flag[0]
-        e['q_flag'] = q_flag
-        s_flag = fields[6]
-        if len(s_flag) > 1:
-            logging.warning(f"Unexpected length of s_flag: {s_flag}")
-            s_flag = s_flag[0]
-        e['s_flag'] = s_flag
-        obs_time = fields[7]
-        if len(obs_time) > 4:
-            logging.warning(f"Unexpected length of obs_time: {obs_time}")
-            obs_time = obs_time[:4]
-        e['obs_time'] = obs_time
-        arr[i] = e
-
-    dset  = f['data']
+        return 0
+
+    dset  = getDataTable(f)
     next_row = dset.shape[0]
     logging.info(f"current shape: {dset.shape[0]}, adding: {count}")
     # Extend by num_rows
-    dset.resize((next_row+count,))
+    with metrics.timer("resize"):
+        dset.resize((next_row+count,))
     # Write array to extended area
-    dset[next_row:next_row+count] = arr
+    with metrics.timer("write"):
+        dset[next_row:next_row+count] = rows
+    metrics.inc("rows_added", count)
+
+    if config.get("station_index"):
+        with metrics.timer("station_index"):
+            updateStationIndex(f, rows, next_row)
+            if getUnindexedRuns(f) > config.get("station_index_merge_runs"):
+                compactStationIndex(f)
+    if config.get("time_index"):
+        with metrics.timer("time_index"):
+            updateTimeIndex(f, rows, next_row)
+    if config.get("summary_tables"):
+        with metrics.timer("summary"):
+            updateSummaries(f, rows)
     
     return count
 
+
+def writeRows(f, rows, manifests, blocks=()):
+    """ Add rows (or None) to the data table, then save the block hashes
+    and manifest entries for the rows """
+    if rows is not None:
+        addRows(f, rows)
+    with metrics.timer("manifest"):
+        if len(blocks) > 0:
+            setBlockHashes(f, blocks)
+        for manifest in manifests:
+            setManifest(f, manifest)
+
+
+class AsyncWriter:
+    """ Writes rows to the data table from a background thread, so the
+    next S3 range can be read and parsed while rows are written.  At
+    most max_pending writes are queued, and put blocks while the queue
+    is full.  Since writes are done in order by one thread, the manifest
+    entries of a write are only saved once its rows are written.  An
+    error in the writer thread is raised by the next put or close.
+    The file is shared with the calling thread, and an h5pyd File isn't
+    thread safe (its HTTP session has no lock), so the caller must only
+    use the file while no writes are queued (see wait). """
+
+    def __init__(self, f, max_pending):
+        self.f = f
+        self.queue = queue.Queue(maxsize=max(max_pending, 1))
+        self.error = None
+        self.thread = threading.Thread(target=self._run, name="writer", daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                self.queue.task_done()
+                break
+            try:
+                if self.error is None:
+                    # don't write anything after a failed write
+                    writeRows(self.f, *item)
+            except Exception as e:
+                logging.error(f"writer thread error: {e}")
+                self.error = e
+            finally:
+                self.queue.task_done()
+
+    def _checkError(self):
+        if self.error is not None:
+            raise self.error
+
+    def put(self, rows, manifests, blocks=()):
+        """ Queue rows (or None) and the block hashes and manifest entries
+        to save after them, waiting if the queue is full """
+        self._checkError()
+        with metrics.timer("write_wait"):
+            self.queue.put((rows, manifests, blocks))
+
+    def wait(self):
+        """ Wait for queued writes to finish """
+        with metrics.timer("write_wait"):
+            self.queue.join()
+        self._checkError()
+
+    def close(self):
+        """ Wait for queued writes to finish and stop the thread """
+        if self.thread.is_alive():
+            self.queue.put(None)
+            self.thread.join()
+        self._checkError()
+
+
+class RowBuffer:
+    """ Collects parsed rows and writes them to the data table with
+    one resize per flush.  Writes end on a chunk boundary where
+    possible, with the remaining rows held for the next flush.
+    Manifest entries are saved only once all the rows they cover
+    have been written.  If writer (an AsyncWriter) is given, writes
+    are done by its thread.
+
+    A write that ends on a chunk boundary can leave rows past the last
+    saved manifest entry if a later write fails or the collector stops.
+    An update reads the years in the same order as the one before it,
+    so the first rows added are those rows, and they're skipped rather
+    than written again. """
+
+    def __init__(self, f, max_rows, writer=None):
+        self.f = f
+        self.max_rows = max(max_rows, 1)
+        self.writer = writer
+        self.blocks = []
+        self.count = 0
+        self.manifests = []  # list of (buffer row count, manifest entry, block hash or None)
+        dset = getDataTable(f)
+        self.chunk_rows = dset.chunks[0] if dset.chunks else None
+        # where the next flush is written, including rows still queued for the writer
+        self.next_row = dset.shape[0]
+        # rows at the end of the table written without their manifest entry
+        self.unsaved = 0
+        blocks_end = getBlocksEnd(f)
+        if blocks_end is not None and self.next_row > blocks_end:
+            self.unsaved = self.next_row - blocks_end
+            logging.warning(f"{self.unsaved} rows written after the last manifest entry, "
+                            "these rows will be skipped")
+
+    def add(self, rows, manifest, block=None):
+        """ Add a dt_day array and the manifest entry for the year
+        after these rows are written.  If given, block (a dt_block entry
+        for the lines the rows were parsed from) is saved with the
+        manifest entry, with start_row set to where the rows are written. """
+        if block is not None:
+            block = block.copy()
+            block['start_row'] = self.next_row + self.count - self.unsaved
+        if self.unsaved > 0 and len(rows) > 0:
+            # already in the data table
+            skip = min(self.unsaved, len(rows))
+            rows = rows[skip:]
+            self.unsaved -= skip
+        if len(rows) > 0:
+            self.blocks.append(rows)
+            self.count += len(rows)
+        self.manifests.append((self.count, manifest, block))
+        if self.count >= self.max_rows:
+            self.flush(final=False)
+
+    def flush(self, final=True):
+        """ Write buffered rows.  Unless final is set, only rows up to
+        the last complete chunk are written. """
+        count = self.count
+        if not final and self.chunk_rows:
+            end_row = self.next_row + count
+            aligned = count - end_row % self.chunk_rows
+            if aligned > 0:
+                count = aligned
+        rows = None
+        if count > 0:
+            buffered = np.concatenate(self.blocks)
+            rows = buffered[:count]
+            self.blocks = [buffered[count:]]
+            self.count -= count
+            self.next_row += count
+
+        # save the latest manifest entry of each year that has been written
+        committed = {}
+        blocks = []
+        while self.manifests and self.manifests[0][0] <= count:
+            _, manifest, block = self.manifests.pop(0)
+            committed[int(manifest['year'])] = manifest
+            if block is not None:
+                blocks.append(block)
+        self.manifests = [(n - count, m, b) for n, m, b in self.manifests]
+        if rows is None and not committed:
+            return
+        if self.writer is None:
+            writeRows(self.f, rows, list(committed.values()), blocks)
+        else:
+            self.writer.put(rows, list(committed.values()), blocks)
+
+    def wait(self):
+        """ Write all buffered rows and wait until they are in the data
+        table """
+        self.flush()
+        self.sync()
+
+    def sync(self):
+        """ Wait for queued writes to finish, so the file can be read
+        from this thread.  Buffered rows aren't written. """
+        if self.writer is not None:
+            self.writer.wait()
+
 def getRowMarker(f, year):
     """ Get the row marker for given year 
     (where the most recent update left off) and return. 
-    Returns 0 if doesn't exist.  """
-    dset = f['data']
+    Returns 0 if doesn't exist.  The row marker has been replaced
+    by the manifest table, but is still used for files created
+    before the manifest. """
+    dset = getDataTable(f)
     marker = 0
     if "_row_marker" in dset.attrs:
         row_marker = dset.attrs["_row_marker"]
@@ -134,13 +278,103 @@ def getRowMarker(f, year):
         
     return marker
 
-def setRowMarker(f, year, row):
-    """ Set the row marker year and row.  Will over-write
-    any existing value. """
-    dset = f['data']
-    if "_row_marker" in dset.attrs:
-        del dset.attrs["_row_marker"]
-    dset.attrs["_row_marker"] = [year, row]
+def getManifest(f, year):
+    """ Get the manifest entry for the given year (how far the year's CSV
+    file has been ingested).  Returns an entry with byte_offset and
+    row_count of 0 if the year isn't in the manifest. """
+    if "manifest" in f:
+        arr = f["manifest"][...]
+        index = np.flatnonzero(arr['year'] == year)
+        if len(index) > 0:
+            entry = np.zeros((1,), dtype=dt_manifest)[0]
+            for name in arr.dtype.names:
+                entry[name] = arr[index[0]][name]
+            return entry
+    entry = np.zeros((1,), dtype=dt_manifest)[0]
+    entry['year'] = year
+    return entry
+
+def getLastManifestYear(f):
+    """ Return the most recent year that has been (at least partly)
+    ingested according to the manifest, or None """
+    if "manifest" not in f:
+        return None
+    arr = f["manifest"][...]
+    arr = arr[arr['row_count'] > 0]
+    if len(arr) == 0:
+        return None
+    return int(arr['year'].max())
+
+def getManifestYears(f):
+    """ Return the years that have been (at least partly) ingested
+    according to the manifest, in order """
+    if "manifest" not in f:
+        return []
+    arr = f["manifest"][...]
+    return sorted(int(year) for year in arr['year'][arr['row_count'] > 0])
+
+def setManifest(f, entry):
+    """ Add or update the manifest entry for entry['year'] """
+    if "manifest" not in f:
+        logging.info("Creating dataset: manifest")
+        f.create_dataset("manifest", (0,), maxshape=(None,), chunks=(1024,), dtype=dt_manifest)
+    dset = f["manifest"]
+    arr = dset[...]
+    index = np.flatnonzero(arr['year'] == entry['year'])
+    if len(index) > 0:
+        index = index[0]
+    else:
+        index = dset.shape[0]
+        dset.resize((index+1,))
+    dset[index:index+1] = np.array([entry], dtype=dt_manifest)
+
+def getBlockHashes(f, year):
+    """ Return the block hashes (dt_block array) saved for the given
+    year, sorted by line_start """
+    if "block_hashes" not in f:
+        return np.zeros((0,), dtype=dt_block)
+    arr = f["block_hashes"][...]
+    arr = arr[arr['year'] == year]
+    return arr[np.argsort(arr['line_start'], kind='stable')]
+
+def getBlocksEnd(f):
+    """ Return the data table row after the rows of the saved block
+    hashes, or None if no block hashes are saved """
+    if "block_hashes" not in f:
+        return None
+    arr = f["block_hashes"][...]
+    if len(arr) == 0:
+        return None
+    return int((arr['start_row'].astype(np.int64) + arr['row_count']).max())
+
+def setBlockHashes(f, blocks):
+    """ Add block hashes, replacing any saved for the same year and
+    line_start """
+    blocks = np.array(blocks, dtype=dt_block)
+    if "block_hashes" not in f:
+        logging.info("Creating dataset: block_hashes")
+        f.create_dataset("block_hashes", (0,), maxshape=(None,), chunks=BLOCK_HASH_CHUNKS, dtype=dt_block)
+    dset = f["block_hashes"]
+    arr = dset[...]
+    keys = arr['year'].astype(np.int64) << 48 | arr['line_start']
+    new_keys = blocks['year'].astype(np.int64) << 48 | blocks['line_start']
+    found = np.zeros((len(blocks),), dtype=bool)
+    if len(keys) > 0:
+        order = np.argsort(keys)
+        pos = np.minimum(np.searchsorted(keys[order], new_keys), len(keys) - 1)
+        indexes = order[pos]
+        found = keys[indexes] == new_keys
+        for index, block in zip(indexes[found], blocks[found]):
+            dset[index:index+1] = np.array([block], dtype=dt_block)
+    added = blocks[~found]
+    if len(added) > 0:
+        num_blocks = dset.shape[0]
+        dset.resize((num_blocks + len(added),))
+        dset[num_blocks:] = added
+
+def hashBlock(text):
+    """ Return the hash of a block of CSV text as saved in block_hashes """
+    return hashlib.blake2b(text, digest_size=16).hexdigest().encode('ascii')
 
 def getStationEtag(f):
     """ Get the etag for the station CSV file when
@@ -160,11 +394,26 @@ def setStationEtag(f, etag):
     dset.attrs["_etag"] = etag
 
 
-def addYearData(f, year):
-    """Get data for given year and add to table"""
-    logging.info(f"addYearData: {year}")
-    return_rows = 0
-    range_start = 0
+def readYearData(year, manifest=None, row_marker=0):
+    """Generator - get data for the given year from S3 and return
+    (rows, manifest, block) for each chunk read, where rows is a dt_day
+    array, manifest is the updated manifest entry for the year, and block
+    is a dt_block entry with the hash of the lines parsed.  Reading
+    starts at the byte offset given by the manifest entry.  Lines
+    before row_marker are skipped (for files without a manifest).
+    If the file was rewritten rather than appended to (the etag changed,
+    but the file didn't grow), (None, manifest, None) is returned with
+    the new etag and content length, and nothing is read: the caller
+    should reconcile the year with reconcileYear.  S3 errors other than
+    a missing file are raised, so a year that couldn't be read isn't
+    taken for a year with no more data."""
+    if manifest is None:
+        manifest = np.zeros((1,), dtype=dt_manifest)[0]
+        manifest['year'] = year
+    else:
+        manifest = manifest.copy()
+    range_start = int(manifest['byte_offset'])
+    rows_read = int(manifest['row_count'])
     block_size = config.get("block_size")
     # expected lines:
     #  b'ASN00008050,18770101,PRCP,0,,,a,\n
@@ -172,130 +421,577 @@ def addYearData(f, year):
     s3_path = config.get("ghcn_path")
     s3_key = f"{s3_path}{year}.csv"
 
-    # get the last row processed for the given year
-    row_marker = getRowMarker(f, year)
-    logging.info(f"got row_marker: {year}/{row_marker}")
-
-    rows_read = 0
-
-    #s3 = boto3.ressource('s3')
-    s3 = boto3.client('s3', aws_access_key_id='', aws_secret_access_key='')
-    s3._request_signer.sign = (lambda *args, **kwargs: None)
+    s3 = getClient()
+    kwargs = {}
+    etag = manifest['etag'].decode('ascii')
+    if etag and 0 < manifest['content_length'] <= manifest['byte_offset']:
+        # year was completely loaded, only continue if the object changed
+        kwargs['IfNoneMatch'] = etag
     content_length = 0
     try:
         # Do HEAD request to verify key exist and get size
-        rsp = s3.head_object(Bucket=s3_bucket, Key=s3_key)
+        with metrics.timer("s3_head"):
+            rsp = s3.head_object(Bucket=s3_bucket, Key=s3_key, **kwargs)
         content_length = rsp['ContentLength']
+        etag = rsp['ETag']
     except ClientError as ce:
+        if isNotModified(ce):
+            logging.info(f"no change to {s3_key}")
+            return
         if ce.response['Error']['Code'] == 'NoSuchKey':
             logging.warning(f"key: {s3_key} not found")
-            return 0
+            return
+        # not a missing year: don't let the caller move on to the next one
+        raise
 
     logging.debug(f"content length for {s3_key}: {content_length}")
     if content_length == 0:
         logging.warning(f"no content for  {s3_key}, returning")
-        return 0
+        return
+    rewritten = False
+    if etag == manifest['etag'].decode('ascii') and content_length == manifest['content_length']:
+        if range_start >= content_length:
+            logging.info(f"no change to {s3_key}")
+            return
+    elif manifest['etag'] and content_length <= manifest['content_length']:
+        # GHCN only appends to the year files, so an object that changed
+        # without growing had earlier lines corrected
+        rewritten = True
+    elif content_length <= range_start:
+        logging.warning(f"{s3_key} changed but has no new content after byte: {range_start}")
+        return
+    manifest['etag'] = etag
+    manifest['content_length'] = content_length
+    manifest['last_modified'] = rsp['LastModified'].timestamp()
+    if rewritten:
+        logging.warning(f"{s3_key} was rewritten, {content_length} bytes (was {range_start} loaded)")
+        metrics.inc("files_rewritten")
+        yield None, manifest.copy(), None
+        return
     
-    while True:
-        range_end = range_start + block_size
-        if range_end > content_length:
-            range_end = content_length
-        if range_end - range_start <= 0:
-            logging.info("no more bytes to read")
-            break
-
-        s3_range = f"bytes={range_start}-{range_end}"
-        logging.info(f"s3_range: {s3_range}")
-        ghcn_text = None
-        try:
-            rsp = s3.get_object(Bucket=s3_bucket, Key=s3_key, Range=s3_range)
-            body = rsp['Body']
-            ghcn_text = body.read()
-        except ClientError as ce:
-            error_code = ce.response['Error']['Code']
-            if error_code == "InvalidRange":
-                logging.info(f"exceeded range for s3_range: {s3_range}")
-            else:
-                logging.error(f"ClientError: {ce.response['Error']['Code']} for s3_range: {s3_range}")
-        
-        if not ghcn_text:
-            logging.info("no bytes read")
-            break
-        ghcn_text = ghcn_text.decode('ascii')        
+    concurrency = config.get("fetch_concurrency")
+    prefetch = config.get("prefetch_depth")
+    chunk_size = config.get("stream_chunk_size")
+    blocks = getBlocks(s3, s3_bucket, s3_key, range_start, content_length,
+                       block_size, concurrency=concurrency, prefetch=prefetch,
+                       etag=etag, chunk_size=chunk_size, cache=getCache())
+    last_row = b''
+    for ghcn_text in blocks:
         num_bytes = len(ghcn_text)
         logging.info(f"read {num_bytes} bytes")
-        rows = ghcn_text.split('\n')
-        last_row = rows[-1]
-        fields = last_row.split(',')
         range_start += num_bytes
-        if len(fields) < 8:
-            # back up to the last \n so we get full text line.  
-            range_start -= len(last_row)
-            rows = rows[:-1]
+        # prepend any partial line left over from the previous block
+        ghcn_text = last_row + ghcn_text
+        last_row = b''
+        if range_start < content_length:
+            # hold back text after the last \n so we get full text lines.
+            index = ghcn_text.rfind(b'\n') + 1
+            last_row = ghcn_text[index:]
+            ghcn_text = ghcn_text[:index]
 
-        rows_read += len(rows)
+        num_rows = countRows(ghcn_text)
+        rows_read += num_rows
 
-        if len(rows) == 0:
-            logging.debug("no rows read, breaking")
-            break
+        if num_rows == 0:
+            logging.debug("no complete rows in block")
+            continue
 
         # If the current set of rows overlaps with rows we've
         # already read, just process the remaining rows.
         # Example:
         # row_marker = 101
         # rows_read = 110
-        # len(rows) = 10
-        # rows = rows[1:]
-        # index = len(rows) + row_maker - rows_read
-        # rows = rows[index:]
+        # num_rows = 10
+        # skip = num_rows + row_marker - rows_read = 1
         if rows_read > row_marker:
-            if rows_read - len(rows) < row_marker:
+            if rows_read - num_rows < row_marker:
                 # remove rows we've already processed
-                index = len(rows) + row_marker - rows_read
-                rows = rows[index:]
-            logging.info("adding {len(rows)} rows")
-            addRows(f, rows)
+                skip = num_rows + row_marker - rows_read
+                ghcn_text = skipRows(ghcn_text, skip)
+            start_time = time.time()
+            with metrics.timer("parse"):
+                rows = parseRows(ghcn_text)
+            elapsed = time.time() - start_time
+            metrics.inc("rows_parsed", len(rows))
+            if elapsed > 0:
+                logging.info(f"parsed {len(rows)} rows - rows/sec: {int(len(rows)/elapsed)}")
+            manifest['byte_offset'] = range_start - len(last_row)
+            manifest['row_count'] = rows_read
+            block = np.zeros((1,), dtype=dt_block)[0]
+            block['year'] = year
+            block['line_count'] = countRows(ghcn_text)
+            block['line_start'] = rows_read - block['line_count']
+            block['row_count'] = len(rows)
+            block['hash'] = hashBlock(ghcn_text)
+            yield rows, manifest.copy(), block
+            row_marker = rows_read
 
-            return_rows += len(rows)    
 
-            setRowMarker(f, year, rows_read)    
-            row_marker = rows_read
+def _rewriteRows(f, rows, start_row):
+    """ Write rows over the data table rows from start_row, and return
+    the number of rows that changed.  Only the span from the first to the
+    last changed row is written. """
+    dset = getDataTable(f)
+    end_row = start_row + len(rows)
+    old_rows = dset[start_row:end_row]
+    changed = np.flatnonzero(old_rows != rows)
+    if len(changed) == 0:
+        return 0
+    moved = (old_rows['station_id'] != rows['station_id']) | (old_rows['ymd'] != rows['ymd'])
+    if np.any(moved):
+        logging.warning(f"station_id or ymd changed in rows {start_row}-{end_row}, "
+                        "the station and time indexes should be rebuilt (ghcn_index.py --rebuild)")
+    first, last = changed[0], changed[-1] + 1
+    with metrics.timer("write"):
+        dset[start_row+first:start_row+last] = rows[first:last]
+    return len(changed)
+
+
+def reconcileYear(f, year, manifest, buffer):
+    """ Update the rows of a year whose CSV file was rewritten.  manifest
+    is the entry returned by readYearData for the rewritten file.  The
+    file is read and split into the blocks of lines saved in block_hashes,
+    and only the blocks whose hash changed are parsed and written over
+    the rows they were loaded to.  Lines after the last block are added
+    as new rows.  Returns the number of rows added. """
+    logging.info(f"reconcileYear: {year}")
+    # rewritten rows may still be in the buffer or queued for the writer
+    buffer.wait()
+    old_blocks = getBlockHashes(f, year)
+    if len(old_blocks) == 0:
+        # loaded before block hashes were saved: keep the loaded rows, but
+        # save the new etag so the rewrite isn't found again on every update
+        logging.warning(f"no block hashes for {year}, can't reconcile the rewritten file, rows are unchanged")
+        manifest = manifest.copy()
+        manifest['byte_offset'] = min(int(manifest['byte_offset']), int(manifest['content_length']))
+        buffer.add(np.zeros((0,), dtype=dt_day), manifest)
+        return 0
+
+    s3_bucket = config.get("ghcn_bucket")
+    s3_key = f"{config.get('ghcn_path')}{year}.csv"
+    content_length = int(manifest['content_length'])
+    etag = manifest['etag'].decode('ascii')
+    blocks = getBlocks(getClient(), s3_bucket, s3_key, 0, content_length, config.get("block_size"),
+                       concurrency=config.get("fetch_concurrency"), prefetch=config.get("prefetch_depth"),
+                       etag=etag, chunk_size=config.get("stream_chunk_size"), cache=getCache())
+    changed_blocks = []
+    rows_changed = 0
+    line_pos = 0  # lines read from the file
+    byte_pos = 0  # bytes of the lines read
+    pending = b''
+    bytes_read = 0
+    index = 0
+    eof = False
+    while index < len(old_blocks):
+        block = old_blocks[index]
+        skip = int(block['line_start']) - line_pos
+        line_count = int(block['line_count'])
+        end = lineEnd(pending, skip + line_count)
+        if end is None and not eof:
+            ghcn_text = next(blocks, None)
+            if ghcn_text is None:
+                eof = True
+            else:
+                pending += ghcn_text
+                bytes_read += len(ghcn_text)
+            continue
+        start = lineEnd(pending, skip)
+        if end is None:
+            # the file ends within this block, compare what's left
+            end = len(pending)
+            if start is None or start >= end:
+                break
+        ghcn_text = pending[start:end]
+        line_pos += skip + countRows(ghcn_text)
+        byte_pos += end
+        pending = pending[end:]
+        index += 1
+        block_hash = hashBlock(ghcn_text)
+        if block_hash == block['hash']:
+            continue
+        with metrics.timer("parse"):
+            rows = parseRows(ghcn_text)
+        count = min(len(rows), int(block['row_count']))
+        if len(rows) != block['row_count']:
+            logging.warning(f"{s3_key} lines {block['line_start']}-{block['line_start'] + line_count} "
+                            f"now have {len(rows)} rows, was {block['row_count']}, only {count} rows updated")
+        rows_changed += _rewriteRows(f, rows[:count], int(block['start_row']))
+        block = block.copy()
+        block['hash'] = block_hash
+        changed_blocks.append(block)
+    blocks.close()
+    if eof and bytes_read < content_length:
+        # the file is shorter than its HEAD said (changed again while being
+        # read), leave the manifest and block hashes so the next update retries
+        logging.error(f"{s3_key} read stopped at byte {bytes_read} of {content_length}")
+        return 0
+    if index < len(old_blocks):
+        logging.warning(f"{s3_key} has {line_pos} lines, rows loaded from later lines are unchanged")
+
+    manifest = manifest.copy()
+    manifest['byte_offset'] = byte_pos
+    manifest['row_count'] = line_pos
+    if changed_blocks:
+        setBlockHashes(f, changed_blocks)
+        if config.get("summary_tables"):
+            with metrics.timer("summary"):
+                rebuildYearSummaries(f, year)
+    setManifest(f, manifest)
+    metrics.inc("rows_reconciled", rows_changed)
+    logging.info(f"reconcileYear {year} - {len(changed_blocks)} of {len(old_blocks)} blocks changed, "
+                 f"{rows_changed} rows updated")
+
+    # add any lines after the blocks that were loaded
+    return_rows = 0
+    for rows, manifest, block in readYearData(year, manifest=manifest):
+        if rows is None:
+            break
+        buffer.add(rows, manifest, block)
+        return_rows += len(rows)
+    return return_rows
+
+
+def addYearData(f, year, buffer=None):
+    """Get data for given year and add to table.  If buffer is given,
+    rows are added to the buffer and written when it flushes."""
+    logging.info(f"addYearData: {year}")
+    return_rows = 0
+    flush = buffer is None
+    if buffer is None:
+        buffer = RowBuffer(f, getWriteBufferRows())
+    else:
+        # the writer thread may still be writing the previous year
+        buffer.sync()
+
+    # get the byte offset and row count where the last update left off
+    manifest = getManifest(f, year)
+    row_marker = 0
+    if manifest['row_count'] == 0:
+        # no manifest entry, fall back to the row marker if set
+        row_marker = getRowMarker(f, year)
+    logging.info(f"got manifest: {year}/{manifest['byte_offset']}/{manifest['row_count']}, row_marker: {row_marker}")
+
+    try:
+        for rows, manifest, block in readYearData(year, manifest=manifest, row_marker=row_marker):
+            if rows is None:
+                return_rows += reconcileYear(f, year, manifest, buffer)
+                continue
+            logging.info(f"adding {len(rows)} rows")
+            buffer.add(rows, manifest, block)
+            return_rows += len(rows)
+    except Exception:
+        if flush:
+            flushAfterError(buffer)
+        raise
+    if flush:
+        buffer.flush()
     
     logging.info(f"addYearData {year} - return_rows: {return_rows}")
 
     return return_rows
 
 
-def getData(f):
-    """ update data table with latest GHCN content """
-    data_dset = f["data"]
+def flushAfterError(buffer):
+    """ Write the rows buffered before a read error, so the data table
+    ends at the last manifest entry rather than at a chunk boundary past
+    it. """
+    try:
+        buffer.flush()
+    except Exception as e:
+        logging.error(f"couldn't write buffered rows: {e}")
+
+
+def getWriteBufferRows():
+    """ Return the number of rows that fit in write_buffer_size """
+    return config.get("write_buffer_size") // dt_day.itemsize
+
+
+def fetchYearData(year, results):
+    """ Put ("rows", (rows, manifest, block)) in the results queue for each
+    block of the given year, then ("done", metrics for reading it), or
+    ("error", message) if the year couldn't be read.  Run by the backfill
+    worker processes.  results is bounded, so a worker waits while the
+    parent is busy with earlier years. """
+    metrics.resetMetrics()
+    try:
+        for item in readYearData(year):
+            results.put(("rows", item))
+    except Exception as e:
+        logging.error(f"fetchYearData {year} failed: {e}")
+        results.put(("error", str(e)))
+        return
+    results.put(("done", metrics.getMetrics()))
+
+
+def getYearResults(year, process, results):
+    """ Generator - return the items that fetchYearData puts in results,
+    until the year is done """
+    while True:
+        try:
+            kind, value = results.get(timeout=WORKER_POLL_SECONDS)
+        except queue.Empty:
+            if not process.is_alive() and results.empty():
+                raise RuntimeError(f"backfill worker for {year} exited with code {process.exitcode}")
+            continue
+        if kind == "error":
+            raise RuntimeError(f"backfill worker for {year} failed: {value}")
+        if kind == "done":
+            metrics.mergeMetrics(value)
+            return
+        yield value
+
+
+def getData(f, shard_id=0, shard_count=1):
+    """ update data table with latest GHCN content.  For a shard of a
+    sharded file, f is the shard's group and only the years in the
+    shard (year % shard_count == shard_id) are added. """
+    data_dset = getDataTable(f)
     num_rows = data_dset.shape[0]
     if num_rows == 0:
-        # empty, start at first year
+        # empty, start at first year (of this shard)
         year = config.get("start_year")
+        year += (shard_id - year) % shard_count
         logging.info(f"no data, starting at year: {year}")
     else:
-        last_row = data_dset[-1]
-        ymd = last_row["ymd"]
-        year = int(ymd[:4])
+        # the manifest records the years ingested, while the year index
+        # would follow any row with a bad (future) date
+        year = getLastManifestYear(f)
+        if year is None:
+            # file created before the manifest, use the year index
+            year = getLastYear(f)
+        if year is None:
+            # no time index, use the last row
+            last_row = data_dset[-1]
+            ymd = last_row["ymd"]
+            year = int(ymd[:4])
         logging.info(f"most recent year: {year}")
 
+    writer = None
+    write_queue_depth = config.get("write_queue_depth")
+    if write_queue_depth > 0:
+        writer = AsyncWriter(f, write_queue_depth)
+    buffer = RowBuffer(f, getWriteBufferRows(), writer=writer)
+    try:
+        total_added = checkYears(f, year, buffer)
+        workers = config.get("backfill_workers")
+        if workers > 1:
+            total_added += getDataParallel(f, year, workers, buffer, step=shard_count)
+        else:
+            total_added += getDataSerial(f, year, buffer, step=shard_count)
+    except Exception:
+        flushAfterError(buffer)
+        raise
+    else:
+        buffer.flush()
+    finally:
+        if writer is not None:
+            # wait for queued rows (and their manifest entries) to be written
+            writer.close()
+
+    return total_added
+
+
+def checkYears(f, year, buffer):
+    """ Check the years ingested before year for changes to their CSV
+    files.  Each check is a HEAD request that returns 304 (not modified)
+    unless the file changed; a rewritten file is reconciled and rows
+    appended to a file are added.  Returns the number of rows added. """
+    total_added = 0
+    for check_year in getManifestYears(f):
+        if check_year < year:
+            total_added += addYearData(f, check_year, buffer=buffer)
+    return total_added
+
+
+def getDataSerial(f, year, buffer, step=1):
+    """ update data table starting with the given year (and every step
+    years after it) """
     total_added = 0
     last_year = -1
     while True:
         if year >= config.get("last_year"):
             # completed desired year range
             break
-        this_year = addYearData(f, year)
+        this_year = addYearData(f, year, buffer=buffer)
         total_added += this_year
         if last_year == 0 and this_year == 0:
             # no data for this year or last, quit
             break
         last_year = this_year
-        year += 1
+        year += step
 
     return total_added
 
+
+def getDataParallel(f, year, workers, buffer, step=1):
+    """ update data table starting with the given year, fetching and
+    parsing the following years (every step years) in worker processes,
+    one per year.  Rows are still added in year order.  Each worker sends
+    its rows a block at a time through a queue holding up to
+    write_buffer_size / workers of rows, so the queues hold about
+    write_buffer_size of parsed rows however many workers there are. """
+    logging.info(f"getDataParallel - starting at {year} with {workers} workers")
+    # the first year may be partially loaded, so use the row marker
+    total_added = 0
+    last_year = -1
+    if year < config.get("last_year"):
+        last_year = addYearData(f, year, buffer=buffer)
+        total_added += last_year
+        year += step
+
+    queue_depth = max(getWriteBufferRows() * dt_day.itemsize // (config.get("block_size") * workers), 1)
+    # the writer, metrics and S3 prefetch threads are already running, and a
+    # forked child could inherit a lock held by one of them
+    ctx = multiprocessing.get_context(WORKER_START_METHOD)
+    if WORKER_START_METHOD == "forkserver":
+        # import the collector once in the fork server rather than in each worker
+        ctx.set_forkserver_preload(["ghcn_update"])
+    pending = deque()  # (year, process, results queue)
+    next_year = year
+    try:
+        while True:
+            # keep one year in progress per worker
+            while len(pending) < workers and next_year < config.get("last_year"):
+                results = ctx.Queue(maxsize=queue_depth)
+                process = ctx.Process(target=fetchYearData, args=(next_year, results),
+                                      name=f"fetch-{next_year}", daemon=True)
+                process.start()
+                pending.append((next_year, process, results))
+                next_year += step
+            if not pending:
+                # completed desired year range
+                break
+            year, process, results = pending[0]
+            this_year = 0
+            for rows, manifest, block in getYearResults(year, process, results):
+                if rows is None:
+                    this_year += reconcileYear(f, year, manifest, buffer)
+                    continue
+                logging.info(f"adding {len(rows)} rows for year {year}")
+                buffer.add(rows, manifest, block)
+                this_year += len(rows)
+            pending.popleft()
+            process.join()
+            logging.info(f"getDataParallel {year} - return_rows: {this_year}")
+            total_added += this_year
+            if last_year == 0 and this_year == 0:
+                # no data for this year or last, quit
+                break
+            last_year = this_year
+    finally:
+        for _, process, _ in pending:
+            process.terminate()
+            process.join()
+
+    return total_added
+
+def getShardId():
+    """ Return the shard this collector writes, from the shard_id config,
+    or else the ordinal at the end of the hostname (e.g. 2 for the
+    StatefulSet pod ghcn-2) """
+    shard_id = config.get("shard_id")
+    if shard_id is None:
+        hostname = socket.gethostname()
+        ordinal = hostname.rsplit('-', 1)[-1]
+        if not ordinal.isdigit():
+            raise ValueError(f"shard_id not set and no ordinal in hostname: {hostname}")
+        shard_id = ordinal
+    return int(shard_id)
+
+
+def getShard(f):
+    """ Return (group, shard_id, shard_count) for the part of f written by
+    this collector: the shard's group for a sharded file, otherwise
+    (f, 0, 0) """
+    shard_count = getShardCount(f)
+    if shard_count == 0:
+        return f, 0, 0
+    shard_id = getShardId()
+    return getShardGroup(f, shard_id), shard_id, shard_count
+
+
+def followYear(filename, duration):
+    """ Add rows appended to the current year's CSV file until duration
+    seconds have passed.  The file is checked every tail_interval
+    seconds with a HEAD request (see readYearData), and only the bytes
+    past the manifest's byte offset are read.  After each check with no
+    new rows the interval doubles, up to tail_max_interval. """
+    end_time = time.time() + duration
+    interval = config.get("tail_interval")
+    year = time.gmtime().tm_year
+    with h5File(filename, mode='r') as f:
+        shard_count = getShardCount(f)
+    if shard_count > 0 and getYearShard(year, shard_count) != getShardId():
+        # another shard has the current year
+        logging.info(f"current year {year} is in another shard, sleeping for {duration} seconds")
+        time.sleep(duration)
+        return
+    logging.info(f"following {year} every {interval} seconds")
+    while True:
+        wait = min(interval, end_time - time.time())
+        if wait <= 0:
+            break
+        time.sleep(wait)
+        year = time.gmtime().tm_year
+        if year >= config.get("last_year"):
+            break
+        with h5File(filename, mode='a') as f:
+            grp, _, _ = getShard(f)
+            nrows = addYearData(grp, year)
+        metrics.inc("tail_polls")
+        if nrows > 0:
+            logging.info(f"followYear - added {nrows} rows for {year}")
+            metrics.inc("tail_rows_added", nrows)
+            interval = config.get("tail_interval")
+        else:
+            interval = min(interval * 2, config.get("tail_max_interval"))
+            logging.debug(f"followYear - no new rows, next check in {interval} seconds")
+
+
+def updateStations(dset, arr):
+    """ Write the stations in arr that are new or have changed to the
+    stations table.  Existing stations keep their row and new stations
+    are added at the end.  Returns the number of stations written. """
+    station_ids, first = np.unique(arr['station_id'], return_index=True)
+    if len(first) < len(arr):
+        logging.warning(f"ignoring {len(arr) - len(first)} duplicate stations")
+        arr = arr[np.sort(first)]
+
+    current = dset[...]
+    current_ids = current['station_id']
+    order = np.argsort(current_ids, kind='stable')
+    found = np.zeros((len(arr),), dtype=bool)
+    rows = np.zeros((len(arr),), dtype=np.int64)
+    if len(current) > 0:
+        pos = np.searchsorted(current_ids[order], arr['station_id'])
+        pos = np.minimum(pos, len(current) - 1)
+        found = current_ids[order][pos] == arr['station_id']
+        rows[found] = order[pos[found]]
+    changed = ~found
+    changed[found] = current[rows[found]] != arr[found]
+    num_new = len(arr) - np.count_nonzero(found)
+    rows[~found] = len(current) + np.arange(num_new)
+    num_changed = np.count_nonzero(changed) - num_new
+    logging.info(f"stations: {num_changed} changed, {num_new} new")
+    if not np.any(changed):
+        return 0
+
+    table = np.concatenate((current, np.zeros((num_new,), dtype=current.dtype)))
+    table[rows[changed]] = arr[changed]
+    if num_new > 0:
+        logging.info(f"resizing stations table to {len(table)} rows")
+        dset.resize((len(table),))
+    # write runs of changed rows, including unchanged rows in small gaps
+    targets = np.sort(rows[changed])
+    breaks = np.flatnonzero(np.diff(targets) > STATION_WRITE_GAP)
+    run_starts = np.concatenate(([targets[0]], targets[breaks + 1]))
+    run_ends = np.concatenate((targets[breaks], [targets[-1]])) + 1
+    for run_start, run_end in zip(run_starts, run_ends):
+        dset[run_start:run_end] = table[run_start:run_end]
+    logging.debug(f"wrote {len(run_starts)} runs of stations")
+    return np.count_nonzero(changed)
+
+
 def getStations(f):
     """ update stations table with latest GHCN content """
     s3_bucket = config.get("ghcn_bucket")
@@ -305,123 +1001,59 @@ def getStations(f):
     # expecint a few 100K stations, so can read into memory
 
     # get s3 file etag
-    s3 = boto3.client('s3', aws_access_key_id='', aws_secret_access_key='')
-    s3._request_signer.sign = (lambda *args, **kwargs: None)
-    etag = ""
-    try:
-        # Do HEAD request to verify key exist and get size
-        rsp = s3.head_object(Bucket=s3_bucket, Key=s3_key)
-        etag = rsp['ETag']
-    except ClientError as ce:
-        if ce.response['Error']['Code'] == 'NoSuchKey':
-            logging.warning(f"key: {s3_key} not found")
-            return 0
-
-    logging.debug(f"etag for {s3_key}: {etag}")
-
-    # if etag is same, just skip
-    if getStationEtag(f) == etag:
-        logging.info("no change to stations file")
-        return 0
+    s3 = getClient()
+    kwargs = {}
+    etag = getStationEtag(f)
+    if etag:
+        # only return the object if the etag has changed
+        kwargs['IfNoneMatch'] = etag
 
+    cache = getCache()
     stations_text = None
     try:
-        rsp = s3.get_object(Bucket=s3_bucket, Key=s3_key)
-        body = rsp['Body']
-        stations_text = body.read()
+        with metrics.timer("stations_get"):
+            if cache is None:
+                rsp = s3.get_object(Bucket=s3_bucket, Key=s3_key, **kwargs)
+                etag = rsp['ETag']
+                body = rsp['Body']
+                stations_text = body.read()
+            else:
+                # get the etag first so the file can be read from the cache
+                rsp = s3.head_object(Bucket=s3_bucket, Key=s3_key, **kwargs)
+                etag = rsp['ETag']
+                content_length = rsp['ContentLength']
+                blocks = getBlocks(s3, s3_bucket, s3_key, 0, content_length, content_length,
+                                   etag=etag, cache=cache)
+                stations_text = b''.join(blocks)
     except ClientError as ce:
+        if isNotModified(ce):
+            logging.info("no change to stations file")
+            return 0
         error_code = ce.response['Error']['Code']
+        if error_code == 'NoSuchKey':
+            logging.warning(f"key: {s3_key} not found")
+            return 0
         logging.error(f"ClientError for getting stations: {error_code}")
+
+    logging.debug(f"etag for {s3_key}: {etag}")
         
     if not stations_text:
         logging.warning("no bytes read for stations.csv")
         return 0
 
-    stations_text = stations_text.decode('utf-8')        
-
-    rows = stations_text.split('\n')
-    count = len(rows)
-    if count == 0:
+    with metrics.timer("stations_parse"):
+        arr = parseStations(stations_text)
+    if len(arr) == 0:
         logging.warning("getStations - no rows to add!")
         return 0
 
-    
-    arr = np.zeros((count,), dtype=dt_station)
-    for i in range(count):
-        row = rows[i]
-        # ACW 000 116 04  17.1167  -61.7833   10.1    ST JOHNS COOLIDGE FLD
-        e = arr[i]
-         
-        station_id = row[:11].strip()
-        if len(station_id) == 0:
-            logging.warning("station_id not set, ignoring")
-            continue
-
-        if len(station_id) != 11:
-            logging.warning(f"unexpected station_id: {station_id}")
-            continue
-        e['station_id'] = station_id
-        lat = row[11:20]
-        try:
-            lat = float(lat)
-        except ValueError:
-            logging.warning(f"Unable to convert lat: {lat} to float")
-            continue
-        e['lat'] = lat
-        lon = row[21:30]
-        try:
-            lon = float(lon)
-        except ValueError:
-            logging.warning(f"Unable to convert lon: {lon} to float")
-            print("row:", row)
-            continue
-        e['lon'] = lon
-        elev = row[31:37]
-        try:
-            elev = float(elev)
-        except ValueError:
-            logging.warning(f"Unable to convert lat: {lat} to float")
-            continue
-        e['elev'] = elev
-        state = row[38:40].strip()
-        e['state'] = state
-        name = row[41:71].strip()
-        try:
-            e['name'] = name
-        except UnicodeEncodeError:
-            logging.warning(f"can't encode name {name} to ascii")
-            name = name.encode('utf-8')
-            if len(name) > 30:
-                name = name[30:]
-                logging.warning("truncating name to 30 characters")
-            e['name'] = name
-        gsn_flag = row[72:75].strip()
-        try:
-            e['gsn_flag'] = gsn_flag
-        except UnicodeEncodeError:
-            logging.warning("can't encode gsn flag to ascii")
-            continue
-
-        hcn_flag = row[76:79].strip()
-        try:
-            e['hcn_flag'] = hcn_flag
-        except UnicodeEncodeError:
-            logging.warning("Can't encode hcn flag to ascii")
-            continue
-
-        wmo_id = row[80:85].strip()
-        try:
-            e['wmo_id'] = wmo_id
-        except UnicodeEncodeError:
-            logging.warning("Can't enode wmo_id to ascii")
-            continue
-        arr[i] = e
-    # can the number of stations ever go down?
-    if dset.shape[0] < count:
-        logging.info(f"resizing stations table to {count} rows")
-        dset.resize((count,))
-    dset[:count] = arr
+    with metrics.timer("stations_write"):
+        count = updateStations(dset, arr)
+    metrics.inc("stations_updated", count)
     setStationEtag(f, etag)  # set etag so don't need to reprocess unless changed
+    if config.get("station_grid"):
+        with metrics.timer("station_grid"):
+            updateStationGrid(f)
     return count
 
  
@@ -429,63 +1061,82 @@ def getStations(f):
 # Main:
 #
 
-
-# Setup logging
-log_level = config.get('log_level')
-print('Set-up log_level:', log_level)
-if log_level == 'DEBUG':
-    level = logging.DEBUG
-elif log_level == 'INFO':
-    level = logging.INFO
-elif log_level in ('WARN', 'WARNING'):
-    level = logging.WARNING
-elif log_level == 'ERROR':
-    level = logging.ERROR
-else:
-    print(f'Unexpected log_level settings: {log_level}, defaulting to DEBUG')
-    level = logging.DEBUG
-
-# logging.basicConfig(format='%(levelname)s %(asctime)s %(message)s', level=level)
-logging.basicConfig(level=level)
-
-sleep_time = config.get("polling_interval")
-logging.debug(f"sleep_time: {sleep_time}")
-
-filename = None
-for i in range(1, len(sys.argv)):
-    arg = sys.argv[1]
-    if arg[0] != '-':
-        # not an override option
-        filename = arg
-
-if not filename:
-    filename = config.get("filename")
-
-if not filename:
-    logging.error("no filename provided!")
-    sys.exit(1)
-
-logging.info(f"Using filename: {filename}")
-
-# Process yearly data files until we get two consective years with no update.
-while True:
-    nrows = 0
-    try:
-        with h5File(filename, mode='a') as f:
-            nstations = getStations(f)
-            if nstations > 0:
-                logging.info(f"updated stations table")
-            nrows = getData(f)
-            if nrows > 0:
-                logging.info(f"added {nrows} rows") 
-            else:
-                logging.info("no rows found")
-    except Exception as e:
-        logging.error(f"Unexpected exception {e}")
-        raise
-    if config.get("run_forever"):
-        logging.info(f"sleeping for {sleep_time} minutes")
-        time.sleep(sleep_time*60)
+def main():
+    # Setup logging
+    log_level = config.get('log_level')
+    print('Set-up log_level:', log_level)
+    if log_level == 'DEBUG':
+        level = logging.DEBUG
+    elif log_level == 'INFO':
+        level = logging.INFO
+    elif log_level in ('WARN', 'WARNING'):
+        level = logging.WARNING
+    elif log_level == 'ERROR':
+        level = logging.ERROR
     else:
-        break
+        print(f'Unexpected log_level settings: {log_level}, defaulting to DEBUG')
+        level = logging.DEBUG
+
+    # logging.basicConfig(format='%(levelname)s %(asctime)s %(message)s', level=level)
+    logging.basicConfig(level=level)
 
+    sleep_time = config.get("polling_interval")
+    logging.debug(f"sleep_time: {sleep_time}")
+
+    filename = None
+    for i in range(1, len(sys.argv)):
+        arg = sys.argv[1]
+        if arg[0] != '-':
+            # not an override option
+            filename = arg
+
+    if not filename:
+        filename = config.get("filename")
+
+    if not filename:
+        logging.error("no filename provided!")
+        sys.exit(1)
+
+    logging.info(f"Using filename: {filename}")
+
+    metrics_port = config.get("metrics_port")
+    if metrics_port:
+        metrics.startServer(int(metrics_port))
+    metrics_log_interval = config.get("metrics_log_interval")
+    if metrics_log_interval:
+        metrics.startSummaryLog(metrics_log_interval)
+
+    # Process yearly data files until we get two consective years with no update.
+    while True:
+        nrows = 0
+        try:
+            with h5File(filename, mode='a') as f:
+                grp, shard_id, shard_count = getShard(f)
+                if shard_count > 0:
+                    logging.info(f"writing shard {shard_id} of {shard_count}")
+                if shard_id == 0:
+                    # stations are shared by all shards, so only updated by one
+                    nstations = getStations(f)
+                    if nstations > 0:
+                        logging.info(f"updated stations table")
+                nrows = getData(grp, shard_id=shard_id, shard_count=max(shard_count, 1))
+                if nrows > 0:
+                    logging.info(f"added {nrows} rows") 
+                else:
+                    logging.info("no rows found")
+        except Exception as e:
+            logging.error(f"Unexpected exception {e}")
+            raise
+        metrics.logSummary()
+        if not config.get("run_forever"):
+            break
+        if config.get("tail_interval"):
+            # pick up rows added to the current year until the next full update
+            followYear(filename, sleep_time*60)
+        else:
+            logging.info(f"sleeping for {sleep_time} minutes")
+            time.sleep(sleep_time*60)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,39 @@
+'''
+Smoke tests for the benchmark scripts in benchmarks/, run on a small
+synthetic sample.
+'''
+
+import os
+import sys
+import json
+import subprocess
+import tempfile
+import unittest
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+class BenchIngestTest(unittest.TestCase):
+
+    def testResults(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            output = os.path.join(tmpdir, "results.json")
+            cmd = [sys.executable, os.path.join(REPO_DIR, "benchmarks", "bench_ingest.py"),
+                   "--stages", "parse,write", "--output", output, "20000"]
+            result = subprocess.run(cmd, capture_output=True, text=True, cwd=tmpdir)
+            self.assertEqual(result.returncode, 0, result.stderr)
+            with open(output) as fh:
+                results = json.load(fh)
+        self.assertEqual(results["rows"], 20000)
+        stages = [item["stage"] for item in results["results"]]
+        self.assertIn("parse", stages)
+        self.assertIn("write", stages)
+        # fetch and ingest need an S3 endpoint
+        self.assertNotIn("fetch", stages)
+        for item in results["results"]:
+            self.assertEqual(item["rows"], 20000)
+            self.assertGreater(item["rows_per_sec"], 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
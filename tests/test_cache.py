@@ -0,0 +1,85 @@
+'''
+Tests for the local disk cache of S3 ranges (ghcn_cache), using a
+stubbed S3 client.
+'''
+
+import os
+import sys
+import time
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from ghcn_cache import BlockCache
+from ghcn_s3 import getBlocks
+from test_s3 import FakeS3
+
+
+class CacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.cache_dir = os.path.join(self.tmpdir.name, "cache")
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def addRange(self, cache, key, size, age):
+        """ Save a range of size bytes, last used age seconds ago """
+        writer = cache.writer("bucket", key, "etag", 0, size)
+        writer.write(b'x' * size)
+        writer.commit()
+        path = cache.getPath("bucket", key, "etag", 0, size)
+        used = time.time() - age
+        os.utime(path, (used, used))
+        return path
+
+    def testReadThrough(self):
+        body = bytes(range(256)) * 20
+        s3 = FakeS3({"key": body})
+        cache = BlockCache(self.cache_dir, 1000000)
+        etag = s3.etag("key")
+        for _ in range(2):
+            data = b''.join(getBlocks(s3, "bucket", "key", 0, len(body), 1000, concurrency=2,
+                                      etag=etag, chunk_size=300, cache=cache))
+            self.assertEqual(data, body)
+        # the second read was from the cache
+        self.assertEqual(len(s3.gets), 6)
+        self.assertEqual(cache.size, len(body))
+        # ranges of a changed object aren't used
+        self.assertIsNone(cache.open("bucket", "key", '"other"', 0, 1000))
+        # nothing is cached without an etag
+        s3.objects["key2"] = body
+        b''.join(getBlocks(s3, "bucket", "key2", 0, len(body), 1000, cache=cache))
+        self.assertEqual(cache.size, len(body))
+
+    def testEviction(self):
+        cache = BlockCache(self.cache_dir, 3500)
+        paths = [self.addRange(cache, f"key{i}", 1000, age=100 - i) for i in range(3)]
+        # reading a range makes it the most recently used
+        cache.open("bucket", "key0", "etag", 0, 1000).close()
+        self.assertEqual(cache.size, 3000)
+        # past max_size, the least recently used ranges are removed until the
+        # cache is at most EVICT_RATIO of max_size
+        paths.append(self.addRange(cache, "key3", 1000, age=10))
+        self.assertEqual([os.path.exists(path) for path in paths], [True, False, True, True])
+        self.assertEqual(cache.size, 3000)
+        paths.append(self.addRange(cache, "key4", 1500, age=0))
+        self.assertEqual([os.path.exists(path) for path in paths], [True, False, False, False, True])
+        self.assertEqual(cache.size, 2500)
+        # the size is found again when the cache is reopened
+        self.assertEqual(BlockCache(self.cache_dir, 3500).size, 2500)
+
+    def testAbortedWrite(self):
+        cache = BlockCache(self.cache_dir, 3500)
+        writer = cache.writer("bucket", "key", "etag", 0, 1000)
+        writer.write(b'x' * 500)
+        writer.close()
+        self.assertIsNone(cache.open("bucket", "key", "etag", 0, 1000))
+        self.assertEqual(os.listdir(self.cache_dir), [])
+        self.assertEqual(cache.size, 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,168 @@
+'''
+Tests for querying and exporting data table rows (ghcn_export), checked
+against a brute force filter of the rows, on local HDF5 files.
+'''
+
+import os
+import sys
+import subprocess
+import tempfile
+import unittest
+import numpy as np
+import h5py
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+os.environ.setdefault("CONFIG_DIR", REPO_DIR)
+
+import config
+import ghcn_export
+import ghcn_update
+from ghcn_parse import parseRows
+from ghcn_table import createDataTable
+from test_s3 import makeText
+
+YEAR = 1990
+
+
+def makeRows():
+    """ Return rows for two years of 30 stations, with some q_flags """
+    rows = np.concatenate([parseRows(makeText(6000, num_stations=30, year=year)) for year in (YEAR, YEAR + 1)])
+    rows['element'][1::3] = b"PRCP"
+    rows['q_flag'][::7] = b"X"
+    return rows
+
+
+class ExportTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.tmpdir = tempfile.TemporaryDirectory()
+        cls.rows = makeRows()
+        config.get("station_index")  # load config.yml before overriding
+        saved_cfg = dict(config.cfg)
+        config.cfg.update(station_index=True, time_index=True, summary_tables=False)
+        cls.paths = {}
+        try:
+            for indexed in (True, False):
+                path = os.path.join(cls.tmpdir.name, f"ghcn_{indexed}.h5")
+                with h5py.File(path, "w") as f:
+                    createDataTable(f, "data", layout="columns", encoding="compact", chunks=(512,))
+                    if not indexed:
+                        config.cfg.update(station_index=False, time_index=False)
+                    for start in range(0, len(cls.rows), 2500):
+                        ghcn_update.addRows(f, cls.rows[start:start + 2500])
+                cls.paths[indexed] = path
+        finally:
+            config.cfg.clear()
+            config.cfg.update(saved_cfg)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.tmpdir.cleanup()
+
+    def expected(self, stations=None, elements=None, start_ymd=None, end_ymd=None, q_flags=None):
+        rows = self.rows
+        mask = np.ones((len(rows),), dtype=bool)
+        if stations is not None:
+            mask &= np.isin(rows['station_id'], [s.encode('ascii') for s in stations])
+        if elements is not None:
+            mask &= np.isin(rows['element'], [e.encode('ascii') for e in elements])
+        if start_ymd is not None:
+            mask &= rows['ymd'] >= start_ymd.encode('ascii')
+        if end_ymd is not None:
+            mask &= rows['ymd'] <= end_ymd.encode('ascii')
+        if q_flags is not None:
+            mask &= np.isin(rows['q_flag'], q_flags)
+        return rows[mask]
+
+    def query(self, path, **kwargs):
+        with h5py.File(path, "r") as f:
+            batches = list(ghcn_export.queryRows(f, **kwargs))
+        if not batches:
+            return None
+        return np.concatenate(batches)
+
+    def testQuery(self):
+        queries = [{},
+                   {"stations": ["USC00000003", "USC00000017"]},
+                   {"stations": "USC00000004", "elements": ["PRCP"]},
+                   {"start_ymd": "19900301", "end_ymd": "19900415"},
+                   {"stations": ["USC00000011"], "start_ymd": "19901220", "end_ymd": "19910110", "q_flags": [b'']},
+                   {"start_ymd": "19910601"},
+                   {"end_ymd": "19900102", "elements": ["TMAX"]}]
+        for kwargs in queries:
+            expected = self.expected(**{k: [v] if k == "stations" and isinstance(v, str) else v
+                                        for k, v in kwargs.items()})
+            for indexed, path in self.paths.items():
+                stats = {}
+                rows = self.query(path, stats=stats, **kwargs)
+                # the query returns rows in table order
+                self.assertTrue(np.array_equal(rows, expected), (indexed, kwargs))
+                self.assertEqual(stats["rows"], len(expected))
+                if indexed and kwargs:
+                    # only rows that can match are read
+                    self.assertLess(stats["rows_read"], len(self.rows), kwargs)
+                elif not indexed:
+                    self.assertEqual(stats["rows_read"], len(self.rows))
+        self.assertIsNone(self.query(self.paths[True], stations=["USC99999999"]))
+        self.assertIsNone(self.query(self.paths[True], start_ymd="20000101"))
+
+    def testFields(self):
+        stats = {}
+        rows = self.query(self.paths[True], stations=["USC00000003"], fields=["ymd", "data_value"], stats=stats)
+        expected = self.expected(stations=["USC00000003"])
+        self.assertEqual(rows.dtype.names, ("ymd", "data_value"))
+        self.assertTrue(np.array_equal(rows['data_value'], expected['data_value']))
+        # station (4 bytes), day (4 bytes) and data_value (2 bytes) columns
+        self.assertEqual(stats["bytes_read"], stats["rows_read"] * 10)
+        with self.assertRaises(ValueError):
+            self.query(self.paths[True], fields=["lat"])
+
+    def testNpy(self):
+        output = os.path.join(self.tmpdir.name, "rows.npy")
+        with h5py.File(self.paths[True], "r") as f:
+            count = ghcn_export.exportRows(f, output, format="npy", elements=["PRCP"],
+                                           fields=["station_id", "ymd", "data_value"])
+        expected = self.expected(elements=["PRCP"])
+        self.assertEqual(count, len(expected))
+        arr = np.load(output)
+        self.assertEqual(arr.dtype.names, ("station_id", "ymd", "data_value"))
+        self.assertTrue(np.array_equal(arr['ymd'], expected['ymd']))
+        # an empty result is still a valid file
+        self.assertEqual(ghcn_export.writeNpy(output, [], self.rows.dtype), 0)
+        self.assertEqual(np.load(output).shape, (0,))
+
+    @unittest.skipIf(ghcn_export.pa is None, "pyarrow not installed")
+    def testArrow(self):
+        kwargs = {"stations": ["USC00000007"], "q_flags": [b'']}
+        expected = self.expected(**kwargs)
+        with h5py.File(self.paths[True], "r") as f:
+            for fmt in ("parquet", "arrow"):
+                output = os.path.join(self.tmpdir.name, f"rows.{fmt}")
+                self.assertEqual(ghcn_export.exportRows(f, output, format=fmt, **kwargs), len(expected))
+                if fmt == "parquet":
+                    table = ghcn_export.pq.read_table(output)
+                else:
+                    with ghcn_export.pa.memory_map(output) as source:
+                        table = ghcn_export.pa.ipc.open_file(source).read_all()
+                self.assertEqual(table.column_names, list(self.rows.dtype.names))
+                self.assertEqual(table.column("ymd").to_pylist(), expected['ymd'].astype('U').tolist())
+                self.assertEqual(table.column("data_value").to_pylist(), expected['data_value'].tolist())
+            with self.assertRaises(ValueError):
+                ghcn_export.exportRows(f, output, format="csv")
+
+    def testDates(self):
+        output = os.path.join(self.tmpdir.name, "dates.npy")
+        cmd = [sys.executable, os.path.join(REPO_DIR, "ghcn_export.py"), self.paths[True], "--loglevel", "error",
+               "--format", "npy", "--output", output]
+        for dates in ("19900230:", "1990:19910101", "19900101", ":"):
+            result = subprocess.run(cmd + ["--dates", dates], capture_output=True, text=True, cwd=REPO_DIR)
+            self.assertNotEqual(result.returncode, 0, dates)
+        result = subprocess.run(cmd + ["--dates", ":19900110"], capture_output=True, text=True, cwd=REPO_DIR)
+        self.assertEqual(result.returncode, 0, result.stderr)
+        self.assertTrue(np.array_equal(np.load(output), self.expected(end_ymd="19900110")))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,114 @@
+'''
+Tests for following the current year's CSV file between updates
+(ghcn_update.followYear), using a stubbed S3 client, a simulated clock
+and a local HDF5 file.
+'''
+
+import os
+import sys
+import time
+import tempfile
+import unittest
+import numpy as np
+import h5py
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("CONFIG_DIR", os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import config
+import ghcn_update
+import ghcn_metrics as metrics
+from ghcn_parse import parseRows
+from ghcn_dtype import dt_day
+from ghcn_table import createDataTable, createShards, getDataTable, getYearShard
+from test_s3 import FakeS3, makeText
+
+YEAR = time.gmtime().tm_year
+
+
+class FakeClock:
+    """ Stands in for the time module: sleep advances the clock without
+    waiting, and calls on_sleep with the number of sleeps so far """
+
+    def __init__(self, on_sleep=None):
+        self.now = time.time()
+        self.sleeps = []
+        self.on_sleep = on_sleep
+
+    def time(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now += seconds
+        if self.on_sleep is not None:
+            self.on_sleep(len(self.sleeps))
+
+    def __getattr__(self, name):
+        return getattr(time, name)
+
+
+class FollowTest(unittest.TestCase):
+
+    def setUp(self):
+        config.get("block_size")  # load config.yml before overriding
+        self.saved_cfg = dict(config.cfg)
+        config.cfg.update(block_size=4096, summary_tables=False, fetch_concurrency=1, prefetch_depth=1,
+                          last_year=YEAR + 1, write_queue_depth=0, write_buffer_size=300 * dt_day.itemsize,
+                          tail_interval=10, tail_max_interval=40, shard_id=None)
+        self.key = f"{config.get('ghcn_path')}{YEAR}.csv"
+        self.s3 = FakeS3({self.key: makeText(300, year=YEAR)})
+        self.saved = (ghcn_update.getClient, ghcn_update.getCache, ghcn_update.time)
+        ghcn_update.getClient = lambda: self.s3
+        ghcn_update.getCache = lambda: None
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmpdir.name, "ghcn.h5")
+        self.polls = metrics.getMetrics()["counters"].get("tail_polls", 0)
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+        ghcn_update.getClient, ghcn_update.getCache, ghcn_update.time = self.saved
+        config.cfg.clear()
+        config.cfg.update(self.saved_cfg)
+
+    def getPolls(self):
+        return metrics.getMetrics()["counters"].get("tail_polls", 0) - self.polls
+
+    def testFollow(self):
+        with h5py.File(self.path, "w") as f:
+            createDataTable(f, "data", chunks=(256,))
+
+        def onSleep(count):
+            # rows are appended to the file before the 4th check
+            if count == 4:
+                self.s3.objects[self.key] = makeText(450, year=YEAR)
+
+        ghcn_update.time = FakeClock(onSleep)
+        ghcn_update.followYear(self.path, 200)
+        # the interval doubles after each check with no new rows, up to
+        # tail_max_interval, and is reset when rows are added
+        self.assertEqual(ghcn_update.time.sleeps, [10, 10, 20, 40, 10, 20, 40, 40, 10])
+        self.assertEqual(self.getPolls(), 9)
+        with h5py.File(self.path, "r") as f:
+            self.assertTrue(np.array_equal(getDataTable(f)[...], parseRows(makeText(450, year=YEAR))))
+            manifest = ghcn_update.getManifest(f, YEAR)
+            self.assertEqual(manifest['byte_offset'], len(self.s3.objects[self.key]))
+        # the appended bytes were read from the end of the first load, and
+        # nothing was read twice
+        starts = [start for _, start in self.s3.gets]
+        self.assertIn(len(makeText(300, year=YEAR)), starts)
+        self.assertEqual(starts, sorted(set(starts)))
+
+    def testOtherShard(self):
+        with h5py.File(self.path, "w") as f:
+            createShards(f, 2, chunks=(256,))
+        config.cfg.update(shard_id=1 - getYearShard(YEAR, 2))
+        ghcn_update.time = FakeClock()
+        ghcn_update.followYear(self.path, 115)
+        self.assertEqual(ghcn_update.time.sleeps, [115])
+        self.assertEqual(self.getPolls(), 0)
+        self.assertEqual(self.s3.heads, [])
+
+
+if __name__ == "__main__":
+    unittest.main()
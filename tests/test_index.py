@@ -0,0 +1,159 @@
+'''
+Tests for the station and time indexes (ghcn_index), using a local
+HDF5 file.
+'''
+
+import os
+import sys
+import datetime
+import tempfile
+import unittest
+import numpy as np
+import h5py
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import ghcn_index
+from ghcn_parse import parseRows
+from ghcn_table import createDataTable, getDataTable
+
+
+def makeText(num_days, num_stations, year):
+    """ Return CSV text with a row per station per day, in date then
+    station order like the GHCN year files """
+    lines = []
+    for day_num in range(num_days):
+        day = (datetime.date(year, 1, 1) + datetime.timedelta(days=day_num)).strftime('%Y%m%d')
+        for station in range(num_stations):
+            lines.append(f"USC{station:08d},{day},TMAX,{(day_num + station) % 400},,,a,\n")
+    return "".join(lines).encode('ascii')
+
+
+class CountingTable:
+    """ Wraps a data table and counts the rows read """
+
+    def __init__(self, dset):
+        self.dset = dset
+        self.dtype = dset.dtype
+        self.rows_read = 0
+        self.reads = 0
+
+    def __getitem__(self, sel):
+        rows = self.dset[sel]
+        self.rows_read += len(rows)
+        self.reads += 1
+        return rows
+
+
+class StationIndexTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.f = h5py.File(os.path.join(self.tmpdir.name, "ghcn.h5"), "w")
+        createDataTable(self.f, "data", chunks=(1000,))
+        self.rows = np.concatenate([parseRows(makeText(60, 500, year)) for year in (2001, 2002, 2003)])
+        dset = getDataTable(self.f)
+        dset.resize((len(self.rows),))
+        dset[0:len(self.rows)] = self.rows
+        self.saved = (ghcn_index.COMPACT_RUNS, ghcn_index.getDataTable)
+
+    def tearDown(self):
+        ghcn_index.COMPACT_RUNS, ghcn_index.getDataTable = self.saved
+        self.f.close()
+        self.tmpdir.cleanup()
+
+    def addRuns(self, batch_rows, merge_runs):
+        """ Index the rows batch_rows at a time, compacting after merge_runs """
+        for start in range(0, len(self.rows), batch_rows):
+            ghcn_index.updateStationIndex(self.f, self.rows[start:start+batch_rows], start)
+            if ghcn_index.getUnindexedRuns(self.f) > merge_runs:
+                ghcn_index.compactStationIndex(self.f)
+
+    def checkStations(self):
+        index = ghcn_index.StationIndex(self.f)
+        for station_id in (b"USC00000000", b"USC00000123", b"USC00000499", b"USX00000000"):
+            expected = self.rows[self.rows['station_id'] == station_id]
+            self.assertTrue(np.array_equal(index.getRows(station_id), expected))
+
+    def testCompaction(self):
+        ghcn_index.COMPACT_RUNS = 5000  # merge in several groups
+        self.addRuns(3000, 6000)
+        self.checkStations()
+        grp = self.f[ghcn_index.SEGMENTS]
+        # segments are merged, so there are few of them for each level
+        levels = [int(grp[name].attrs["level"]) for name in grp]
+        for level in set(levels):
+            self.assertLess(levels.count(level), ghcn_index.SEGMENT_FANOUT)
+        self.assertGreater(max(levels), 0)
+        ghcn_index.compactStationIndex(self.f)
+        self.assertEqual(ghcn_index.getUnindexedRuns(self.f), 0)
+        self.assertEqual(ghcn_index.getIndexedRuns(self.f), len(self.rows))
+        self.checkStations()
+
+    def testRowsRead(self):
+        self.addRuns(len(self.rows), len(self.rows))
+        ghcn_index.compactStationIndex(self.f)
+        table = CountingTable(getDataTable(self.f))
+        ghcn_index.getDataTable = lambda f: table
+        rows = ghcn_index.StationIndex(self.f).getRows("USC00000042")
+        # one row a day for 3 years, and only those rows are read
+        self.assertEqual(len(rows), 180)
+        self.assertEqual(table.rows_read, 180)
+        self.assertEqual(table.reads, 180)
+
+    def testRebuild(self):
+        self.addRuns(len(self.rows), len(self.rows))
+        ghcn_index.rebuildIndexes(self.f)
+        self.checkStations()
+        self.assertEqual(ghcn_index.getYearRange(self.f, 2002), (30000, 60000))
+        self.assertIsNone(ghcn_index.getYearRange(self.f, 2004))
+
+
+class TimeIndexTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.f = h5py.File(os.path.join(self.tmpdir.name, "ghcn.h5"), "w")
+        createDataTable(self.f, "data", chunks=(1000,))
+        # 10 stations for 40 days of each year, and a row with a bad date
+        text = b"".join(makeText(40, 10, year) for year in (1999, 2000, 2001))
+        text += b"USC00000001,20019999,TMAX,5,,,a,\n"
+        self.rows = parseRows(text)
+        dset = getDataTable(self.f)
+        dset.resize((len(self.rows),))
+        dset[0:len(self.rows)] = self.rows
+        # indexed as written, in batches that split days
+        for start in range(0, len(self.rows), 333):
+            ghcn_index.updateTimeIndex(self.f, self.rows[start:start+333], start)
+
+    def tearDown(self):
+        self.f.close()
+        self.tmpdir.cleanup()
+
+    def testRanges(self):
+        self.assertEqual(ghcn_index.getYearRange(self.f, 2000), (400, 800))
+        self.assertIsNone(ghcn_index.getYearRange(self.f, 1998))
+        self.assertIsNone(ghcn_index.getYearRange(self.f, 1700))
+        self.assertEqual(ghcn_index.getLastYear(self.f), 2001)
+        self.assertEqual(ghcn_index.getDayRange(self.f, "20000101", "20000101"), (400, 410))
+        self.assertEqual(ghcn_index.getDayRange(self.f, b"19991231", "20000102"), (400, 420))
+        self.assertIsNone(ghcn_index.getDayRange(self.f, "19980101", "19981231"))
+        with self.assertRaises(ValueError):
+            ghcn_index.getDayRange(self.f, "20000101", "2000-01-02")
+
+    def testDateRows(self):
+        rows = ghcn_index.getDateRows(self.f, "20010209", "20010301")
+        expected = self.rows[(self.rows['ymd'] >= b"20010209") & (self.rows['ymd'] <= b"20010301")]
+        self.assertEqual(len(rows), 10)
+        self.assertTrue(np.array_equal(rows, expected))
+
+    def testRebuild(self):
+        day_index = self.f["day_index"][...]
+        year_index = self.f["year_index"][...]
+        ghcn_index.rebuildIndexes(self.f, station_index=False)
+        self.assertTrue(np.array_equal(self.f["day_index"][...], day_index))
+        self.assertTrue(np.array_equal(self.f["year_index"][...], year_index))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,76 @@
+'''
+Tests for the collector's counters, stage timers and /metrics endpoint
+(ghcn_metrics).
+'''
+
+import os
+import sys
+import time
+import unittest
+import urllib.error
+import urllib.request
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import ghcn_metrics as metrics
+
+
+class MetricsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.saved = metrics.getMetrics()
+        metrics.resetMetrics()
+
+    def tearDown(self):
+        metrics.resetMetrics()
+        metrics.mergeMetrics(self.saved)
+
+    def testCounters(self):
+        metrics.inc("rows_added", 10)
+        metrics.inc("rows_added", 5)
+        metrics.inc("files_rewritten")
+        with metrics.timer("parse"):
+            time.sleep(0.01)
+        with self.assertRaises(ValueError):
+            with metrics.timer("parse"):
+                raise ValueError()
+        values = metrics.getMetrics()
+        self.assertEqual(values["counters"], {"rows_added": 15, "files_rewritten": 1})
+        calls, seconds = values["timers"]["parse"]
+        self.assertEqual(calls, 2)
+        self.assertGreaterEqual(seconds, 0.01)
+
+        # metrics from a backfill worker are added in
+        metrics.mergeMetrics({"counters": {"rows_added": 100}, "timers": {"parse": [3, 1.5]}})
+        values = metrics.getMetrics()
+        self.assertEqual(values["counters"]["rows_added"], 115)
+        self.assertEqual(values["timers"]["parse"][0], 5)
+        self.assertIn("rows_added=115", metrics.getSummary())
+
+    def testFormat(self):
+        metrics.inc("rows_added", 7)
+        metrics.addTime("write", 2.5, calls=4)
+        lines = metrics.formatMetrics().splitlines()
+        self.assertIn("# TYPE ghcn_rows_added_total counter", lines)
+        self.assertIn("ghcn_rows_added_total 7", lines)
+        self.assertIn('ghcn_stage_seconds_total{stage="write"} 2.500000', lines)
+        self.assertIn('ghcn_stage_calls_total{stage="write"} 4', lines)
+
+    def testServer(self):
+        metrics.inc("tail_polls", 2)
+        server = metrics.startServer(0)
+        try:
+            url = f"http://127.0.0.1:{server.server_address[1]}"
+            with urllib.request.urlopen(f"{url}/metrics", timeout=5) as rsp:
+                self.assertEqual(rsp.status, 200)
+                body = rsp.read().decode('utf-8')
+            self.assertIn("ghcn_tail_polls_total 2", body.splitlines())
+            with self.assertRaises(urllib.error.HTTPError):
+                urllib.request.urlopen(f"{url}/other", timeout=5)
+        finally:
+            server.shutdown()
+            server.server_close()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,73 @@
+'''
+Tests for parsing GHCN CSV text (ghcn_parse), checking the vectorized
+parseRows against the original row at a time parseRowsLoop.
+'''
+
+import os
+import sys
+import unittest
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from ghcn_parse import parseRows, parseRowsLoop, BAD_VALUE
+
+# data_value fields, with the value int() gives for them
+VALUES = (("0", 0), ("12", 12), ("-12", -12), ("+12", 12), ("-0", 0),
+          (" 12", 12), ("12 ", 12), (" -7 ", -7), ("\t5", 5), ("1_2", 12), ("-1_000", -1000),
+          ("0000000000012", 12), ("-000000000000000032768", -32768), ("00000000000000000000", 0),
+          ("32767", 32767), ("32768", BAD_VALUE), ("-32769", BAD_VALUE), ("99999999999", BAD_VALUE),
+          ("123456789012345678901234567890", BAD_VALUE),
+          ("", BAD_VALUE), ("-", BAD_VALUE), ("+", BAD_VALUE), ("1.5", BAD_VALUE), ("1e3", BAD_VALUE),
+          ("_12", BAD_VALUE), ("1__2", BAD_VALUE), ("12_", BAD_VALUE), ("1 2", BAD_VALUE),
+          ("--1", BAD_VALUE), ("0x10", BAD_VALUE), ("abc", BAD_VALUE))
+
+
+def makeLine(data_value, station_id="USC00042319", ymd="20250107", element="TMAX",
+             flags=("", "", "a"), obs_time="0700"):
+    return ",".join((station_id, ymd, element, data_value) + tuple(flags) + (obs_time,))
+
+
+class ParseTest(unittest.TestCase):
+
+    def checkSame(self, lines):
+        text = "".join(line + "\n" for line in lines).encode('utf-8')
+        arr = parseRows(text)
+        expected = parseRowsLoop(lines)
+        self.assertEqual(len(arr), len(expected))
+        for name in expected.dtype.names:
+            self.assertTrue(np.array_equal(arr[name], expected[name]), name)
+        return arr
+
+    def testValues(self):
+        arr = self.checkSame([makeLine(value) for value, _ in VALUES])
+        self.assertEqual(list(arr['data_value']), [value for _, value in VALUES])
+
+    def testFields(self):
+        lines = [makeLine("5"),
+                 makeLine("5", station_id="USC000423190"),  # truncated
+                 makeLine("5", ymd="2025010"),
+                 makeLine("5", element="PRCPX"),
+                 makeLine("5", flags=("S", "QX", "abc")),
+                 makeLine("5", obs_time=""),
+                 makeLine("5", obs_time="07000")]
+        self.checkSame(lines)
+
+    def testRandom(self):
+        rng = np.random.default_rng(1)
+        chars = list("0123456789-+_ ")
+        lines = []
+        for _ in range(2000):
+            value = "".join(rng.choice(chars, size=rng.integers(0, 8)))
+            lines.append(makeLine(value))
+        self.checkSame(lines)
+
+    def testCarriageReturn(self):
+        text = (makeLine("12") + "\r\n" + makeLine(" 3") + "\r\n").encode('ascii')
+        arr = parseRows(text)
+        self.assertEqual(list(arr['data_value']), [12, 3])
+        self.assertEqual(list(arr['obs_time']), [b"0700", b"0700"])
+
+
+if __name__ == "__main__":
+    unittest.main()
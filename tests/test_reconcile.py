@@ -0,0 +1,165 @@
+'''
+Tests for reconciling a rewritten year file (ghcn_update.reconcileYear),
+using a stubbed S3 client and a local HDF5 file.
+'''
+
+import os
+import sys
+import datetime
+import tempfile
+import unittest
+import numpy as np
+import h5py
+from botocore.exceptions import ClientError
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("CONFIG_DIR", os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import config
+import ghcn_update
+from ghcn_parse import parseRows
+from ghcn_table import createDataTable, getDataTable
+
+YEAR = 1990
+
+
+def makeText(num_rows, num_stations=20, year=YEAR):
+    """ Return CSV text for num_rows rows, in date then station order """
+    lines = []
+    for i in range(num_rows):
+        day = datetime.date(year, 1, 1) + datetime.timedelta(days=i // num_stations)
+        station_id = f"USC{i % num_stations:08d}"
+        lines.append(f"{station_id},{day.strftime('%Y%m%d')},TMAX,{i % 400:03d},,,a,0700\n")
+    return "".join(lines).encode('ascii')
+
+
+class FakeS3:
+    """ S3 client that serves objects from a dict """
+
+    def __init__(self, objects, heads=None):
+        self.objects = objects
+        self.heads = heads if heads is not None else []
+
+    def head_object(self, Bucket, Key, **kwargs):
+        self.heads.append(Key)
+        if Key not in self.objects:
+            raise ClientError({'Error': {'Code': 'NoSuchKey'}}, 'HeadObject')
+        body = self.objects[Key]
+        etag = f'"{hash(body):x}"'
+        if kwargs.get('IfNoneMatch') == etag:
+            raise ClientError({'Error': {'Code': '304'}}, 'HeadObject')
+        return {'ContentLength': len(body), 'ETag': etag,
+                'LastModified': datetime.datetime(2026, 1, 1)}
+
+
+class ReconcileTest(unittest.TestCase):
+
+    def setUp(self):
+        config.get("block_size")  # load config.yml before overriding
+        self.saved_cfg = dict(config.cfg)
+        config.cfg.update(block_size=4096, summary_tables=False, fetch_concurrency=1, prefetch_depth=1)
+        self.key = f"{config.get('ghcn_path')}{YEAR}.csv"
+        self.objects = {}
+        self.heads = []
+        self.saved = (ghcn_update.getClient, ghcn_update.getBlocks, ghcn_update.getCache)
+        ghcn_update.getClient = lambda: FakeS3(self.objects, self.heads)
+        ghcn_update.getBlocks = self.getBlocks
+        ghcn_update.getCache = lambda: None
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.f = h5py.File(os.path.join(self.tmpdir.name, "ghcn.h5"), "w")
+        createDataTable(self.f, "data", chunks=(256,))
+
+    def tearDown(self):
+        self.f.close()
+        self.tmpdir.cleanup()
+        ghcn_update.getClient, ghcn_update.getBlocks, ghcn_update.getCache = self.saved
+        config.cfg.clear()
+        config.cfg.update(self.saved_cfg)
+
+    def getBlocks(self, s3, s3_bucket, s3_key, range_start, content_length, block_size, **kwargs):
+        body = self.objects[s3_key]
+        for start in range(range_start, content_length, block_size):
+            yield body[start:min(start + block_size, content_length)]
+
+    def ingest(self):
+        buffer = ghcn_update.RowBuffer(self.f, 1000)
+        count = ghcn_update.addYearData(self.f, YEAR, buffer=buffer)
+        buffer.flush()
+        return count
+
+    def editValues(self, text, line_numbers):
+        """ Return text with data_value of the given lines changed, keeping
+        the length of the text """
+        lines = text.split(b'\n')
+        for n in line_numbers:
+            fields = lines[n].split(b',')
+            fields[3] = b'999' if fields[3] != b'999' else b'998'
+            lines[n] = b','.join(fields)
+        return b'\n'.join(lines)
+
+    def testRewrite(self):
+        text = makeText(3000)
+        self.objects[self.key] = text
+        self.assertEqual(self.ingest(), 3000)
+        num_blocks = len(self.f["block_hashes"])
+        self.assertGreater(num_blocks, 2)
+
+        text = self.editValues(text, (5, 1500, 2999))
+        self.objects[self.key] = text
+        self.assertEqual(self.ingest(), 0)
+        self.assertTrue(np.array_equal(getDataTable(self.f)[...], parseRows(text)))
+        self.assertEqual(len(self.f["block_hashes"]), num_blocks)
+        manifest = ghcn_update.getManifest(self.f, YEAR)
+        self.assertEqual(manifest['byte_offset'], len(text))
+        self.assertEqual(manifest['row_count'], 3000)
+
+        # unchanged since the reconcile
+        self.assertEqual(self.ingest(), 0)
+
+        # rows appended after a rewrite are added
+        text = self.editValues(text, (10,))
+        self.objects[self.key] = text
+        self.assertEqual(self.ingest(), 0)
+        text += makeText(3100)[len(makeText(3000)):]
+        self.objects[self.key] = text
+        self.assertEqual(self.ingest(), 100)
+        self.assertTrue(np.array_equal(getDataTable(self.f)[...], parseRows(text)))
+
+    def testNoBlockHashes(self):
+        text = makeText(1000)
+        self.objects[self.key] = text
+        self.ingest()
+        del self.f["block_hashes"]
+        rows = getDataTable(self.f)[...]
+
+        text = self.editValues(text, (7,))
+        self.objects[self.key] = text
+        self.assertEqual(self.ingest(), 0)
+        self.assertTrue(np.array_equal(getDataTable(self.f)[...], rows))
+        # the new etag is saved, so the rewrite is only reported once
+        manifest = ghcn_update.getManifest(self.f, YEAR)
+        self.assertEqual(manifest['etag'].decode('ascii'), FakeS3(self.objects).head_object(None, self.key)['ETag'])
+        self.assertEqual(list(ghcn_update.readYearData(YEAR, manifest=manifest)), [])
+
+    def testRewriteEarlierYear(self):
+        config.cfg.update(start_year=YEAR, last_year=YEAR + 3, backfill_workers=1, write_queue_depth=0)
+        texts = {year: makeText(1000, year=year) for year in (YEAR, YEAR + 1)}
+        for year, text in texts.items():
+            self.objects[f"{config.get('ghcn_path')}{year}.csv"] = text
+        self.assertEqual(ghcn_update.getData(self.f), 2000)
+
+        # nothing changed: each earlier year is one conditional HEAD
+        self.heads.clear()
+        self.assertEqual(ghcn_update.getData(self.f), 0)
+        self.assertEqual(self.heads.count(self.key), 1)
+
+        # a revision to a year before the last one is reconciled
+        texts[YEAR] = self.editValues(texts[YEAR], (3, 600))
+        self.objects[self.key] = texts[YEAR]
+        self.assertEqual(ghcn_update.getData(self.f), 0)
+        expected = np.concatenate([parseRows(texts[YEAR]), parseRows(texts[YEAR + 1])])
+        self.assertTrue(np.array_equal(getDataTable(self.f)[...], expected))
+
+
+if __name__ == "__main__":
+    unittest.main()
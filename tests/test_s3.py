@@ -0,0 +1,231 @@
+'''
+Tests for reading S3 objects in blocks (ghcn_s3.getBlocks), and for
+stopping an update at a year that couldn't be read, using a stubbed S3
+client and a local HDF5 file.
+'''
+
+import io
+import os
+import sys
+import datetime
+import tempfile
+import threading
+import time
+import unittest
+import numpy as np
+import h5py
+from botocore import UNSIGNED
+from botocore.exceptions import ClientError, ReadTimeoutError
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("CONFIG_DIR", os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import config
+import ghcn_s3
+import ghcn_update
+from ghcn_s3 import getBlocks
+from ghcn_parse import parseRows
+from ghcn_dtype import dt_day
+from ghcn_table import createDataTable, getDataTable
+
+YEAR = 1990
+
+
+def makeText(num_rows, num_stations=20, year=YEAR):
+    """ Return CSV text for num_rows rows, in date then station order """
+    lines = []
+    for i in range(num_rows):
+        day = datetime.date(year, 1, 1) + datetime.timedelta(days=i // num_stations)
+        lines.append(f"USC{i % num_stations:08d},{day.strftime('%Y%m%d')},TMAX,{i % 400},,,a,\n")
+    return "".join(lines).encode('ascii')
+
+
+class FakeS3:
+    """ S3 client that serves objects from a dict.  A GET of a range
+    starting at a byte in failures raises the exception given for it.
+    Requests are recorded in gets and heads. """
+
+    def __init__(self, objects, failures=None):
+        self.objects = objects
+        self.failures = failures if failures is not None else {}
+        self.gets = []  # (key, range start) of each GET
+        self.heads = []  # (key, If-None-Match etag) of each HEAD
+
+    def etag(self, key):
+        return f'"{hash(self.objects[key]):x}"'
+
+    def head_object(self, Bucket, Key, **kwargs):
+        self.heads.append((Key, kwargs.get('IfNoneMatch')))
+        if Key not in self.objects:
+            raise ClientError({'Error': {'Code': 'NoSuchKey'}}, 'HeadObject')
+        if kwargs.get('IfNoneMatch') == self.etag(Key):
+            raise ClientError({'Error': {'Code': '304'}}, 'HeadObject')
+        return {'ContentLength': len(self.objects[Key]), 'ETag': self.etag(Key),
+                'LastModified': datetime.datetime(2026, 1, 1)}
+
+    def get_object(self, Bucket, Key, Range=None, IfMatch=None, IfNoneMatch=None):
+        if Key not in self.objects:
+            raise ClientError({'Error': {'Code': 'NoSuchKey'}}, 'GetObject')
+        body = self.objects[Key]
+        if Range is None:
+            start, end = 0, len(body) - 1
+        else:
+            start, end = (int(n) for n in Range[len("bytes="):].split('-'))
+        self.gets.append((Key, start))
+        if IfNoneMatch == self.etag(Key):
+            raise ClientError({'Error': {'Code': '304'}}, 'GetObject')
+        if (Key, start) in self.failures:
+            raise self.failures[(Key, start)]
+        if IfMatch and IfMatch != self.etag(Key):
+            raise ClientError({'Error': {'Code': 'PreconditionFailed'}}, 'GetObject')
+        if start >= len(body):
+            raise ClientError({'Error': {'Code': 'InvalidRange'}}, 'GetObject')
+        return {'Body': io.BytesIO(body[start:end+1]), 'ETag': self.etag(Key)}
+
+
+class GetBlocksTest(unittest.TestCase):
+
+    def setUp(self):
+        self.body = bytes(range(256)) * 40
+        self.s3 = FakeS3({"key": self.body})
+
+    def read(self, content_length=None, **kwargs):
+        if content_length is None:
+            content_length = len(self.body)
+        return b''.join(getBlocks(self.s3, "bucket", "key", 0, content_length, 1000, **kwargs))
+
+    def testBlocks(self):
+        for concurrency, prefetch, chunk_size in ((1, 1, None), (4, 8, 300), (3, 2, 1000)):
+            data = self.read(concurrency=concurrency, prefetch=prefetch, chunk_size=chunk_size)
+            self.assertEqual(data, self.body)
+
+    def testConcurrent(self):
+        # ranges are downloaded by several threads at once, up to concurrency
+        lock = threading.Lock()
+        active = []
+        max_active = []
+        get_object = self.s3.get_object
+
+        def slowGet(**kwargs):
+            with lock:
+                active.append(1)
+                max_active.append(len(active))
+            time.sleep(0.01)
+            with lock:
+                active.pop()
+            return get_object(**kwargs)
+
+        self.s3.get_object = slowGet
+        self.assertEqual(self.read(concurrency=4, prefetch=8), self.body)
+        self.assertEqual(max(max_active), 4)
+        max_active.clear()
+        self.assertEqual(self.read(concurrency=1, prefetch=4), self.body)
+        self.assertEqual(max(max_active), 1)
+
+    def testRangeStart(self):
+        data = b''.join(getBlocks(self.s3, "bucket", "key", 2500, len(self.body), 1000, concurrency=2))
+        self.assertEqual(data, self.body[2500:])
+        self.assertEqual(sorted(start for _, start in self.s3.gets), [2500, 3500, 4500, 5500, 6500, 7500, 8500, 9500])
+
+    def testInvalidRange(self):
+        # the object is shorter than the content length: read to its end
+        self.assertEqual(self.read(content_length=len(self.body) + 3000, concurrency=2), self.body)
+
+    def testErrorRaised(self):
+        errors = (ClientError({'Error': {'Code': 'PreconditionFailed'}}, 'GetObject'),
+                  ClientError({'Error': {'Code': 'SlowDown'}}, 'GetObject'),
+                  ReadTimeoutError(endpoint_url="http://s3"))
+        for error in errors:
+            self.s3.failures[("key", 3000)] = error
+            data = []
+            with self.assertRaises(type(error)):
+                for block in getBlocks(self.s3, "bucket", "key", 0, len(self.body), 1000,
+                                       concurrency=2, prefetch=4):
+                    data.append(block)
+            # the blocks before the failed range were returned
+            self.assertEqual(b''.join(data), self.body[:3000])
+
+    def testEtagChanged(self):
+        etag = self.s3.etag("key")
+        self.s3.objects["key"] = self.body[::-1]
+        with self.assertRaises(ClientError):
+            self.read(etag=etag)
+
+
+class ClientTest(unittest.TestCase):
+
+    def setUp(self):
+        self.saved = (ghcn_s3._s3_client, ghcn_s3._s3_client_pid)
+        ghcn_s3._s3_client = None
+
+    def tearDown(self):
+        ghcn_s3._s3_client, ghcn_s3._s3_client_pid = self.saved
+
+    def testShared(self):
+        client = ghcn_s3.getClient()
+        self.assertIs(ghcn_s3.getClient(), client)
+        self.assertIs(client.meta.config.signature_version, UNSIGNED)
+        self.assertEqual(client.meta.config.max_pool_connections, config.get("s3_max_pool_connections"))
+        self.assertEqual(client.meta.config.retries['total_max_attempts'], config.get("s3_max_attempts"))
+        # a forked process creates its own client
+        ghcn_s3._s3_client_pid = -1
+        self.assertIsNot(ghcn_s3.getClient(), client)
+
+
+class IncompleteYearTest(unittest.TestCase):
+
+    def setUp(self):
+        config.get("block_size")  # load config.yml before overriding
+        self.saved_cfg = dict(config.cfg)
+        config.cfg.update(block_size=4096, summary_tables=False, fetch_concurrency=2, prefetch_depth=2,
+                          start_year=YEAR, last_year=YEAR + 4, backfill_workers=1, write_queue_depth=0,
+                          write_buffer_size=500 * dt_day.itemsize)
+        self.texts = {year: makeText(1000, year=year) for year in range(YEAR, YEAR + 3)}
+        objects = {f"{config.get('ghcn_path')}{year}.csv": text for year, text in self.texts.items()}
+        self.s3 = FakeS3(objects)
+        self.saved = (ghcn_update.getClient, ghcn_update.getCache)
+        ghcn_update.getClient = lambda: self.s3
+        ghcn_update.getCache = lambda: None
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.f = h5py.File(os.path.join(self.tmpdir.name, "ghcn.h5"), "w")
+        createDataTable(self.f, "data", chunks=(256,))
+
+    def tearDown(self):
+        self.f.close()
+        self.tmpdir.cleanup()
+        ghcn_update.getClient, ghcn_update.getCache = self.saved
+        config.cfg.clear()
+        config.cfg.update(self.saved_cfg)
+
+    def testStopAtFailedYear(self):
+        key = f"{config.get('ghcn_path')}{YEAR + 1}.csv"
+        self.s3.failures[(key, 8192)] = ReadTimeoutError(endpoint_url="http://s3")
+        with self.assertRaises(ReadTimeoutError):
+            ghcn_update.getData(self.f)
+        # the year after the failed one wasn't started
+        self.assertEqual(ghcn_update.getManifest(self.f, YEAR + 2)['byte_offset'], 0)
+        manifest = ghcn_update.getManifest(self.f, YEAR + 1)
+        self.assertLess(manifest['byte_offset'], len(self.texts[YEAR + 1]))
+
+        # the next update resumes the failed year
+        del self.s3.failures[(key, 8192)]
+        ghcn_update.getData(self.f)
+        expected = np.concatenate([parseRows(self.texts[year]) for year in sorted(self.texts)])
+        self.assertTrue(np.array_equal(getDataTable(self.f)[...], expected))
+
+    def testHeadError(self):
+        self.s3.head_object = self.failHead
+        with self.assertRaises(ClientError):
+            ghcn_update.getData(self.f)
+        # the first year was written, and nothing after the failed one
+        self.assertEqual(ghcn_update.getLastManifestYear(self.f), YEAR)
+        self.assertTrue(np.array_equal(getDataTable(self.f)[...], parseRows(self.texts[YEAR])))
+
+    def failHead(self, Bucket, Key, **kwargs):
+        if Key.endswith(f"{YEAR + 1}.csv"):
+            raise ClientError({'Error': {'Code': '503'}}, 'HeadObject')
+        return FakeS3.head_object(self.s3, Bucket, Key, **kwargs)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,108 @@
+'''
+Tests for the parallel scan API (ghcn_scan) on local HDF5 files with
+each data table layout and encoding.
+'''
+
+import os
+import sys
+import tempfile
+import unittest
+import numpy as np
+import h5py
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("CONFIG_DIR", os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import ghcn_scan
+from ghcn_parse import parseRows
+from ghcn_table import createDataTable, getDataTable
+from test_s3 import makeText
+
+NUM_ROWS = 5000
+CHUNK_ROWS = 256
+
+
+def getSummary(rows):
+    """ scan function: row count and unique station_ids of a slice """
+    return len(rows), rows.dtype.names, np.unique(rows['station_id'])
+
+
+class SlicesTest(unittest.TestCase):
+
+    def testSlices(self):
+        self.assertEqual(ghcn_scan.getSlices(1000, 100, slice_rows=300),
+                         [(0, 300), (300, 600), (600, 900), (900, 1000)])
+        # later slices start on a chunk boundary, and slice_rows is rounded
+        # down to whole chunks
+        self.assertEqual(ghcn_scan.getSlices(1000, 100, start_row=150, end_row=720, slice_rows=250),
+                         [(150, 200), (200, 400), (400, 600), (600, 720)])
+        self.assertEqual(ghcn_scan.getSlices(1000, 100, start_row=950, end_row=5000, slice_rows=50),
+                         [(950, 1000)])
+        self.assertEqual(ghcn_scan.getSlices(1000, 100), [(0, 800), (800, 1000)])
+        self.assertEqual(ghcn_scan.getSlices(0, 100), [])
+
+
+class ScanTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.rows = parseRows(makeText(NUM_ROWS, num_stations=37))
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def makeFile(self, layout="table", encoding="string"):
+        path = os.path.join(self.tmpdir.name, f"{layout}_{encoding}.h5")
+        with h5py.File(path, "w") as f:
+            createDataTable(f, "data", layout=layout, encoding=encoding, chunks=(CHUNK_ROWS,))
+            dset = getDataTable(f)
+            dset.resize((NUM_ROWS,))
+            dset[...] = self.rows
+        return path
+
+    def testScan(self):
+        path = self.makeFile()
+        results = list(ghcn_scan.scan(path, getSummary, workers=2, slice_rows=3 * CHUNK_ROWS))
+        # results are in row order, one per slice
+        self.assertEqual([count for count, _, _ in results],
+                         [end - start for start, end in ghcn_scan.getSlices(NUM_ROWS, CHUNK_ROWS, slice_rows=768)])
+        station_ids = np.unique(np.concatenate([ids for _, _, ids in results]))
+        self.assertEqual(station_ids.tolist(), np.unique(self.rows['station_id']).tolist())
+
+        results = list(ghcn_scan.scan(path, getSummary, start_row=1000, end_row=1100, workers=1))
+        self.assertEqual(len(results), 1)
+        count, names, ids = results[0]
+        self.assertEqual(count, 100)
+        self.assertEqual(names, self.rows.dtype.names)
+        self.assertEqual(ids.tolist(), np.unique(self.rows['station_id'][1000:1100]).tolist())
+
+    def testFields(self):
+        for layout, encoding in (("table", "string"), ("columns", "string"), ("table", "compact"),
+                                 ("columns", "compact")):
+            path = self.makeFile(layout, encoding)
+            results = list(ghcn_scan.scan(path, getSummary, workers=2, fields=('station_id', 'ymd')))
+            self.assertEqual(sum(count for count, _, _ in results), NUM_ROWS)
+            self.assertTrue(all(names == ('station_id', 'ymd') for _, names, _ in results))
+            with h5py.File(path, "r") as f:
+                dset = getDataTable(f)
+                arr = ghcn_scan.readSlice(dset, 100, 2100, fields=('ymd', 'data_value', 'q_flag'))
+                self.assertEqual(arr.dtype.names, ('ymd', 'data_value', 'q_flag'))
+                for name in arr.dtype.names:
+                    self.assertTrue(np.array_equal(arr[name], self.rows[name][100:2100]), (layout, encoding, name))
+                self.assertTrue(np.array_equal(ghcn_scan.readSlice(dset, 100, 2100), self.rows[100:2100]))
+
+    def testColumnsRead(self):
+        # only the requested columns of a compact columns table are read
+        path = self.makeFile("columns", "compact")
+        with h5py.File(path, "r") as f:
+            dset = getDataTable(f)
+            read = []
+            getColumn = dset.raw.getColumn
+            dset.raw.getColumn = lambda name, sel=slice(None): read.append(name) or getColumn(name, sel)
+            arr = ghcn_scan.readSlice(dset, 0, NUM_ROWS, fields=('station_id', 'element'))
+            self.assertEqual(sorted(read), ['element', 'station'])
+            self.assertTrue(np.array_equal(arr['element'], self.rows['element']))
+
+
+if __name__ == "__main__":
+    unittest.main()
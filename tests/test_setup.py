@@ -0,0 +1,71 @@
+'''
+Tests for creating a file with ghcn_setup.py, run as a script on a local
+HDF5 file.
+'''
+
+import os
+import sys
+import subprocess
+import tempfile
+import unittest
+import h5py
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+
+from ghcn_dtype import dt_day, dt_day_compact
+from ghcn_table import getLayout, getEncoding, getShardCount
+
+
+class SetupTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmpdir.name, "ghcn.h5")
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def setup(self, *args):
+        cmd = [sys.executable, os.path.join(REPO_DIR, "ghcn_setup.py"), self.path, "--loglevel", "error"]
+        return subprocess.run(cmd + list(args), capture_output=True, text=True, cwd=REPO_DIR)
+
+    def testDefaults(self):
+        self.assertEqual(self.setup().returncode, 0)
+        with h5py.File(self.path, "r") as f:
+            self.assertEqual(sorted(f), ["data", "manifest", "stations"])
+            self.assertEqual(f["data"].dtype, dt_day)
+            self.assertEqual(f["data"].chunks, (91268,))
+            self.assertIsNone(f["data"].compression)
+
+    def testFilters(self):
+        result = self.setup("--layout", "columns", "--encoding", "compact", "--compression", "gzip",
+                            "--level", "4", "--shuffle", "--chunks", "5000")
+        self.assertEqual(result.returncode, 0, result.stderr)
+        with h5py.File(self.path, "r") as f:
+            self.assertEqual(getLayout(f), "columns")
+            self.assertEqual(getEncoding(f), "compact")
+            self.assertEqual(sorted(f["data"]), sorted(dt_day_compact.names))
+            for name in dt_day_compact.names:
+                dset = f["data"][name]
+                self.assertEqual((dset.compression, dset.compression_opts, dset.shuffle, dset.chunks),
+                                 ("gzip", 4, True, (5000,)), name)
+            self.assertEqual(f["stations"].compression, "gzip")
+
+    def testShards(self):
+        self.assertEqual(self.setup("--shards", "3", "--compression", "lzf").returncode, 0)
+        with h5py.File(self.path, "r") as f:
+            self.assertEqual(getShardCount(f), 3)
+            self.assertNotIn("data", f)
+            for shard_id in range(3):
+                shard = f["shards"][str(shard_id)]
+                self.assertEqual(shard["data"].compression, "lzf")
+                self.assertIn("manifest", shard)
+
+    def testBadOption(self):
+        self.assertNotEqual(self.setup("--chunks", "many").returncode, 0)
+        self.assertFalse(os.path.exists(self.path))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,122 @@
+'''
+Tests for sharded files (ghcn_table.ShardTable and the shard handling in
+ghcn_update), using a stubbed S3 client and a local HDF5 file.
+'''
+
+import os
+import sys
+import tempfile
+import unittest
+import numpy as np
+import h5py
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("CONFIG_DIR", os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import config
+import ghcn_update
+from ghcn_parse import parseRows
+from ghcn_dtype import dt_day
+from ghcn_table import ShardTable, createShards, getDataTable, getShardGroups, getYearGroup, getYearShard
+from test_s3 import FakeS3, makeText
+
+YEAR = 1990
+SHARDS = 3
+
+
+class ShardTest(unittest.TestCase):
+
+    def setUp(self):
+        config.get("block_size")  # load config.yml before overriding
+        self.saved_cfg = dict(config.cfg)
+        config.cfg.update(block_size=4096, summary_tables=False, fetch_concurrency=1, prefetch_depth=1,
+                          start_year=YEAR, last_year=YEAR + 5, backfill_workers=1, write_queue_depth=0,
+                          write_buffer_size=300 * dt_day.itemsize, shard_id=None)
+        self.texts = {year: makeText(200 + 10 * (year - YEAR), year=year) for year in range(YEAR, YEAR + 5)}
+        objects = {f"{config.get('ghcn_path')}{year}.csv": text for year, text in self.texts.items()}
+        self.s3 = FakeS3(objects)
+        self.saved = (ghcn_update.getClient, ghcn_update.getCache, ghcn_update.socket.gethostname,
+                      ghcn_update.WORKER_START_METHOD)
+        ghcn_update.getClient = lambda: self.s3
+        ghcn_update.getCache = lambda: None
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.f = h5py.File(os.path.join(self.tmpdir.name, "ghcn.h5"), "w")
+        createShards(self.f, SHARDS, chunks=(128,))
+
+    def tearDown(self):
+        self.f.close()
+        self.tmpdir.cleanup()
+        (ghcn_update.getClient, ghcn_update.getCache, ghcn_update.socket.gethostname,
+         ghcn_update.WORKER_START_METHOD) = self.saved
+        config.cfg.clear()
+        config.cfg.update(self.saved_cfg)
+
+    def testShardId(self):
+        ghcn_update.socket.gethostname = lambda: "ghcn-collector-2"
+        self.assertEqual(ghcn_update.getShardId(), 2)
+        ghcn_update.socket.gethostname = lambda: "ghcn-collector"
+        with self.assertRaises(ValueError):
+            ghcn_update.getShardId()
+        # the shard_id config overrides the hostname
+        config.cfg.update(shard_id=1)
+        self.assertEqual(ghcn_update.getShardId(), 1)
+        grp, shard_id, shard_count = ghcn_update.getShard(self.f)
+        self.assertEqual((grp.name, shard_id, shard_count), ("/shards/1", 1, SHARDS))
+        config.cfg.update(shard_id=SHARDS)
+        with self.assertRaises(ValueError):
+            ghcn_update.getShard(self.f)
+        # a file without shards is written by every collector
+        with h5py.File(os.path.join(self.tmpdir.name, "plain.h5"), "w") as f:
+            self.assertEqual(ghcn_update.getShard(f), (f, 0, 0))
+            self.assertIs(getYearGroup(f, YEAR), f)
+
+        self.assertEqual([getYearShard(year, SHARDS) for year in range(YEAR, YEAR + 4)], [1, 2, 0, 1])
+        self.assertEqual(getYearGroup(self.f, YEAR).name, "/shards/1")
+
+    def addShards(self):
+        """ Run getData for each shard, and check each shard has only its
+        own years, in order """
+        for shard_id in range(SHARDS):
+            grp = getShardGroups(self.f)[shard_id]
+            ghcn_update.getData(grp, shard_id=shard_id, shard_count=SHARDS)
+        for shard_id, grp in enumerate(getShardGroups(self.f)):
+            years = [year for year in sorted(self.texts) if getYearShard(year, SHARDS) == shard_id]
+            self.assertEqual(ghcn_update.getManifestYears(grp), years)
+            expected = np.concatenate([parseRows(self.texts[year]) for year in years])
+            self.assertTrue(np.array_equal(getDataTable(grp)[...], expected), shard_id)
+
+    def testParallel(self):
+        # workers inherit the stubbed S3 client
+        ghcn_update.WORKER_START_METHOD = "fork"
+        config.cfg.update(backfill_workers=2, write_queue_depth=2)
+        self.addShards()
+
+    def testGetData(self):
+        self.addShards()
+
+        # reads of the whole file see the shards one after another
+        table = getDataTable(self.f)
+        self.assertIsInstance(table, ShardTable)
+        expected = np.concatenate([getDataTable(grp)[...] for grp in getShardGroups(self.f)])
+        self.assertEqual(table.shape, (len(expected),))
+        self.assertTrue(np.array_equal(table[...], expected))
+        offset = table.offsets[1]
+        self.assertTrue(np.array_equal(table[offset - 5:offset + 5], expected[offset - 5:offset + 5]))
+        self.assertEqual(table[int(offset)], expected[offset])
+        self.assertEqual(table[-1], expected[-1])
+        self.assertTrue(np.array_equal(table['ymd'], expected['ymd']))
+        self.assertEqual(len(table[len(expected):]), 0)
+        with self.assertRaises(IndexError):
+            table[len(expected)]
+        with self.assertRaises(ValueError):
+            table[::2]
+        with self.assertRaises(ValueError):
+            table.resize((0,))
+
+        # nothing new to add
+        for shard_id, grp in enumerate(getShardGroups(self.f)):
+            self.assertEqual(ghcn_update.getData(grp, shard_id=shard_id, shard_count=SHARDS), 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
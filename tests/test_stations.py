@@ -0,0 +1,231 @@
+'''
+Tests for refreshing the stations table (ghcn_parse.parseStations and
+ghcn_update.getStations), using a stubbed S3 client and a local HDF5
+file, and for the station lookup (ghcn_stations).
+'''
+
+import os
+import sys
+import tempfile
+import unittest
+import numpy as np
+import h5py
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("CONFIG_DIR", os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import config
+import ghcn_update
+from ghcn_dtype import dt_station
+from ghcn_parse import parseStations
+from ghcn_stations import StationLookup, getDistances, getStationLookup, updateStationGrid
+from test_s3 import FakeS3
+
+
+def makeLine(station_id, lat, lon, elev=10.0, state="", name="", gsn="", hcn="", wmo=""):
+    """ Return a ghcnd-stations.txt line """
+    return f"{station_id:11s}{lat:9.4f} {lon:9.4f} {elev:6.1f} {state:2s} {name:30s} {gsn:3s} {hcn:3s} {wmo:5s}"
+
+
+def makeText(lines):
+    return "".join(line + "\n" for line in lines).encode('utf-8')
+
+
+LINES = [makeLine("ACW00011604", 17.1167, -61.7833, 10.1, name="ST JOHNS COOLIDGE FLD"),
+         makeLine("USC00042319", 36.4622, -116.8669, -59.1, "CA", "DEATH VALLEY", "GSN", "HCN", "72486"),
+         makeLine("RSM00024266", 67.55, 133.3833, 137.0, name="VERHOJANSK", wmo="24266"),
+         makeLine("GME00122614", 53.5, 9.9667, 14.0, name="HAMBURG-FUHLSBÜTTEL")]
+
+
+class ParseStationsTest(unittest.TestCase):
+
+    def testParse(self):
+        arr = parseStations(makeText(LINES))
+        self.assertEqual(list(arr['station_id']), [b"ACW00011604", b"USC00042319", b"RSM00024266", b"GME00122614"])
+        station = arr[1]
+        self.assertAlmostEqual(float(station['lat']), 36.4622, places=4)
+        self.assertAlmostEqual(float(station['lon']), -116.8669, places=4)
+        self.assertAlmostEqual(float(station['elev']), -59.1, places=4)
+        self.assertEqual((station['state'], station['name'], station['gsn_flag'], station['hcn_flag'], station['wmo_id']),
+                         (b"CA", b"DEATH VALLEY", b"GSN", b"HCN", b"72486"))
+        # columns are characters, so a utf-8 name doesn't shift the fields after it
+        self.assertEqual(arr[3]['name'], "HAMBURG-FUHLSBÜTTEL".encode('utf-8'))
+        self.assertAlmostEqual(float(arr[3]['lon']), 9.9667, places=4)
+
+    def testInvalid(self):
+        lines = LINES[:2] + ["USC0004", LINES[2].replace("67.5500", "67.5x00"), ""]
+        arr = parseStations(makeText(lines))
+        self.assertEqual(list(arr['station_id']), [b"ACW00011604", b"USC00042319"])
+
+
+class UpdateStationsTest(unittest.TestCase):
+
+    def setUp(self):
+        config.get("stations_key")  # load config.yml before overriding
+        self.saved_cfg = dict(config.cfg)
+        config.cfg.update(station_grid=False)
+        self.s3 = FakeS3({config.get("stations_key"): makeText(LINES)})
+        self.saved = (ghcn_update.getClient, ghcn_update.getCache)
+        ghcn_update.getClient = lambda: self.s3
+        ghcn_update.getCache = lambda: None
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.f = h5py.File(os.path.join(self.tmpdir.name, "ghcn.h5"), "w")
+        self.f.create_dataset("stations", (0,), maxshape=(None,), chunks=(1000,), dtype=dt_station)
+
+    def tearDown(self):
+        self.f.close()
+        self.tmpdir.cleanup()
+        ghcn_update.getClient, ghcn_update.getCache = self.saved
+        config.cfg.clear()
+        config.cfg.update(self.saved_cfg)
+
+    def testUpdate(self):
+        dset = self.f["stations"]
+        arr = parseStations(makeText(LINES))
+        self.assertEqual(ghcn_update.updateStations(dset, arr), 4)
+        self.assertTrue(np.array_equal(dset[...], arr))
+        self.assertEqual(ghcn_update.updateStations(dset, arr), 0)
+
+        # one station changed, one added, one no longer listed
+        lines = [LINES[3].replace("14.0", "15.0"), makeLine("USW00094728", 40.7789, -73.9692, name="NY CITY"),
+                 LINES[0], LINES[0], LINES[1]]
+        self.assertEqual(ghcn_update.updateStations(dset, parseStations(makeText(lines))), 2)
+        stations = dset[...]
+        # existing stations keep their rows, and new ones are added at the end
+        self.assertEqual(list(stations['station_id']),
+                         [b"ACW00011604", b"USC00042319", b"RSM00024266", b"GME00122614", b"USW00094728"])
+        self.assertEqual(float(stations[3]['elev']), 15.0)
+        self.assertTrue(np.array_equal(stations[:3], arr[:3]))
+
+    def testEtag(self):
+        self.assertEqual(ghcn_update.getStations(self.f), 4)
+        self.assertEqual(len(self.f["stations"]), 4)
+        # unchanged: the GET is conditional on the saved etag
+        self.assertEqual(ghcn_update.getStations(self.f), 0)
+        self.s3.objects[config.get("stations_key")] = makeText(LINES + [makeLine("USW00094728", 40.7789, -73.9692)])
+        self.assertEqual(ghcn_update.getStations(self.f), 1)
+        self.assertEqual(len(self.f["stations"]), 5)
+
+
+def makeStations(count, seed=0):
+    """ Return a dt_station array with random locations, with extra
+    stations near the poles and the antimeridian and one without a
+    location """
+    rng = np.random.default_rng(seed)
+    lats = np.degrees(np.arcsin(rng.uniform(-1, 1, count)))
+    lons = rng.uniform(-180, 180, count)
+    edges = [(89.9, 10.0), (90.0, -170.0), (-89.5, 45.0), (0.0, 180.0), (0.5, -180.0),
+             (10.0, 179.99), (10.0, -179.99), (np.nan, np.nan)]
+    arr = np.zeros((count + len(edges),), dtype=dt_station)
+    arr['station_id'] = [f"XX{i:09d}".encode('ascii') for i in range(len(arr))]
+    arr['lat'][:count] = lats
+    arr['lon'][:count] = lons
+    arr['lat'][count:] = [lat for lat, _ in edges]
+    arr['lon'][count:] = [lon for _, lon in edges]
+    return arr
+
+
+class StationLookupTest(unittest.TestCase):
+
+    def setUp(self):
+        self.stations = makeStations(5000)
+        self.lookup = StationLookup(self.stations)
+        self.lats = self.stations['lat'].astype(np.float64)
+        self.lons = self.stations['lon'].astype(np.float64)
+
+    def checkRadius(self, lookup, lat, lon, km):
+        rows, distances = lookup.radius(lat, lon, km)
+        expected = np.flatnonzero(getDistances(lat, lon, self.lats, self.lons) <= km)
+        self.assertEqual(sorted(rows.tolist()), expected.tolist(), (lat, lon, km))
+        self.assertTrue(np.all(np.diff(distances) >= 0))
+
+    def testGetStation(self):
+        self.assertEqual(len(self.lookup), 5008)
+        self.assertEqual(self.lookup.getRow("XX000000042"), 42)
+        self.assertEqual(self.lookup.getStation(b"XX000005007")['station_id'], b"XX000005007")
+        self.assertIsNone(self.lookup.getRow("USC00000000"))
+        self.assertIsNone(self.lookup.getStation("USC00000000"))
+
+    def testRadius(self):
+        points = [(40.0, -105.0), (0.0, 180.0), (5.0, -179.5), (89.0, 0.0), (-88.0, 120.0), (-30.0, 20.0)]
+        for lat, lon in points:
+            for km in (0.0, 50.0, 300.0, 2000.0, 25000.0):
+                self.checkRadius(self.lookup, lat, lon, km)
+        # a circle across the pole and a point given with lon outside -180 to 180
+        self.checkRadius(self.lookup, 89.95, 100.0, 200.0)
+        self.checkRadius(self.lookup, 10.0, 540.0 - 0.005, 100.0)
+        # the station on the pole is found at any longitude
+        rows, _ = self.lookup.radius(90.0, 0.0, 1.0)
+        self.assertIn(5001, rows.tolist())
+
+    def testNearest(self):
+        all_rows = np.flatnonzero(np.isfinite(self.lats))
+        for lat, lon in [(40.0, -105.0), (0.0, 179.9), (-89.9, 0.0), (89.95, -30.0)]:
+            for k in (1, 5, 50):
+                rows, distances = self.lookup.nearest(lat, lon, k)
+                expected = np.sort(getDistances(lat, lon, self.lats[all_rows], self.lons[all_rows]))[:k]
+                self.assertEqual(len(rows), k)
+                self.assertTrue(np.allclose(distances, expected), (lat, lon, k))
+        # more than the number of stations
+        rows, _ = self.lookup.nearest(0.0, 0.0, 6000)
+        self.assertEqual(sorted(rows.tolist()), all_rows.tolist())
+
+    def testBbox(self):
+        boxes = [(30.0, -110.0, 45.0, -95.0), (-10.0, 170.0, 10.0, -170.0), (80.0, -180.0, 90.0, 180.0),
+                 (-90.0, -10.0, -60.0, 10.0), (0.0, 179.99, 20.0, 180.0), (0.0, 0.0, 0.0, 0.0)]
+        for min_lat, min_lon, max_lat, max_lon in boxes:
+            in_lats = (self.lats >= min_lat) & (self.lats <= max_lat)
+            if min_lon <= max_lon:
+                in_lons = (self.lons >= min_lon) & (self.lons <= max_lon)
+            else:
+                in_lons = (self.lons >= min_lon) | (self.lons <= max_lon)
+            rows = self.lookup.bbox(min_lat, min_lon, max_lat, max_lon)
+            self.assertEqual(rows.tolist(), np.flatnonzero(in_lats & in_lons).tolist(),
+                             (min_lat, min_lon, max_lat, max_lon))
+
+    def testCellSize(self):
+        lookup = StationLookup(self.stations, cell_size=7.0)
+        self.checkRadius(lookup, 0.0, 180.0, 1500.0)
+        self.assertEqual(lookup.bbox(-10.0, 170.0, 10.0, -170.0).tolist(),
+                         self.lookup.bbox(-10.0, 170.0, 10.0, -170.0).tolist())
+
+
+class StationGridTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.f = h5py.File(os.path.join(self.tmpdir.name, "ghcn.h5"), "w")
+        self.stations = makeStations(500)
+        dset = self.f.create_dataset("stations", data=self.stations, maxshape=(None,), chunks=(1000,))
+        dset.attrs["_etag"] = '"one"'
+
+    def tearDown(self):
+        self.f.close()
+        self.tmpdir.cleanup()
+
+    def testSaved(self):
+        lookup = updateStationGrid(self.f, cell_size=2.0)
+        dset = self.f["station_grid"]
+        self.assertEqual(len(dset), 507)
+        self.assertEqual(dset.attrs["_etag"], '"one"')
+        self.assertTrue(np.array_equal(dset[...], lookup.grid.cells))
+        # the saved grid is used while the stations etag matches
+        lookup = getStationLookup(self.f)
+        self.assertEqual(lookup.grid.cell_size, 2.0)
+        self.assertEqual(lookup.bbox(-45.0, 0.0, 45.0, 90.0).tolist(),
+                         StationLookup(self.stations).bbox(-45.0, 0.0, 45.0, 90.0).tolist())
+
+    def testOutOfDate(self):
+        updateStationGrid(self.f, cell_size=2.0)
+        self.f["stations"].attrs["_etag"] = '"two"'
+        self.assertEqual(getStationLookup(self.f).grid.cell_size, 1.0)
+        # rows past the end of the stations table aren't used either
+        updateStationGrid(self.f, cell_size=2.0)
+        self.f["stations"].resize((400,))
+        lookup = getStationLookup(self.f)
+        self.assertEqual(lookup.grid.cell_size, 1.0)
+        self.assertEqual(len(lookup.grid.cells), 400)
+
+
+if __name__ == "__main__":
+    unittest.main()
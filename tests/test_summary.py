@@ -0,0 +1,156 @@
+'''
+Tests for the monthly and yearly summary tables (ghcn_summary), checked
+against a brute force count of the rows, on a local HDF5 file.
+'''
+
+import os
+import sys
+import datetime
+import tempfile
+import unittest
+import numpy as np
+import h5py
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("CONFIG_DIR", os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import config
+import ghcn_summary
+import ghcn_update
+from ghcn_dtype import dt_day, dt_summary
+from ghcn_parse import BAD_VALUE
+from ghcn_table import createDataTable, getDataTable
+from ghcn_index import updateTimeIndex
+
+YEAR = 1990
+STATIONS = [f"USC{i:08d}".encode('ascii') for i in range(6)]
+ELEMENTS = [b"TMAX", b"TMIN", b"PRCP"]
+
+
+def makeRows(count, seed=0):
+    """ Return count dt_day rows in date order over two years, with some
+    q_flags, unparsed values and invalid dates """
+    rng = np.random.default_rng(seed)
+    rows = np.zeros((count,), dtype=dt_day)
+    days = np.sort(rng.integers(0, 730, count))
+    rows['ymd'] = [(datetime.date(YEAR, 1, 1) + datetime.timedelta(days=int(day))).strftime("%Y%m%d").encode('ascii')
+                   for day in days]
+    rows['station_id'] = rng.choice(STATIONS, count)
+    rows['element'] = rng.choice(ELEMENTS, count)
+    rows['data_value'] = rng.integers(-500, 500, count)
+    rows['q_flag'][rng.random(count) < 0.05] = b"X"
+    rows['data_value'][rng.random(count) < 0.05] = BAD_VALUE
+    rows['ymd'][:3] = [b"19901301", b"1990013X", b"19900230"]
+    return rows
+
+
+def getCounted(rows):
+    """ Return (ymd, station_id, element, data_value) of the rows that
+    should be counted in the summaries """
+    counted = []
+    for row in rows:
+        ymd = row['ymd'].decode('ascii')
+        try:
+            datetime.datetime.strptime(ymd, "%Y%m%d")
+        except ValueError:
+            continue
+        if row['q_flag'] == b'' and row['data_value'] != BAD_VALUE:
+            counted.append((ymd, row['station_id'], row['element'], int(row['data_value'])))
+    return counted
+
+
+def bruteForce(counted, prefix):
+    """ Return the dt_summary entries of the counted rows with ymd
+    starting with prefix, sorted by station_id and element """
+    totals = {}
+    for ymd, station_id, element, value in counted:
+        if not ymd.startswith(prefix):
+            continue
+        key = (station_id, element)
+        count, total, low, high = totals.get(key, (0, 0, value, value))
+        totals[key] = (count + 1, total + value, min(low, value), max(high, value))
+    entries = np.zeros((len(totals),), dtype=dt_summary)
+    for i, key in enumerate(sorted(totals)):
+        entries[i] = key + totals[key]
+    return entries
+
+
+class SummaryTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.f = h5py.File(os.path.join(self.tmpdir.name, "ghcn.h5"), "w")
+        self.rows = makeRows(4000)
+        self.counted = getCounted(self.rows)
+
+    def tearDown(self):
+        self.f.close()
+        self.tmpdir.cleanup()
+
+    def checkSummaries(self):
+        for year in (YEAR, YEAR + 1):
+            self.assertTrue(np.array_equal(ghcn_summary.getSummary(self.f, year), bruteForce(self.counted, f"{year}")))
+            for month in range(1, 13):
+                self.assertTrue(np.array_equal(ghcn_summary.getSummary(self.f, year, month=month),
+                                               bruteForce(self.counted, f"{year}{month:02d}")), (year, month))
+
+    def testUpdate(self):
+        # rows added in several writes are merged into the existing entries
+        for start in range(0, len(self.rows), 700):
+            ghcn_summary.updateSummaries(self.f, self.rows[start:start + 700])
+        self.assertEqual(sorted(self.f[ghcn_summary.MONTHLY]), [f"{year}{month:02d}" for year in (YEAR, YEAR + 1)
+                                                                  for month in range(1, 13)])
+        self.checkSummaries()
+        self.assertEqual(len(ghcn_summary.getSummary(self.f, YEAR + 2)), 0)
+
+        entries = ghcn_summary.getSummary(self.f, YEAR, month=3, station_id=STATIONS[2].decode('ascii'))
+        self.assertEqual(len(entries), 3)
+        self.assertTrue(np.all(entries['station_id'] == STATIONS[2]))
+        entries = ghcn_summary.getSummary(self.f, YEAR, station_id=STATIONS[2], element="PRCP")
+        expected = bruteForce(self.counted, f"{YEAR}")
+        self.assertEqual(entries.tolist(), expected[(expected['station_id'] == STATIONS[2]) &
+                                                    (expected['element'] == b"PRCP")].tolist())
+
+    def testRebuild(self):
+        dset = createDataTable(self.f, "data", chunks=(256,))
+        dset.resize((len(self.rows),))
+        dset[...] = self.rows
+        ghcn_summary.SCAN_ROWS, saved = 1000, ghcn_summary.SCAN_ROWS
+        try:
+            ghcn_summary.updateSummaries(self.f, self.rows[:100])
+            ghcn_summary.rebuildSummaries(self.f)
+            self.checkSummaries()
+
+            # a year is rebuilt from the whole table, or its rows in the time index
+            del self.f[f"{ghcn_summary.MONTHLY}/{YEAR}05"]
+            ghcn_summary.updateSummaries(self.f, self.rows[-100:])
+            ghcn_summary.rebuildYearSummaries(self.f, YEAR + 1)
+            ghcn_summary.rebuildYearSummaries(self.f, YEAR)
+            self.checkSummaries()
+            updateTimeIndex(self.f, self.rows, 0)
+            ghcn_summary.updateSummaries(self.f, self.rows[-100:])
+            ghcn_summary.rebuildYearSummaries(self.f, YEAR + 1)
+            self.checkSummaries()
+        finally:
+            ghcn_summary.SCAN_ROWS = saved
+
+    def testAddRows(self):
+        config.get("summary_tables")  # load config.yml before overriding
+        saved_cfg = dict(config.cfg)
+        config.cfg.update(summary_tables=True, station_index=False, time_index=False)
+        try:
+            createDataTable(self.f, "data", encoding="compact", chunks=(256,))
+            for start in range(0, len(self.rows), 1000):
+                ghcn_update.addRows(self.f, self.rows[start:start + 1000])
+        finally:
+            config.cfg.clear()
+            config.cfg.update(saved_cfg)
+        self.checkSummaries()
+        # a rebuild from the compact table gives the same summaries
+        ghcn_summary.rebuildSummaries(self.f)
+        self.checkSummaries()
+        self.assertEqual(len(getDataTable(self.f)), len(self.rows))
+
+
+if __name__ == "__main__":
+    unittest.main()
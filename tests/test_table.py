@@ -0,0 +1,119 @@
+'''
+Tests for the data table layouts and encodings (ghcn_table), using a
+local HDF5 file.
+'''
+
+import os
+import sys
+import tempfile
+import unittest
+import numpy as np
+import h5py
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from ghcn_parse import parseRows
+from ghcn_scan import readSlice
+from ghcn_dtype import dt_day
+from ghcn_table import createDataTable, getDataTable, getLayout, getEncoding, ColumnTable, CompactTable, LAYOUTS
+
+TEXT = b"""USC00042319,20250107,TMAX,156,,,a,0700
+USC00042319,20250107,PRCP,0,T,,7,
+ASN00008050,18770101,PRCP,12,,G,a,
+ASN00008050,18770231,PRCP,3,,,a,
+ASN00008050,1877AB01,PRCP,4,B,X,S,2400
+ASN00008050,,SNOW,5,,,,
+USC00042319,22500101,TMIN,-32,H,,W,0800
+"""
+
+
+class LayoutTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.f = h5py.File(os.path.join(self.tmpdir.name, "ghcn.h5"), "w")
+        self.rows = parseRows(TEXT)
+
+    def tearDown(self):
+        self.f.close()
+        self.tmpdir.cleanup()
+
+    def testColumns(self):
+        createDataTable(self.f, "data", layout="columns", chunks=(4,))
+        self.assertEqual(getLayout(self.f), "columns")
+        self.assertEqual(getEncoding(self.f), "string")
+        # a dataset for each field
+        self.assertEqual(sorted(self.f["data"]), sorted(dt_day.names))
+        dset = getDataTable(self.f)
+        self.assertIsInstance(dset, ColumnTable)
+        dset.resize((len(self.rows),))
+        dset[0:len(self.rows)] = self.rows
+        self.assertEqual(dset.shape, (len(self.rows),))
+        self.assertEqual(dset.chunks, (4,))
+        self.assertTrue(np.array_equal(dset[...], self.rows))
+        self.assertEqual(dset[2], self.rows[2])
+        self.assertTrue(np.array_equal(dset["element"], self.rows["element"]))
+        arr = readSlice(dset, 1, 5, ["station_id", "data_value"])
+        self.assertEqual(arr.dtype.names, ("station_id", "data_value"))
+        self.assertTrue(np.array_equal(arr, self.rows[1:5][["station_id", "data_value"]]))
+
+    def testTable(self):
+        createDataTable(self.f, "data", chunks=(4,))
+        self.assertEqual(getLayout(self.f), "table")
+        self.assertEqual(getEncoding(self.f), "string")
+        dset = getDataTable(self.f)
+        self.assertIsInstance(dset, h5py.Dataset)
+        with self.assertRaises(ValueError):
+            createDataTable(self.f, "data2", layout="rows")
+        with self.assertRaises(ValueError):
+            createDataTable(self.f, "data2", encoding="utf-8")
+
+
+class CompactTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmpdir.name, "ghcn.h5")
+        self.rows = parseRows(TEXT)
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def write(self, layout):
+        with h5py.File(self.path, "w") as f:
+            createDataTable(f, "data", layout=layout, encoding="compact", chunks=(4,))
+            dset = getDataTable(f)
+            self.assertIsInstance(dset, CompactTable)
+            # written in two parts, so codes are added to existing tables
+            dset.resize((len(self.rows),))
+            dset[0:3] = self.rows[0:3]
+            dset[3:] = self.rows[3:]
+
+    def testRoundTrip(self):
+        for layout in LAYOUTS:
+            self.write(layout)
+            with h5py.File(self.path, "r") as f:
+                dset = getDataTable(f)
+                self.assertTrue(np.array_equal(dset[...], self.rows), layout)
+                self.assertEqual(dset[4], self.rows[4])
+                for name in ("ymd", "m_flag", "q_flag", "s_flag", "obs_time"):
+                    self.assertTrue(np.array_equal(dset.getColumn(name, slice(2, 7)), self.rows[name][2:7]), name)
+                fields = ["ymd", "q_flag", "data_value"]
+                self.assertTrue(np.array_equal(readSlice(dset, 1, 6, fields), self.rows[1:6][fields]))
+
+    def testCodes(self):
+        self.write("table")
+        with h5py.File(self.path, "r") as f:
+            raw = getDataTable(f).raw
+            self.assertEqual(raw.dtype.itemsize, 15)
+            # one code for each combination of the three flags
+            self.assertEqual(len(f["flag_codes"]), 6)
+            # invalid dates (Feb 31, non-digits, empty and past MAX_YEAR) are saved as they were
+            self.assertEqual(sorted(f["ymd_codes"][...]), [b"", b"18770231", b"1877AB01", b"22500101"])
+            days = raw["day"]
+            self.assertEqual(np.count_nonzero(days < 0), 4)
+            self.assertEqual(len(np.unique(days[days < 0])), 4)
+
+
+if __name__ == "__main__":
+    unittest.main()
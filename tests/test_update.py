@@ -0,0 +1,280 @@
+'''
+Tests for adding year files to the data table (ghcn_update): the ingest
+manifest, and writing rows with RowBuffer and AsyncWriter, using a
+stubbed S3 client and a local HDF5 file.
+'''
+
+import os
+import sys
+import time
+import tempfile
+import unittest
+import numpy as np
+import h5py
+from botocore.exceptions import ClientError
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("CONFIG_DIR", os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import config
+import ghcn_update
+from ghcn_parse import parseRows
+from ghcn_dtype import dt_day, dt_block
+from ghcn_table import createDataTable, getDataTable
+from ghcn_index import StationIndex, getYearRange
+from test_s3 import FakeS3, makeText
+
+YEAR = 1990
+
+
+class UpdateTest(unittest.TestCase):
+
+    def setUp(self):
+        config.get("block_size")  # load config.yml before overriding
+        self.saved_cfg = dict(config.cfg)
+        config.cfg.update(block_size=4096, summary_tables=False, fetch_concurrency=1, prefetch_depth=1,
+                          start_year=YEAR, last_year=YEAR + 4, backfill_workers=1, write_queue_depth=2,
+                          write_buffer_size=300 * dt_day.itemsize)
+        self.texts = {year: makeText(1000, year=year) for year in range(YEAR, YEAR + 3)}
+        objects = {f"{config.get('ghcn_path')}{year}.csv": text for year, text in self.texts.items()}
+        self.s3 = FakeS3(objects)
+        self.saved = (ghcn_update.getClient, ghcn_update.getCache, ghcn_update.writeRows,
+                      ghcn_update.getManifest, ghcn_update.getBlockHashes, ghcn_update.WORKER_START_METHOD)
+        ghcn_update.getClient = lambda: self.s3
+        ghcn_update.getCache = lambda: None
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.f = h5py.File(os.path.join(self.tmpdir.name, "ghcn.h5"), "w")
+        createDataTable(self.f, "data", chunks=(256,))
+
+    def tearDown(self):
+        self.f.close()
+        self.tmpdir.cleanup()
+        (ghcn_update.getClient, ghcn_update.getCache, ghcn_update.writeRows,
+         ghcn_update.getManifest, ghcn_update.getBlockHashes, ghcn_update.WORKER_START_METHOD) = self.saved
+        config.cfg.clear()
+        config.cfg.update(self.saved_cfg)
+
+    def expected(self):
+        return np.concatenate([parseRows(self.texts[year]) for year in sorted(self.texts)])
+
+    def setText(self, year, text):
+        self.texts[year] = text
+        self.s3.objects[f"{config.get('ghcn_path')}{year}.csv"] = text
+
+    def testManifestResume(self):
+        text = self.texts[YEAR]
+        self.setText(YEAR, text[:text.index(b"\n", 20000) + 1])
+        count = ghcn_update.addYearData(self.f, YEAR)
+        self.assertGreater(count, 0)
+        manifest = ghcn_update.getManifest(self.f, YEAR)
+        self.assertEqual(manifest['byte_offset'], len(self.texts[YEAR]))
+        self.assertEqual(manifest['row_count'], count)
+
+        # rows appended to the file are read from the manifest's byte offset
+        self.setText(YEAR, text)
+        self.s3.gets.clear()
+        self.assertEqual(ghcn_update.addYearData(self.f, YEAR), 1000 - count)
+        self.assertEqual(self.s3.gets[0][1], manifest['byte_offset'])
+        self.assertTrue(np.array_equal(getDataTable(self.f)[...], parseRows(text)))
+        self.assertEqual(ghcn_update.getManifest(self.f, YEAR)['row_count'], 1000)
+        self.assertEqual(ghcn_update.getLastManifestYear(self.f), YEAR)
+
+    def testUnchanged(self):
+        self.assertEqual(ghcn_update.addYearData(self.f, YEAR), 1000)
+        manifest = ghcn_update.getManifest(self.f, YEAR)
+        etag = self.s3.etag(f"{config.get('ghcn_path')}{YEAR}.csv")
+        self.assertEqual(manifest['etag'].decode('ascii'), etag)
+        self.assertEqual(manifest['content_length'], len(self.texts[YEAR]))
+        self.assertGreater(manifest['last_modified'], 0)
+
+        # a loaded year that hasn't changed is one conditional HEAD, and no GETs
+        self.s3.heads.clear()
+        self.s3.gets.clear()
+        self.assertEqual(ghcn_update.addYearData(self.f, YEAR), 0)
+        self.assertEqual([etag for _, etag in self.s3.heads], [etag])
+        self.assertEqual(self.s3.gets, [])
+        self.assertEqual(len(getDataTable(self.f)), 1000)
+
+    def testRowMarker(self):
+        # a file loaded before the manifest resumes from its row marker
+        rows = parseRows(self.texts[YEAR])
+        dset = getDataTable(self.f)
+        dset.resize((600,))
+        dset[0:600] = rows[:600]
+        dset.attrs["_row_marker"] = [YEAR, 600]
+        self.assertEqual(ghcn_update.getManifestYears(self.f), [])
+        self.assertEqual(ghcn_update.addYearData(self.f, YEAR), 400)
+        self.assertTrue(np.array_equal(getDataTable(self.f)[...], rows))
+        self.assertEqual(ghcn_update.getManifestYears(self.f), [YEAR])
+
+    def testSetManifest(self):
+        self.assertEqual(ghcn_update.getManifest(self.f, YEAR)['row_count'], 0)
+        self.assertIsNone(ghcn_update.getLastManifestYear(self.f))
+        for year, row_count in ((YEAR + 1, 10), (YEAR, 20), (YEAR + 1, 30), (YEAR + 2, 0)):
+            entry = ghcn_update.getManifest(self.f, year)
+            entry['row_count'] = row_count
+            ghcn_update.setManifest(self.f, entry)
+        self.assertEqual(len(self.f["manifest"]), 3)
+        self.assertEqual(ghcn_update.getManifest(self.f, YEAR + 1)['row_count'], 30)
+        # years with no rows read aren't counted as ingested
+        self.assertEqual(ghcn_update.getManifestYears(self.f), [YEAR, YEAR + 1])
+        self.assertEqual(ghcn_update.getLastManifestYear(self.f), YEAR + 1)
+
+    def testChunkAligned(self):
+        rows = parseRows(self.texts[YEAR])
+        buffer = ghcn_update.RowBuffer(self.f, 300)
+        dset = getDataTable(self.f)
+        sizes = []
+        for start in range(0, len(rows), 70):
+            block_rows = rows[start:start+70]
+            manifest = ghcn_update.getManifest(self.f, YEAR)
+            manifest['row_count'] = start + len(block_rows)
+            block = np.zeros((1,), dtype=dt_block)[0]
+            block['year'] = YEAR
+            block['line_start'] = start
+            block['row_count'] = len(block_rows)
+            buffer.add(block_rows, manifest, block)
+            if len(dset) not in sizes:
+                sizes.append(len(dset))
+            # writes end on a chunk boundary, and the manifest only covers written rows
+            self.assertEqual(len(dset) % 256, 0)
+            self.assertLessEqual(ghcn_update.getManifest(self.f, YEAR)['row_count'], len(dset))
+        self.assertEqual(sizes, [0, 256, 512, 768])
+        buffer.flush()
+        self.assertTrue(np.array_equal(dset[...], rows))
+        self.assertEqual(ghcn_update.getManifest(self.f, YEAR)['row_count'], 1000)
+        blocks = ghcn_update.getBlockHashes(self.f, YEAR)
+        self.assertEqual(list(blocks['start_row']), list(range(0, 1000, 70)))
+
+    def testUnsavedRows(self):
+        # the collector stopped after a write ended past the last manifest entry
+        buffer = ghcn_update.RowBuffer(self.f, 300)
+        for rows, manifest, block in ghcn_update.readYearData(YEAR):
+            buffer.add(rows, manifest, block)
+            if len(getDataTable(self.f)) > 0:
+                break
+        row_count = ghcn_update.getManifest(self.f, YEAR)['row_count']
+        self.assertEqual(len(getDataTable(self.f)), 256)
+        self.assertLess(row_count, 256)
+        self.assertEqual(ghcn_update.getBlocksEnd(self.f), row_count)
+
+        # the rows already written are skipped when the update resumes
+        self.assertEqual(ghcn_update.getData(self.f), 3000 - row_count)
+        self.assertTrue(np.array_equal(getDataTable(self.f)[...], self.expected()))
+        blocks = ghcn_update.getBlockHashes(self.f, YEAR)
+        self.assertEqual(list(blocks['start_row'][1:]), list(np.cumsum(blocks['row_count'])[:-1]))
+        self.assertEqual(ghcn_update.getBlocksEnd(self.f), 3000)
+
+    def testParallel(self):
+        # forked workers use the stubbed S3 client
+        ghcn_update.WORKER_START_METHOD = "fork"
+        self.setText(YEAR + 3, makeText(500, year=YEAR + 3))
+        config.cfg.update(backfill_workers=3, last_year=YEAR + 6)
+        self.assertEqual(ghcn_update.getData(self.f), 3500)
+        self.assertTrue(np.array_equal(getDataTable(self.f)[...], self.expected()))
+        self.assertEqual(ghcn_update.getManifestYears(self.f), list(range(YEAR, YEAR + 4)))
+        blocks = ghcn_update.getBlockHashes(self.f, YEAR + 2)
+        self.assertEqual(blocks['start_row'][0], 2000)
+        # nothing changed
+        self.assertEqual(ghcn_update.getData(self.f), 0)
+
+    def testWorkerError(self):
+        ghcn_update.WORKER_START_METHOD = "fork"
+        config.cfg.update(backfill_workers=2)
+        self.s3.failures[(f"{config.get('ghcn_path')}{YEAR + 2}.csv", 0)] = ClientError(
+            {'Error': {'Code': 'SlowDown'}}, 'GetObject')
+        with self.assertRaises(RuntimeError):
+            ghcn_update.getData(self.f)
+        # the years before the failed one are saved
+        self.assertEqual(ghcn_update.getManifestYears(self.f), [YEAR, YEAR + 1])
+        self.assertTrue(np.array_equal(getDataTable(self.f)[...], self.expected()[:2000]))
+
+    def testLayouts(self):
+        # the same rows are loaded (and indexed) for each layout and encoding
+        config.cfg.update(summary_tables=True)
+        for layout, encoding in (("columns", "string"), ("table", "compact"), ("columns", "compact")):
+            with h5py.File(os.path.join(self.tmpdir.name, f"{layout}-{encoding}.h5"), "w") as f:
+                createDataTable(f, "data", layout=layout, encoding=encoding, chunks=(256,))
+                self.assertEqual(ghcn_update.getData(f), 3000)
+                self.assertTrue(np.array_equal(getDataTable(f)[...], self.expected()), f"{layout} {encoding}")
+                self.assertEqual(getYearRange(f, YEAR + 1), (1000, 2000))
+                station_rows = StationIndex(f).getRows("USC00000003")
+                self.assertTrue(np.array_equal(station_rows['data_value'], self.expected()['data_value'][3::20]))
+
+    def testWriterIdleOnRead(self):
+        # the file isn't read by the main thread while the writer thread uses it
+        writing = []
+        overlaps = []
+        writeRows, getManifest, getBlockHashes = self.saved[2:5]
+
+        def slowWriteRows(*args):
+            writing.append(True)
+            time.sleep(0.02)
+            try:
+                writeRows(*args)
+            finally:
+                writing.pop()
+
+        def checked(func):
+            def wrapper(*args):
+                if writing:
+                    overlaps.append(func.__name__)
+                return func(*args)
+            return wrapper
+
+        ghcn_update.writeRows = slowWriteRows
+        ghcn_update.getManifest = checked(getManifest)
+        ghcn_update.getBlockHashes = checked(getBlockHashes)
+        self.assertEqual(ghcn_update.getData(self.f), 3000)
+        # a rewritten year is reconciled after the later years are queued
+        key = f"{config.get('ghcn_path')}{YEAR}.csv"
+        text = bytearray(self.texts[YEAR])
+        text[text.index(b',TMAX,') + 6] = ord('9')
+        self.s3.objects[key] = self.texts[YEAR] = bytes(text)
+        self.assertEqual(ghcn_update.getData(self.f), 0)
+        self.assertEqual(overlaps, [])
+        self.assertTrue(np.array_equal(getDataTable(self.f)[...], self.expected()))
+
+
+    def testWriterError(self):
+        # an error in the writer thread is raised by the next put, wait or close
+        writeRows = self.saved[2]
+        written = []
+
+        def failingWriteRows(f, rows, manifests, blocks=()):
+            if len(written) == 1:
+                raise OSError("write failed")
+            written.append(len(rows))
+            writeRows(f, rows, manifests, blocks)
+
+        ghcn_update.writeRows = failingWriteRows
+        rows = parseRows(self.texts[YEAR])
+        writer = ghcn_update.AsyncWriter(self.f, 1)
+        writer.put(rows[0:100], [])
+        writer.put(rows[100:200], [])
+        with self.assertRaises(OSError):
+            writer.wait()
+        with self.assertRaises(OSError):
+            writer.put(rows[300:400], [])
+        with self.assertRaises(OSError):
+            writer.close()
+        # nothing is written after the failed write
+        self.assertEqual(written, [100])
+        self.assertTrue(np.array_equal(getDataTable(self.f)[...], rows[:100]))
+
+        # getData raises the error, and the next update resumes after the
+        # rows written
+        getDataTable(self.f).resize((0,))
+        written.clear()
+        with self.assertRaises(OSError):
+            ghcn_update.getData(self.f)
+        self.assertEqual(len(written), 1)
+        self.assertEqual(len(getDataTable(self.f)), written[0])
+        ghcn_update.writeRows = writeRows
+        row_count = ghcn_update.getManifest(self.f, YEAR)['row_count']
+        self.assertEqual(ghcn_update.getData(self.f), 3000 - row_count)
+        self.assertTrue(np.array_equal(getDataTable(self.f)[...], self.expected()))
+
+
+if __name__ == "__main__":
+    unittest.main()